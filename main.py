@@ -1,19 +1,112 @@
+import asyncio
 import sys
 
+from utils.startup import startup_timer
 from src.main_bot import run_bot
 from src.scheduler import start as schedule_start
-from utils.db import initialize_db
+from utils.db import connect_db, initialize_db, rehydrate_jobs, job_check_spending_summary, job_flush_stats, flush_stats
+from utils.aio import loop_monitor, run_db
+from src.delivery import delivery_queue
+from src.broadcast import resume_broadcasts
+from migrations import run_migrations
+from utils.settings import NOTIFICATION_MODE, METRICS_HOST, METRICS_PORT, SCHEDULER_METRICS_PORT, logging
+from utils import metrics
 
-def main():
+
+logger = logging.getLogger(__name__)
+background_tasks: set[asyncio.Task] = set()
+startup_timer.mark('imports')
+
+
+async def rehydrate(dispatcher, wait_polling: bool) -> None:
+    while wait_polling and not dispatcher.is_polling():
+        await asyncio.sleep(0.05)
+    startup_timer.mark('first poll' if wait_polling else 'webhook server start')
+    count = await rehydrate_jobs()
+    logger.info(f'Restored {count} notifications')
+    startup_timer.mark('rehydration')
+
+
+def get_on_startup(wait_polling: bool):
+    async def on_startup(dispatcher) -> None:
+        loop_monitor.start()
+        delivery_queue.start()
+        if METRICS_PORT:
+            await metrics.start_server(METRICS_HOST, METRICS_PORT)
+        await resume_broadcasts()
+        if NOTIFICATION_MODE == 'worker':  # notifications are handled by the scheduler process
+            return
+        task = asyncio.create_task(rehydrate(dispatcher, wait_polling))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    return on_startup
+
+
+async def on_shutdown(dispatcher) -> None:
+    await delivery_queue.stop()
+    await run_db(flush_stats)
+
+
+def add_notification_jobs() -> None:
+    from src.sweeper import job_sweep_notifications
+    from src.outbox import job_relay_outbox
+    job_sweep_notifications()
+    job_relay_outbox()
+
+
+def run_scheduler() -> None:
+    """Scheduler process for the 'worker' notification mode, the bot process only handles updates."""
+    schedule_start()
+    connect_db()
+    run_migrations()
+    initialize_db()
+    job_flush_stats()
+    add_notification_jobs()
+    loop = asyncio.get_event_loop()
+
+    async def on_startup() -> None:
+        loop_monitor.start()
+        delivery_queue.start()
+        if SCHEDULER_METRICS_PORT:
+            await metrics.start_server(METRICS_HOST, SCHEDULER_METRICS_PORT)
+        count = await rehydrate_jobs()
+        logger.info(f'Restored {count} notifications')
+
+    loop.run_until_complete(on_startup())
+    logger.info('Scheduler started')
+    try:
+        loop.run_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        loop.run_until_complete(delivery_queue.stop())
+        flush_stats()
+
+
+def main(webhook: bool = False):
     schedule_start()
+    connect_db()
+    run_migrations()
+    startup_timer.mark('migrations')
     initialize_db()
-    run_bot()
+    job_check_spending_summary()
+    job_flush_stats()
+    if NOTIFICATION_MODE == 'sweeper':
+        add_notification_jobs()
+    if webhook:
+        from src.webhook import run_webhook
+        run_webhook(on_startup=get_on_startup(wait_polling=False), on_shutdown=on_shutdown)
+    else:
+        run_bot(on_startup=get_on_startup(wait_polling=True), on_shutdown=on_shutdown)
 
 
 if __name__ == '__main__':
     args = sys.argv[1:]
     if len(args) == 0:
         main()
+    if len(args) == 1 and args[0] == 'webhook':
+        main(webhook=True)
     if len(args) == 1 and args[0] == 'migrate':
-        from migrations import migration_0001
-        migration_0001()
+        run_migrations()
+    if len(args) == 1 and args[0] == 'scheduler':
+        run_scheduler()
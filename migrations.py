@@ -1,12 +1,214 @@
+from datetime import datetime
+
 import peewee
 from playhouse.migrate import migrate
 
-from utils.settings import migrator
-from utils.db import User
+from utils.settings import migrator, database, logging
+from utils.db import BaseModel, User, Payment, PaymentSearch, Notification, SpendingSummary, set_next_due_dates
+from utils.dates import get_local_now
+
+
+logger = logging.getLogger(__name__)
+
+
+class SchemaVersion(BaseModel):
+    version = peewee.IntegerField(primary_key=True)
+    applied_at = peewee.DateTimeField(default=datetime.now)
+
+
+def outside_transaction(migration):
+    """Mark migration which cannot run inside a transaction, like journal mode change."""
+    migration.outside_transaction = True
+    return migration
+
+
+def has_column(table: str, column: str) -> bool:
+    return column in {c.name for c in database.get_columns(table)}
+
 
+def has_index(table: str, index: str) -> bool:
+    return index in {i.name for i in database.get_indexes(table)}
+
+
+# Migrations only change tables which already exist, new tables are created
+# by `create_tables` with the latest schema. So each one checks what is missing.
 
 def migration_0001() -> None:
-    is_admin_field = peewee.BooleanField(default=False)
-    migrate(
-        migrator.add_column(User._meta.table_name, 'is_admin', is_admin_field),
+    table = User._meta.table_name
+    if database.table_exists(table) and not has_column(table, 'is_admin'):
+        is_admin_field = peewee.BooleanField(default=False)
+        migrate(
+            migrator.add_column(table, 'is_admin', is_admin_field),
+        )
+
+
+def migration_0002() -> None:
+    table = Notification._meta.table_name
+    if not database.table_exists(table):
+        return
+    if not has_column(table, 'next_fire_at'):
+        next_fire_at_field = peewee.DateTimeField(null=True)
+        migrate(migrator.add_column(table, 'next_fire_at', next_fire_at_field))
+    if not has_index(table, 'notification_next_fire_at'):
+        migrate(migrator.add_index(table, ('next_fire_at',)))
+
+
+def migration_0003() -> None:
+    """Composite indexes for ordered lists of user payments and payment notifications."""
+    indexes = (
+        (Payment._meta.table_name, ('user_id', 'id')),
+        (Notification._meta.table_name, ('payment_id', 'id')),
     )
+    for table, columns in indexes:
+        if database.table_exists(table) and not has_index(table, f'{table}_{"_".join(columns)}'):
+            migrate(migrator.add_index(table, columns))
+
+
+def migration_0004() -> None:
+    """Payment names are unique for a user, not for the whole bot."""
+    table = Payment._meta.table_name
+    if not database.table_exists(table):
+        return
+    if has_index(table, 'payment_name'):
+        migrate(migrator.drop_index(table, 'payment_name'))
+    if not has_index(table, 'payment_user_id_name'):
+        migrate(migrator.add_index(table, ('user_id', 'name'), True))
+
+
+@outside_transaction
+def migration_0005() -> None:
+    # synchronous and cache_size are per connection, see DATABASE_PRAGMAS
+    database.execute_sql('PRAGMA journal_mode=wal')
+
+
+def migration_0006() -> None:
+    """Most expensive payments of a user for the summary."""
+    table = Payment._meta.table_name
+    if database.table_exists(table) and not has_index(table, 'payment_user_id_price'):
+        migrate(migrator.add_index(table, ('user_id', 'price')))
+
+
+def migration_0007() -> None:
+    """Users who blocked the bot are skipped by broadcasts and notifications."""
+    table = User._meta.table_name
+    if not database.table_exists(table):
+        return
+    if not has_column(table, 'is_reachable'):
+        is_reachable_field = peewee.BooleanField(default=True)
+        migrate(migrator.add_column(table, 'is_reachable', is_reachable_field))
+    if not has_index(table, 'user_is_reachable_id'):
+        migrate(migrator.add_index(table, ('is_reachable', 'id')))
+
+
+def migration_0008() -> None:
+    """Payments repeat weekly, monthly, quarterly or yearly."""
+    table = Payment._meta.table_name
+    if database.table_exists(table) and not has_column(table, 'period'):
+        period_field = peewee.CharField(default='monthly')
+        migrate(migrator.add_column(table, 'period', period_field))
+    # summary rows were per day of month, now per period; the table is rebuilt on start
+    summary_table = SpendingSummary._meta.table_name
+    if database.table_exists(summary_table) and has_column(summary_table, 'day'):
+        database.drop_tables([SpendingSummary])
+
+
+def migration_0009() -> None:
+    """Full-text search over payments, the index is filled from the existing ones."""
+    if not database.table_exists(Payment._meta.table_name) or PaymentSearch.table_exists():
+        return
+    PaymentSearch.create_table()
+    PaymentSearch.create_triggers()
+    PaymentSearch.rebuild()
+
+
+def migration_0010() -> None:
+    """Next charge of every payment, the upcoming charges are read by the (user, next_due) index."""
+    table = Payment._meta.table_name
+    if not database.table_exists(table):
+        return
+    if not has_column(table, 'next_due'):
+        migrate(migrator.add_column(table, 'next_due', peewee.DateField(null=True)))
+    if not has_index(table, 'payment_user_id_next_due'):
+        migrate(migrator.add_index(table, ('user_id', 'next_due')))
+    payments = list(Payment.select(Payment.id, Payment.date, Payment.period).where(Payment.next_due.is_null()))
+    if payments:
+        set_next_due_dates(payments, get_local_now().date())
+        Payment.bulk_update(payments, fields=[Payment.next_due], batch_size=500)
+
+
+MIGRATIONS = {
+    1: migration_0001,
+    2: migration_0002,
+    3: migration_0003,
+    4: migration_0004,
+    5: migration_0005,
+    6: migration_0006,
+    7: migration_0007,
+    8: migration_0008,
+    9: migration_0009,
+    10: migration_0010,
+}
+
+
+def get_query_plans() -> dict[str, str]:
+    queries = {
+        'payment list': (Payment.select()
+                         .where(Payment.user == 1)
+                         .order_by(Payment.id)),
+        'notification list': (Notification.select()
+                              .where(Notification.payment.in_([1, 2]))
+                              .order_by(Notification.id)),
+        'top payments': (Payment.select()
+                         .where(Payment.user == 1)
+                         .order_by(Payment.price.desc())
+                         .limit(5)),
+        'payment search': (Payment.select()
+                           .join(PaymentSearch, on=(PaymentSearch.rowid == Payment.id))
+                           .where(PaymentSearch.match(PaymentSearch.get_expression(1, 'search')))
+                           .order_by(PaymentSearch.bm25(*PaymentSearch.WEIGHTS))),
+        'upcoming charges': (Payment.select()
+                             .where((Payment.user == 1) & (Payment.next_due < datetime.now().date()))
+                             .order_by(Payment.next_due, Payment.id)
+                             .limit(20)),
+        'due notifications': (Notification.select()
+                              .where(Notification.next_fire_at <= datetime.now())
+                              .order_by(Notification.next_fire_at)),
+    }
+    plans = {}
+    for name, query in queries.items():
+        sql, params = query.sql()
+        try:
+            rows = database.execute_sql(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+        except peewee.OperationalError:  # columns are not migrated yet
+            plans[name] = '-'
+            continue
+        plans[name] = '; '.join(row[-1] for row in rows)
+    return plans
+
+
+def run_migrations() -> list[int]:
+    """Apply migrations which are not recorded in the version table yet."""
+    database.connect(reuse_if_open=True)
+    database.create_tables([SchemaVersion])
+    applied = {row.version for row in SchemaVersion.select()}
+    pending = [version for version in sorted(MIGRATIONS) if version not in applied]
+    if not pending:
+        return []
+
+    can_explain = all(database.table_exists(m._meta.table_name) for m in (Payment, Notification))
+    plans_before = get_query_plans() if can_explain else {}
+    for version in pending:
+        migration = MIGRATIONS[version]
+        logger.info(f'Apply migration {version:04}')
+        if getattr(migration, 'outside_transaction', False):
+            migration()
+            SchemaVersion.create(version=version)
+            continue
+        with database.atomic():
+            migration()
+            SchemaVersion.create(version=version)
+
+    if can_explain:
+        for name, plan in get_query_plans().items():
+            logger.info(f'Query plan for {name}: {plans_before[name]} -> {plan}')
+    return pending
@@ -0,0 +1,201 @@
+import asyncio
+import functools
+import time
+from dataclasses import dataclass, field
+
+from aiogram import types
+from aiogram.utils import exceptions
+
+from utils.settings import (
+    logging, bot, BROADCAST_RATE_LIMIT, BROADCAST_BATCH_SIZE, BROADCAST_PROGRESS_INTERVAL,
+)
+from utils.rate_limit import TokenBucket
+from utils.db import User, Broadcast
+from utils.dates import get_local_now
+from utils.aio import run_db
+from src.delivery import UNREACHABLE_ERRORS
+
+
+logger = logging.getLogger(__name__)
+
+MAX_RETRIES = 3
+
+# keep references to running broadcasts, otherwise asyncio may collect them
+running_broadcasts: set[asyncio.Task] = set()
+
+
+@dataclass
+class BroadcastStats:
+    total: int = 0
+    sent: int = 0
+    unreachable: int = 0
+    failed: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    resumed_from: int = 0  # processed before a restart, not counted in the rate
+
+    @classmethod
+    def from_broadcast(cls, broadcast: Broadcast) -> 'BroadcastStats':
+        stats = cls(broadcast.total, broadcast.sent, broadcast.unreachable, broadcast.failed)
+        stats.resumed_from = stats.processed
+        return stats
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.unreachable + self.failed
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started_at
+        return (self.processed - self.resumed_from) / elapsed if elapsed else 0.0
+
+    def get_message(self, finished: bool = False) -> str:
+        bot_text = [
+            'Рассылка завершена' if finished else 'Идёт рассылка...',
+            f'Обработано: {self.processed} из {self.total}',
+            f'Доставлено: {self.sent}',
+            f'Недоступны: {self.unreachable}',
+            f'Ошибки: {self.failed}',
+            f'Скорость: {self.rate:.1f} сообщ./сек',
+        ]
+        return '\n'.join(bot_text)
+
+
+def get_user_batch(last_id: int, batch_size: int) -> list[tuple[int, int]]:
+    # (is_reachable, id) index: users who blocked the bot are not even read
+    return list(
+        User.select(User.id, User.telegram_id)
+        .where(User.is_reachable & (User.id > last_id))
+        .order_by(User.id)
+        .limit(batch_size)
+        .tuples()
+    )
+
+
+def count_audience() -> int:
+    return User.select().where(User.is_reachable).count()
+
+
+async def iterate_user_batches(last_id: int = 0, batch_size: int = BROADCAST_BATCH_SIZE):
+    """Stream (last user id, telegram ids) in keyset-paginated batches instead of loading the whole table."""
+    while batch := await run_db(get_user_batch, last_id, batch_size):
+        last_id = batch[-1][0]
+        yield last_id, [telegram_id for _, telegram_id in batch]
+
+
+async def send_with_retry(telegram_id: int, text: str, bucket: TokenBucket,
+                          stats: BroadcastStats) -> None:
+    for _ in range(MAX_RETRIES):
+        await bucket.acquire()
+        try:
+            await bot.send_message(telegram_id, text)
+        except exceptions.RetryAfter as exc:
+            logger.warning(f'Flood control on broadcast, sleep {exc.timeout} sec')
+            bucket.pause(exc.timeout)
+            continue
+        except UNREACHABLE_ERRORS:
+            stats.unreachable += 1
+            await User.aset_reachable(telegram_id, False)
+            return
+        except exceptions.TelegramAPIError as exc:
+            logger.debug(f'Cannot broadcast to user {telegram_id}: {exc}')
+            stats.failed += 1
+            return
+        except Exception:
+            logger.exception(f'Cannot broadcast to user {telegram_id}')
+            stats.failed += 1
+            return
+        stats.sent += 1
+        return
+    stats.failed += 1
+
+
+async def report_progress(broadcast: Broadcast, stats: BroadcastStats,
+                          finished: bool = False) -> None:
+    try:
+        await bot.edit_message_text(stats.get_message(finished), broadcast.chat_id, broadcast.message_id)
+    except exceptions.TelegramAPIError as exc:
+        logger.debug(f'Cannot update broadcast progress: {exc}')
+
+
+def save_checkpoint(broadcast: Broadcast, stats: BroadcastStats, last_user_id: int,
+                    finished: bool = False) -> None:
+    broadcast.last_user_id = last_user_id
+    broadcast.sent, broadcast.unreachable, broadcast.failed = stats.sent, stats.unreachable, stats.failed
+    if finished:
+        broadcast.status = Broadcast.FINISHED
+        broadcast.finished_at = get_local_now()
+    broadcast.save()
+
+
+async def run_broadcast(broadcast: Broadcast) -> BroadcastStats:
+    """Send the broadcast to users after its checkpoint, saving the checkpoint after every batch.
+
+    A restart resends at most one batch.
+    """
+    stats = BroadcastStats.from_broadcast(broadcast)
+    bucket = TokenBucket(BROADCAST_RATE_LIMIT)
+    last_report = time.monotonic()
+    last_user_id = broadcast.last_user_id
+    async for last_user_id, batch in iterate_user_batches(broadcast.last_user_id):
+        await asyncio.gather(*(
+            send_with_retry(telegram_id, broadcast.text, bucket, stats)
+            for telegram_id in batch
+        ))
+        await run_db(save_checkpoint, broadcast, stats, last_user_id)
+        if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+            await report_progress(broadcast, stats)
+            last_report = time.monotonic()
+    await run_db(save_checkpoint, broadcast, stats, last_user_id, finished=True)
+    await report_progress(broadcast, stats, finished=True)
+    logger.info(
+        f'Broadcast {broadcast.id} finished: {stats.sent} sent, {stats.unreachable} unreachable, '
+        f'{stats.failed} failed, {stats.rate:.1f} msg/sec'
+    )
+    return stats
+
+
+def mark_failed(broadcast: Broadcast) -> None:
+    broadcast.status = Broadcast.FAILED
+    broadcast.finished_at = get_local_now()
+    broadcast.save(only=[Broadcast.status, Broadcast.finished_at])
+
+
+def on_broadcast_done(broadcast: Broadcast, task: asyncio.Task) -> None:
+    """Mark a crashed broadcast failed, so it is neither left running nor resumed on restart.
+
+    A cancelled one stays running: it is cancelled on shutdown and resumed on start.
+    """
+    running_broadcasts.discard(task)
+    if task.cancelled() or task.exception() is None:
+        return
+    logger.error(f'Broadcast {broadcast.id} failed', exc_info=task.exception())
+    saving = asyncio.create_task(run_db(mark_failed, broadcast))
+    running_broadcasts.add(saving)
+    saving.add_done_callback(running_broadcasts.discard)
+
+
+def run_in_background(broadcast: Broadcast) -> asyncio.Task:
+    task = asyncio.create_task(run_broadcast(broadcast))
+    running_broadcasts.add(task)
+    task.add_done_callback(functools.partial(on_broadcast_done, broadcast))
+    return task
+
+
+async def start_broadcast(text: str, status: types.Message) -> asyncio.Task:
+    broadcast = await run_db(
+        Broadcast.create,
+        text=text,
+        chat_id=status.chat.id,
+        message_id=status.message_id,
+        total=await run_db(count_audience),
+    )
+    return run_in_background(broadcast)
+
+
+async def resume_broadcasts() -> int:
+    """Continue broadcasts interrupted by a restart."""
+    broadcasts = await run_db(Broadcast.get_running)
+    for broadcast in broadcasts:
+        logger.info(f'Resume broadcast {broadcast.id} after user {broadcast.last_user_id}')
+        run_in_background(broadcast)
+    return len(broadcasts)
@@ -1,3 +1,5 @@
+from functools import cache
+
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.utils.callback_data import CallbackData
 
@@ -5,32 +7,50 @@ from aiogram.utils.callback_data import CallbackData
 class Button:
     rename = 'Изменить имя'
     payments = 'Список сервисов'
+    summary = 'Сводка расходов'
+    upcoming = 'Ближайшие списания'
     broadcast = 'Создать глобальное уведомление'
+    stats = 'Статистика'
     notifications = 'Список уведомлений'
     add_new_payment = 'Добавить'
+    import_payments = 'Импорт'
+    export_payments = 'Экспорт'
     delete_payment = 'Удалить'
     add_notification = 'Добавить уведомление'
     delete_notification = 'Удалить'
     move_back = 'Вернуться'
 
 MainMenuCallback = CallbackData('id', 'action')
-PaymentView = CallbackData('view', 'id')
+PaymentView = CallbackData('view', 'id')  # payment primary key
+PaymentPage = CallbackData('page', 'direction', 'cursor', 'offset')
 PaymentAction = CallbackData('payment', 'action')
 NotificationAction = CallbackData('notification', 'action')
 NotificationDays = CallbackData('notification', 'day')
 
 
+# Keyboards without parameters are built once, so returned markups must not be changed
+
+def get_main_buttons() -> list[InlineKeyboardButton]:
+    return [
+        InlineKeyboardButton(Button.rename, callback_data=MainMenuCallback.new(action='change_name')),
+        InlineKeyboardButton(Button.payments, callback_data=MainMenuCallback.new(action='show_payments')),
+        InlineKeyboardButton(Button.summary, callback_data=MainMenuCallback.new(action='summary')),
+    ]
+
+
+@cache
 def get_main_markup() -> InlineKeyboardMarkup:
     markup = InlineKeyboardMarkup(row_width=2)
-    user_rename = InlineKeyboardButton(Button.rename, callback_data=MainMenuCallback.new(action='change_name'))
-    payments_list = InlineKeyboardButton(Button.payments, callback_data=MainMenuCallback.new(action='show_payments'))
-    markup.add(user_rename, payments_list)
+    markup.add(*get_main_buttons())
     return markup
 
 
+@cache
 def get_admin_markup() -> InlineKeyboardMarkup:
-    markup = get_main_markup()
+    markup = InlineKeyboardMarkup(row_width=2)
+    markup.add(*get_main_buttons())
     markup.add(InlineKeyboardButton(Button.broadcast, callback_data=MainMenuCallback.new(action='broadcast')))
+    markup.add(InlineKeyboardButton(Button.stats, callback_data=MainMenuCallback.new(action='stats')))
     return markup
 
 
@@ -57,22 +77,65 @@ def get_notifications_markup() -> ReplyKeyboardMarkup:
     markup.add(*buttons)
     return markup
 
-def get_services_markup(list_services: list) -> InlineKeyboardMarkup:
+def get_services_markup(payment_ids: list[int], offset: int = 0,
+                        has_previous: bool = False, has_next: bool = False) -> InlineKeyboardMarkup:
     markup = InlineKeyboardMarkup()
     buttons = [
         InlineKeyboardButton(
-            str(i+1),
-            callback_data=PaymentView.new(id=i),
+            str(offset + i + 1),
+            callback_data=PaymentView.new(id=payment_id),
         )
-        for i in range(len(list_services))
+        for i, payment_id in enumerate(payment_ids)
         ]
     markup.add(*buttons)
+    pages = []
+    if has_previous:
+        pages.append(InlineKeyboardButton(
+            '«', callback_data=PaymentPage.new(direction='previous', cursor=payment_ids[0], offset=offset),
+        ))
+    if has_next:
+        pages.append(InlineKeyboardButton(
+            '»', callback_data=PaymentPage.new(
+                direction='next', cursor=payment_ids[-1], offset=offset + len(payment_ids),
+            ),
+        ))
+    if pages:
+        markup.row(*pages)
     add_button = InlineKeyboardButton('Добавить', callback_data=PaymentAction.new(action='add'))
+    import_button = InlineKeyboardButton(Button.import_payments, callback_data=PaymentAction.new(action='import'))
+    export_button = InlineKeyboardButton(Button.export_payments, callback_data=PaymentAction.new(action='export'))
     back_button = InlineKeyboardButton('Вернуться', callback_data=PaymentAction.new(action='back'))
     markup.add(add_button)
+    markup.row(import_button, export_button)
     markup.add(back_button)
     return markup
 
+def get_search_markup(payment_ids: list[int]) -> InlineKeyboardMarkup:
+    markup = InlineKeyboardMarkup()
+    markup.add(*(
+        InlineKeyboardButton(str(i + 1), callback_data=PaymentView.new(id=payment_id))
+        for i, payment_id in enumerate(payment_ids)
+    ))
+    markup.add(InlineKeyboardButton(Button.move_back, callback_data=PaymentAction.new(action='back')))
+    return markup
+
+
+@cache
+def get_summary_markup() -> InlineKeyboardMarkup:
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton(Button.upcoming, callback_data=MainMenuCallback.new(action='upcoming')))
+    markup.add(InlineKeyboardButton(Button.move_back, callback_data=MainMenuCallback.new(action='back')))
+    return markup
+
+
+@cache
+def get_back_markup() -> InlineKeyboardMarkup:
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton(Button.move_back, callback_data=MainMenuCallback.new(action='back')))
+    return markup
+
+
+@cache
 def get_service_markup(has_notifications: bool = True) -> InlineKeyboardMarkup:
     markup = InlineKeyboardMarkup(2)
     buttons = [
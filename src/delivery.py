@@ -0,0 +1,168 @@
+import asyncio
+import random
+from dataclasses import dataclass
+from typing import Optional
+
+from aiogram import types
+from aiogram.utils import exceptions
+
+from utils.settings import (
+    logging, bot, DELIVERY_RATE_LIMIT, DELIVERY_WORKERS, DELIVERY_SPREAD_WINDOW,
+    DELIVERY_MAX_ATTEMPTS, DELIVERY_RETRY_BACKOFF,
+)
+from utils.rate_limit import TokenBucket
+from utils.aio import run_db
+from utils.db import User, DeadLetter, OutboxMessage
+from utils.stats import stats
+from utils import metrics
+from src import profiling
+
+
+logger = logging.getLogger(__name__)
+
+TEMPORARY_ERRORS = (exceptions.NetworkError, asyncio.TimeoutError)
+# the user blocked the bot or was deleted, sending again will not help
+UNREACHABLE_ERRORS = (
+    exceptions.BotBlocked,
+    exceptions.UserDeactivated,
+    exceptions.ChatNotFound,
+    exceptions.CantInitiateConversation,
+)
+
+
+@dataclass
+class Delivery:
+    telegram_id: int
+    text: str
+    reply_markup: Optional[types.InlineKeyboardMarkup] = None
+    attempts: int = 0
+    outbox_id: Optional[int] = None  # marked sent or failed when delivery ends
+
+
+class DeliveryQueue:
+    """Sends messages at a limited rate in the background.
+
+    Messages put together are spread over `spread_window` seconds, so a batch
+    of notifications due at the same minute does not hit flood control.
+    Temporary failures are retried with exponential backoff, messages which
+    still fail are stored as dead letters.
+    """
+
+    def __init__(self, rate: float = DELIVERY_RATE_LIMIT, workers: int = DELIVERY_WORKERS,
+                 spread_window: float = DELIVERY_SPREAD_WINDOW,
+                 max_attempts: int = DELIVERY_MAX_ATTEMPTS, backoff: float = DELIVERY_RETRY_BACKOFF):
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.spread_window = spread_window
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._queue: asyncio.Queue[Delivery] = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+        self._delayed: set[asyncio.TimerHandle] = set()
+
+    def __len__(self) -> int:
+        return self._queue.qsize() + len(self._delayed)
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if len(self):
+            logger.warning(f'Delivery queue stopped with {len(self)} messages not sent')
+
+    def put(self, delivery: Delivery) -> None:
+        delay = random.uniform(0, self.spread_window) if self.spread_window else 0
+        self._put_later(delivery, delay)
+
+    def _put_later(self, delivery: Delivery, delay: float) -> None:
+        if not delay:
+            self._queue.put_nowait(delivery)
+            return
+
+        def put() -> None:
+            self._delayed.discard(handle)
+            self._queue.put_nowait(delivery)
+
+        handle = asyncio.get_running_loop().call_later(delay, put)
+        self._delayed.add(handle)
+
+    async def join(self) -> None:
+        """Wait until every message put so far, including delayed ones, is processed."""
+        await self._queue.join()
+        while self._delayed:
+            await asyncio.sleep(0.1)
+            await self._queue.join()
+
+    async def _work(self) -> None:
+        while True:
+            delivery = await self._queue.get()
+            try:
+                await self.deliver(delivery)
+            except Exception as exc:
+                logger.exception(f'Delivery to user {delivery.telegram_id} crashed: {exc}')
+                await self._release(delivery, exc)
+            finally:
+                self._queue.task_done()
+
+    async def _release(self, delivery: Delivery, error: Exception) -> None:
+        """Retry a crashed delivery, so its outbox row is not left pending until a restart."""
+        try:
+            await self.retry(delivery, error, delay=self.backoff * 2 ** max(0, delivery.attempts - 1))
+        except Exception as exc:
+            logger.exception(f'Cannot release delivery to user {delivery.telegram_id}: {exc}')
+
+    async def deliver(self, delivery: Delivery) -> None:
+        if profiling.current_session is not None:
+            profiling.current_session.notifications += 1
+        await self.bucket.acquire()
+        delivery.attempts += 1
+        try:
+            await bot.send_message(delivery.telegram_id, delivery.text, reply_markup=delivery.reply_markup)
+        except exceptions.RetryAfter as exc:
+            logger.warning(f'Flood control on delivery, sleep {exc.timeout} sec')
+            self.bucket.pause(exc.timeout)
+            await self.retry(delivery, exc, delay=0)
+        except TEMPORARY_ERRORS as exc:
+            await self.retry(delivery, exc, delay=self.backoff * 2 ** (delivery.attempts - 1))
+        except UNREACHABLE_ERRORS as exc:
+            await User.aset_reachable(delivery.telegram_id, False)
+            await self.dead_letter(delivery, exc)
+        except exceptions.TelegramAPIError as exc:
+            await self.dead_letter(delivery, exc)
+        else:
+            metrics.notification_count.inc(status='sent')
+            stats.inc('notifications_sent')
+            if delivery.outbox_id:
+                await run_db(OutboxMessage.set_status, delivery.outbox_id, OutboxMessage.SENT)
+
+    async def retry(self, delivery: Delivery, error: Exception, delay: float) -> None:
+        if delivery.attempts >= self.max_attempts:
+            await self.dead_letter(delivery, error)
+            return
+        metrics.notification_count.inc(status='retried')
+        self._put_later(delivery, delay)
+
+    async def dead_letter(self, delivery: Delivery, error: Exception) -> None:
+        metrics.notification_count.inc(status='failed')
+        stats.inc('notifications_failed')
+        logger.warning(
+            f'Cannot deliver message to user {delivery.telegram_id} '
+            f'after {delivery.attempts} attempts: {error}'
+        )
+        await run_db(
+            DeadLetter.create,
+            telegram_id=delivery.telegram_id,
+            text=delivery.text,
+            error=f'{type(error).__name__}: {error}'[:255],
+            attempts=delivery.attempts,
+        )
+        if delivery.outbox_id:
+            await run_db(OutboxMessage.set_status, delivery.outbox_id, OutboxMessage.FAILED)
+
+
+delivery_queue = DeliveryQueue()
@@ -1,157 +1,366 @@
-import time
+import asyncio
+import io
+from typing import Optional
 from datetime import datetime
-from contextlib import suppress
 
 from aiogram import executor, types
 from aiogram.dispatcher import FSMContext
-from aiogram.dispatcher.filters import Text, IsReplyFilter, Regexp, ContentTypeFilter
-from aiogram.utils import exceptions
-from aiogram.utils.callback_data import CallbackData, CallbackDataFilter
 
-from utils.settings import logging, bot, dp, PAYMENTS, get_day_word
+from utils.settings import (
+    logging, bot, dp, get_day_word, NOTIFICATION_MODE, IMPORT_MAX_FILE_SIZE,
+    UPCOMING_CHARGES_DAYS, UPCOMING_CHARGES_LIMIT, PROFILE_MAX_UPDATES, PROFILE_MAX_SECONDS,
+)
 from src.states import MainStates, NotificationStates, PaymentStates
 from src.buttons import (
-    get_main_markup, get_admin_markup, get_payments_markup,
-    get_notifications_markup, Button,
-    get_services_markup, get_service_markup,
+    get_main_markup, get_admin_markup,
+    get_services_markup, get_service_markup, get_back_markup, get_summary_markup, get_search_markup,
     get_notification_days_add, get_notification_days_delete,
-    PaymentView, PaymentAction, MainMenuCallback, NotificationAction, NotificationDays
+    PaymentView, PaymentPage, PaymentAction, MainMenuCallback, NotificationAction, NotificationDays
     )
-from utils.db import User, Payment, Notification
+from utils.db import User, Payment, Notification, OutboxMessage
+from utils.cache import get_views
+from utils.stats import stats, get_active_users_key
+from utils.dates import (
+    get_local_now, WEEKLY, MONTHLY, QUARTERLY, PERIODS_PER_MONTH,
+)
+from utils.aio import run_db
+from src.payments_csv import parse_payments, parse_period, export_payments
+from utils import metrics
+from src.broadcast import start_broadcast
+from src.scheduler import scheduler
+from src.profiling import start_profiling
+from src import middlewares
+from src.webhook import answer_callback
 
 
 logger = logging.getLogger(__name__)
+middlewares.setup(dp)
 
+# list pages are (direction, cursor payment id, offset of the first payment on the page)
+FIRST_PAGE = ('next', 0, 0)
 
-def run_bot():
-    executor.start_polling(dp, skip_updates=True)
+
+def run_bot(on_startup=None, on_shutdown=None):
+    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
 
 
 @dp.message_handler(commands='start')
-async def start(message: types.Message):
-    User.create_or_update(message.from_user.id, message.from_user.username)
+async def start(message: types.Message, user: User):
+    if user is None:
+        await User.acreate_or_update(message.from_user.id, message.from_user.username)
     logger.debug(f'User "{message.chat.id}" choose /start command')
-    await start_page(message)
+    await start_page(message, user)
 
 
-async def start_page(message: types.Message):
-    user: User = User.get(telegram_id=message.from_user.id)
+async def start_page(message: types.Message, user: User):
     await main_menu(user, message)
-    del user
 
 @dp.callback_query_handler(PaymentAction.filter(action=['back']), state=PaymentStates.list)
-async def move_back_from_list(call: types.CallbackQuery, state: FSMContext):
-    user: User = User.get(telegram_id=call.from_user.id)
-    await main_menu(user, call.message)
-    await call.message.delete()
+async def move_back_from_list(call: types.CallbackQuery, state: FSMContext, user: User):
     await state.finish()
+    return await edit_main_menu(call, user)
+
 
-async def main_menu(user: User, message: types.Message):
+def get_main_menu(user: User) -> tuple[str, types.InlineKeyboardMarkup]:
     if user and user.is_admin:
-        await message.answer(
-            'Чего изволите, мой господин?',
-            reply_markup=get_admin_markup()
-            )
-    else:
-        await message.answer(
-            'Чего изволите?',
-            reply_markup=get_main_markup()
-        )
+        return 'Чего изволите, мой господин?', get_admin_markup()
+    return 'Чего изволите?', get_main_markup()
 
 
-@dp.callback_query_handler(MainMenuCallback.filter(action=['broadcast']))
-async def pre_broadcast(call: types.CallbackQuery, state: FSMContext, callback_data: dict):
-    await call.message.edit_text(
-        'Напиши, что хочешь сообщить всем пользователям.',
+async def main_menu(user: User, message: types.Message, prefix: Optional[str] = None):
+    bot_text, markup = get_main_menu(user)
+    if prefix:
+        bot_text = f'{prefix}\n{bot_text}'
+    await message.answer(
+        bot_text,
+        reply_markup=markup,
+    )
+
+
+async def edit_main_menu(call: types.CallbackQuery, user: User):
+    """Show the main menu in place of the current message instead of sending a new one."""
+    bot_text, markup = get_main_menu(user)
+    return await edit_and_answer(call, bot_text, markup)
+
+
+async def edit_and_answer(call: types.CallbackQuery, text: str,
+                          markup: Optional[types.InlineKeyboardMarkup] = None,
+                          answer_text: Optional[str] = None):
+    """Edit the message and answer the callback concurrently, neither waits for the other."""
+    _, answer = await asyncio.gather(
+        call.message.edit_text(text, reply_markup=markup),
+        answer_callback(call, answer_text),
     )
+    return answer
+
+
+@dp.callback_query_handler(MainMenuCallback.filter(action=['broadcast']))
+async def pre_broadcast(call: types.CallbackQuery, state: FSMContext, callback_data: dict, user: User):
     await state.set_state(MainStates.broadcast)
-    user: User = User.get(telegram_id=call.from_user.id)
     logger.debug(f'User-{user.id} wants to broadcast')
-    del user
+    return await edit_and_answer(call, 'Напиши, что хочешь сообщить всем пользователям.')
 
 
 @dp.message_handler(state=MainStates.broadcast)
-async def broadcast(message: types.Message, state: FSMContext):
-    users: list[User] = User.select()
-    for user in users:
-        with suppress(exceptions.UserDeactivated):
-            await bot.send_message(
-                user.telegram_id,
-                message.text,
-            )
+async def broadcast(message: types.Message, state: FSMContext, user: User):
     await state.finish()
-    del users
-    user: User = User.get(telegram_id=message.from_user.id)
     logger.debug(f'User-{user.id} sends message by broadcast')
+    status: types.Message = await message.answer('Рассылка запущена...')
+    await start_broadcast(message.text, status)
     await main_menu(user, message)
-    del user
+
+
+@dp.callback_query_handler(MainMenuCallback.filter(action=['stats']))
+async def show_stats(call: types.CallbackQuery, state: FSMContext, user: User):
+    if user is None or not user.is_admin:
+        return await answer_callback(call)
+    logger.debug(f'User-{user.id} requests stats')
+    today = get_local_now().date()
+    bot_text = [
+        f'Пользователей: {stats.get("users")}',
+        f'Активных сегодня: {stats.get(get_active_users_key(today))}',
+        f'Сервисов: {stats.get("payments")}',
+        f'Уведомлений: {stats.get("notifications")}',
+        f'Уведомлений отправлено: {stats.get("notifications_sent")}',
+        f'Не удалось отправить: {stats.get("notifications_failed")}',
+    ]
+    if NOTIFICATION_MODE == 'cron':
+        bot_text.append(f'Задач в планировщике: {len(scheduler.get_jobs())}')
+    else:  # notifications are not scheduler jobs, the sweeper writes them to the outbox
+        bot_text.append(f'Ожидают отправки: {await run_db(OutboxMessage.count_pending)}')
+    await state.set_state(MainStates.stats)
+    return await edit_and_answer(call, '\n'.join(bot_text), get_back_markup())
+
+
+@dp.message_handler(commands='metrics')
+async def send_metrics(message: types.Message, state: FSMContext, user: User):
+    if user is None or not user.is_admin:
+        return await cannot_parse(message, state)
+    logger.debug(f'User-{user.id} requests metrics')
+    document = types.InputFile(io.BytesIO(metrics.render().encode()), filename='metrics.txt')
+    await message.answer_document(document)
+
+
+@dp.message_handler(commands='profile')
+async def profile(message: types.Message, state: FSMContext, user: User):
+    """`/profile [updates] [seconds]`, the report comes as a document when either limit is reached."""
+    if user is None or not user.is_admin:
+        return await cannot_parse(message, state)
+    try:
+        limits = [int(arg) for arg in message.get_args().split()]
+        max_updates = limits[0] if len(limits) > 0 else PROFILE_MAX_UPDATES
+        max_seconds = limits[1] if len(limits) > 1 else PROFILE_MAX_SECONDS
+        if max_updates <= 0 or max_seconds <= 0:
+            raise ValueError
+    except ValueError:
+        await message.answer('Формат: /profile [число обновлений] [секунды]')
+        return
+    if not start_profiling(message.chat.id, max_updates, max_seconds):
+        await message.answer('Профилирование уже идёт')
+        return
+    logger.debug(f'User-{user.id} starts profiling')
+    await message.answer(
+        f'Профилирование запущено на {max_updates} обновлений или {max_seconds} сек., '
+        'отчёт придёт файлом'
+    )
+
+
+@dp.message_handler(commands='search', state='*')
+async def search_payments(message: types.Message, state: FSMContext, user: User):
+    """`/search words`, payments with words starting with these in the name or description."""
+    if user is None:
+        return await cannot_parse(message, state)
+    text = message.get_args()
+    if not text.strip():
+        await message.answer('Формат: /search слова из названия или описания')
+        return
+    payments = await user.asearch_payments(text)
+    logger.debug(f'User-{user.id} searched payments, {len(payments)} found')
+    if not payments:
+        await message.answer('Ничего не найдено')
+        return
+    bot_text = ['Найденные сервисы:']
+    bot_text.extend(
+        f'{number}.\t{payment.name}: {payment.description}, {get_schedule_text(payment)}'
+        for number, payment in enumerate(payments, start=1)
+    )
+    await state.set_state(PaymentStates.list)
+    await state.update_data(page=FIRST_PAGE)
+    await message.answer('\n'.join(bot_text), reply_markup=get_search_markup([payment.id for payment in payments]))
 
 
 @dp.callback_query_handler(MainMenuCallback.filter(action=['change_name']))
-async def pre_change_name(call: types.CallbackQuery, state: FSMContext):
-    user: User = User.get(telegram_id=call.from_user.id)
+async def pre_change_name(call: types.CallbackQuery, state: FSMContext, user: User):
     logger.debug(f'User "{user.id}" wants change username')
-    await call.message.edit_text(
-        'Ну-ка, и как ты хочешь называться теперь?',
-    )
     await state.set_state(MainStates.change_name)
+    return await edit_and_answer(call, 'Ну-ка, и как ты хочешь называться теперь?')
 
 
 @dp.message_handler(state=MainStates.change_name)
-async def change_name(message: types.Message, state: FSMContext):
-    user: User = User.get(telegram_id=message.from_user.id)
-    user.change_username(message.text)
+async def change_name(message: types.Message, state: FSMContext, user: User):
+    await user.achange_username(message.text)
     logger.debug(f'User "{user.id}" change username to "{message.text}"')
-    await bot.send_message(
-        message.chat.id,
-        f'Отлично, буду звать тебя "{user.username}"!'
-    )
     await state.finish()
-    await main_menu(user, message)
-    del user
+    await main_menu(user, message, prefix=f'Отлично, буду звать тебя "{user.username}"!')
+
+
+@dp.callback_query_handler(MainMenuCallback.filter(action=['summary']))
+async def show_summary(call: types.CallbackQuery, state: FSMContext, user: User):
+    logger.debug(f'User "{user.id}" select spending summary')
+    bot_text = await get_summary_text(user)
+    await state.set_state(MainStates.summary)
+    return await edit_and_answer(call, bot_text, get_summary_markup())
+
+
+async def get_summary_text(user: User) -> str:
+    today = get_local_now().date()
+    views = get_views(user.telegram_id)
+    if (view := views.get('summary')) is not None and view[0] == today:
+        return view[1]
+    periods, top_payments = await user.aget_summary()
+    if not periods:
+        return 'Твой список платежей пуст'
+    monthly = sum(row.total * PERIODS_PER_MONTH[row.period] for row in periods)
+    bot_text = [
+        f'Расходы в месяц: {monthly:.2f}',
+        f'Расходы в год: {monthly * 12:.2f}',
+        '',
+        'Самые дорогие сервисы:',
+    ]
+    bot_text.extend(
+        f'{count}.\t{payment.name}: {payment.price}'
+        for count, payment in enumerate(top_payments, start=1)
+    )
+    bot_text = '\n'.join(bot_text)
+    views['summary'] = today, bot_text
+    return bot_text
+
+
+@dp.callback_query_handler(MainMenuCallback.filter(action=['upcoming']), state=MainStates.summary)
+async def show_upcoming_charges(call: types.CallbackQuery, user: User):
+    bot_text = await get_upcoming_charges_text(user)
+    return await edit_and_answer(call, bot_text, get_back_markup())
+
+
+async def get_upcoming_charges_text(user: User, days: int = UPCOMING_CHARGES_DAYS) -> str:
+    today = get_local_now().date()
+    views = get_views(user.telegram_id)
+    if (view := views.get('upcoming')) is not None and view[0] == today:
+        return view[1]
+    charges, count, total = await user.aget_upcoming_charges(today, days, UPCOMING_CHARGES_LIMIT)
+    if not charges:
+        bot_text = f'В ближайшие {days} дней списаний нет'
+    else:
+        bot_text = [f'Ближайшие списания за {days} дней, всего {total:.2f}:']
+        bot_text.extend(
+            f'\t{day:%d.%m}: {payment.name}, {payment.price}'
+            for day, payment in charges
+        )
+        if count > len(charges):
+            bot_text.append(f'И ещё {count - len(charges)}')
+        bot_text = '\n'.join(bot_text)
+    views['upcoming'] = today, bot_text
+    return bot_text
+
+
+def get_schedule_text(payment: Payment) -> str:
+    if payment.period == WEEKLY:
+        return f'каждую неделю с {payment.date:%d.%m.%Y}'
+    if payment.period == MONTHLY:
+        return f'{payment.date.day} числа'
+    if payment.period == QUARTERLY:
+        return f'раз в квартал с {payment.date:%d.%m.%Y}'
+    return f'раз в год, {payment.date:%d.%m}'
 
 
 @dp.callback_query_handler(MainMenuCallback.filter(action=['show_payments']))
 @dp.callback_query_handler(PaymentAction.filter(action=['back']))
-async def payments_list(call: types.CallbackQuery, state: FSMContext):
-    user: User = User.get(telegram_id=call.from_user.id)
+async def payments_list(call: types.CallbackQuery, state: FSMContext, user: User,
+                        page: Optional[tuple] = None, answer_text: Optional[str] = None):
     logger.debug(f'User "{user.username}" select payments list')
-    payments = [
-        f'{count + 1}.\t{payment.description}, {payment.date.day} числа'
-        for count, payment in enumerate(user.get_payment_list())
+    page = tuple(page or FIRST_PAGE)
+    bot_text, markup = await get_payments_list_view(user, page)
+    await state.set_state(PaymentStates.list)
+    await state.update_data(page=page)
+    return await edit_and_answer(call, bot_text, markup, answer_text)
+
+
+@dp.callback_query_handler(PaymentPage.filter(), state=PaymentStates.list)
+async def payments_page(call: types.CallbackQuery, state: FSMContext, callback_data: dict, user: User):
+    page = (callback_data['direction'], int(callback_data['cursor']), int(callback_data['offset']))
+    return await payments_list(call, state, user, page)
+
+
+async def get_payments_list_view(user: User, page: tuple) -> tuple[str, types.InlineKeyboardMarkup]:
+    pages = get_views(user.telegram_id).setdefault('list', {})
+    if (view := pages.get(page)) is not None:
+        return view
+    direction, cursor, offset = page
+    forward = direction == 'next'
+    payments, has_more = await user.aget_payment_page(cursor, forward)
+    if not payments and cursor:
+        # every payment of the page was deleted
+        return await get_payments_list_view(user, FIRST_PAGE)
+    if not forward:
+        offset = max(offset - len(payments), 0)
+    lines = [
+        f'{offset + count + 1}.\t{payment.description}, {get_schedule_text(payment)}'
+        for count, payment in enumerate(payments)
     ]
-    if payments:
-        bot_text = '\n'.join(['Твой список платежей:'] + payments)
+    if lines:
+        bot_text = '\n'.join(['Твой список платежей:'] + lines)
     else:
         bot_text = 'Твой список платежей пуст'
-    await call.message.edit_text(
-        bot_text,
-        reply_markup=get_services_markup(payments),
+    markup = get_services_markup(
+        [payment.id for payment in payments],
+        offset=offset,
+        has_previous=has_more if not forward else offset > 0,
+        has_next=has_more if forward else True,
     )
-    await state.set_state(PaymentStates.list)
-    del payments, bot_text, user
+    view = pages[page] = bot_text, markup
+    return view
+
+
+async def get_selected_payment(state: FSMContext, user: User) -> Optional[Payment]:
+    user_data = await state.get_data()
+    return await user.aget_payment(user_data.get('payment_id'))
+
+
+async def payment_not_found(call: types.CallbackQuery, state: FSMContext, user: User):
+    """The payment was deleted meanwhile, e.g. from another chat window."""
+    user_data = await state.get_data()
+    return await payments_list(call, state, user, user_data.get('page'), 'Ошибка! Такого сервиса нет')
 
 
 @dp.callback_query_handler(PaymentView.filter(), state=PaymentStates.list)
-async def move_back_from_list(call: types.CallbackQuery, state: FSMContext, callback_data: dict):
-    payment_ordered_number = int(callback_data.get('id'))
-    user: User = User.get(telegram_id=call.from_user.id)
-    payment: Payment = user.get_payment_list()[payment_ordered_number]
-    await call.message.edit_text(
-        get_payment_message(payment),
-        reply_markup=get_service_markup(has_notifications=any(payment.get_notification_list()))
-    )
+async def show_payment(call: types.CallbackQuery, state: FSMContext, callback_data: dict, user: User):
+    payment_id = int(callback_data.get('id'))
+    view = get_views(user.telegram_id).get(Payment.get_view_key(payment_id))
+    if view is None:
+        if (payment := await user.aget_payment(payment_id)) is None:
+            return await payment_not_found(call, state, user)
+        view = get_payment_view(payment)
+    bot_text, markup = view
     await state.set_state(PaymentStates.select)
-    await state.update_data(payment_ordered_number=payment_ordered_number)
-    del payment
+    await state.update_data(payment_id=payment_id)
+    return await edit_and_answer(call, bot_text, markup)
+
+def get_payment_view(payment: Payment) -> tuple[str, types.InlineKeyboardMarkup]:
+    views = get_views(payment.user.telegram_id)
+    key = payment.get_view_key(payment.id)
+    if (view := views.get(key)) is None:
+        markup = get_service_markup(has_notifications=any(payment.notifications))
+        view = views[key] = get_payment_message(payment), markup
+    return view
+
 
 def get_payment_message(payment: Payment):
     bot_text = [
         f'Информация о сервисе: {payment.name}',
         f'Цена: {payment.price}',
-        f'{payment.date.day} числа'
+        get_schedule_text(payment).capitalize(),
         ]
-    notifications: list[Notification] = payment.get_notification_list()
+    notifications: list[Notification] = payment.notifications
     if notifications:
         notifications_message = [
             f'\t{n.day_before_payment} {get_day_word(n.day_before_payment)}'
@@ -163,162 +372,190 @@ def get_payment_message(payment: Payment):
 
 
 @dp.callback_query_handler(MainMenuCallback.filter(action=['back']), state=PaymentStates.list)
-async def back_to_main_menu(call: types.CallbackQuery, state: FSMContext):
-    user: User = User.get(telegram_id=call.from_user.id)
+@dp.callback_query_handler(MainMenuCallback.filter(action=['back']), state=MainStates.summary)
+@dp.callback_query_handler(MainMenuCallback.filter(action=['back']), state=MainStates.stats)
+async def back_to_main_menu(call: types.CallbackQuery, state: FSMContext, user: User):
     await state.finish()
-    await call.message.delete()
-    await main_menu(user, call.message)
+    return await edit_main_menu(call, user)
 
 
 @dp.callback_query_handler(PaymentAction.filter(action=['add']), state=PaymentStates.list)
 async def pre_payment_add(call: types.CallbackQuery, state: FSMContext):
     bot_text = [
         'Добавьте платёж в следующем формате:',
-        'Название,Описание,Цена,год-месяц-день',
+        'Название,Описание,Цена,год-месяц-день[,период]',
+        'Период: неделя, месяц (по умолчанию), квартал или год',
         '',
         'Примеры:',
         'Мобильный интернет,Оплата за мобильный интернет,450.35,2020-01-07',
         'Я.Плюс,Оплата за подписку Яндекс.Плюс,300,2020-01-07',
+        'Домен,Продление домена,900,2020-03-15,год',
     ]
-    await call.message.edit_text(
-        '\n'.join(bot_text),
-    )
     await state.set_state(PaymentStates.add)
+    return await edit_and_answer(call, '\n'.join(bot_text))
 
 
 @dp.message_handler(state=PaymentStates.add)
-async def payment_add(message: types.Message, state: FSMContext):
-    user: User = User.get(telegram_id=message.from_user.id)
+async def payment_add(message: types.Message, state: FSMContext, user: User):
     try:
-        name, description, price, date_payment = message.text.replace(', ', ',').split(',')
+        name, description, price, date_payment, *period = message.text.replace(', ', ',').split(',')
+        if len(period) > 1:
+            raise ValueError('Too many fields')
+        period = parse_period(period[0] if period else '')
         date_payment = datetime.strptime(date_payment, '%Y-%m-%d')
         price = float(price)
-        payment: Payment = user.add_payment(name, description, price, date_payment)
+        payment: Payment = await user.aadd_payment(name, description, price, date_payment, period)
         logger.debug(f'Add payment "{name}" for user {user.id}')
 
         bot_message = f'Новый сервис "{payment.name}" добавлен!'
+        bot_text, markup = get_payment_view(payment)
         await message.answer(
-            f'{bot_message}\n{get_payment_message(payment)}',
-            reply_markup=get_service_markup(has_notifications=any(payment.get_notification_list())),
+            f'{bot_message}\n{bot_text}',
+            reply_markup=markup,
         )
         await state.set_state(PaymentStates.select)
-        del name, description, price, date_payment, user, payment
-    except (ValueError, TypeError) as exc:
+        await state.update_data(payment_id=payment.id)
+        del name, description, price, date_payment, period, payment
+    except (ValueError, TypeError):
         logger.error(f'Cannot parse "{message.text}"')
         bot_message = 'Что-то пошло не так. Попробуйте ещё раз.'
-        await message.answer(
-            bot_message,
-        )
         await state.finish()
-        await main_menu(user, message)
+        await main_menu(user, message, prefix=bot_message)
     del bot_message
 
 
+@dp.callback_query_handler(PaymentAction.filter(action=['import']), state=PaymentStates.list)
+async def pre_payment_import(call: types.CallbackQuery, state: FSMContext):
+    bot_text = [
+        'Отправьте список платежей, по одному на строку, или CSV файл:',
+        'Название,Описание,Цена,год-месяц-день,дни уведомлений через ;,период',
+        '',
+        'Пример:',
+        'Мобильный интернет,Оплата за мобильный интернет,450.35,2020-01-07,1;3',
+        'Я.Плюс,Оплата за подписку Яндекс.Плюс,300,2020-01-07',
+    ]
+    await state.set_state(PaymentStates.bulk_add)
+    return await edit_and_answer(call, '\n'.join(bot_text))
+
+
+@dp.message_handler(state=PaymentStates.bulk_add, content_types=[types.ContentType.TEXT, types.ContentType.DOCUMENT])
+async def payment_import(message: types.Message, state: FSMContext, user: User):
+    if message.document:
+        if message.document.file_size > IMPORT_MAX_FILE_SIZE:
+            await message.answer(f'Файл слишком большой, максимум {IMPORT_MAX_FILE_SIZE // 1024} КБ')
+            return
+        content = await message.document.download(destination_file=io.BytesIO())
+        text = content.getvalue().decode('utf-8-sig', errors='replace')
+    else:
+        text = message.text
+    rows, errors = parse_payments(text.splitlines())
+    added, existing = await user.aimport_payments(rows)
+    logger.debug(f'User {user.id} imported {added} payments')
+    bot_text = [f'Добавлено сервисов: {added}']
+    if existing:
+        bot_text.append(f'Уже есть: {", ".join(existing)}')
+    bot_text.extend(errors[:10])
+    if len(errors) > 10:
+        bot_text.append(f'И ещё ошибок: {len(errors) - 10}')
+    list_text, markup = await get_payments_list_view(user, FIRST_PAGE)
+    bot_text.append('')
+    bot_text.append(list_text)
+    await message.answer('\n'.join(bot_text), reply_markup=markup)
+    await state.set_state(PaymentStates.list)
+    await state.update_data(page=FIRST_PAGE)
+
+
+@dp.callback_query_handler(PaymentAction.filter(action=['export']), state=PaymentStates.list)
+async def payment_export(call: types.CallbackQuery, user: User):
+    file = await run_db(export_payments, user)
+    try:
+        await call.message.answer_document(types.InputFile(file, filename='payments.csv'))
+    finally:
+        file.close()
+    return await answer_callback(call)
+
+
 @dp.callback_query_handler(PaymentAction.filter(action=['delete']), state=PaymentStates.select)
-async def delete_payment(call: types.CallbackQuery, state: FSMContext):
+async def delete_payment(call: types.CallbackQuery, state: FSMContext, user: User):
     bot_text = list()
     user_data = await state.get_data()
-    payment_ordered_number = user_data['payment_ordered_number']
-    try:
-        user: User = User.get(telegram_id=call.from_user.id)
-        payment: Payment = user.get_payment_list()[payment_ordered_number]
-        delete_result = bool(payment.delete_instance(True))
-        if delete_result:
-            bot_text.append('Удалено выполнено')
-        else:
-            bot_text.append('Удалено прервано')
-    except ValueError:
-        bot_text.append('Ошибка! Некорректный номер сервиса')
-    except IndexError:
-        bot_text.append('Ошибка! Такого номера сервиса нет')
-    await call.answer('\n'.join(bot_text))
-
-    await state.set_state(PaymentStates.list)
+    payment = await user.aget_payment(user_data.get('payment_id'))
+    if payment is None:
+        bot_text.append('Ошибка! Такого сервиса нет')
+    elif await payment.adelete_instance(True):
+        bot_text.append('Удалено выполнено')
+    else:
+        bot_text.append('Удалено прервано')
     await state.reset_data()
-    await payments_list(call, state)
-    del bot_text, user_data, payment_ordered_number
-    del user, payment, delete_result
+    page = user_data.get('page')
+    del user_data, payment
+    return await payments_list(call, state, user, page, '\n'.join(bot_text))
 
 
 @dp.callback_query_handler(PaymentAction.filter(action=['back']), state=PaymentStates.select)
-async def back_to_payment_list(call: types.CallbackQuery, state: FSMContext):
-    await payments_list(call, state)
+async def back_to_payment_list(call: types.CallbackQuery, state: FSMContext, user: User):
+    user_data = await state.get_data()
+    return await payments_list(call, state, user, user_data.get('page'))
 
 
 
 @dp.callback_query_handler(NotificationAction.filter(action=['add']), state=PaymentStates.select)
-async def pre_notification_add(сall: types.CallbackQuery, state: FSMContext, callback_data: dict):
-    user: User = User.get(telegram_id=сall.from_user.id)
-    user_data = await state.get_data()
-    payment_ordered_number = user_data.get('payment_ordered_number')
-    payment: Payment = user.get_payment_list()[payment_ordered_number]
-    notif_days: list[int] = [d.day_before_payment for d in payment.get_notification_list()]
-
-    await сall.message.edit_text(
-        'За сколько дней нужно уведомить тебя об оплате?',
-        reply_markup=get_notification_days_add(exclude_days=notif_days),
-    )
+async def pre_notification_add(call: types.CallbackQuery, state: FSMContext, callback_data: dict, user: User):
+    if (payment := await get_selected_payment(state, user)) is None:
+        return await payment_not_found(call, state, user)
+    notif_days: list[int] = [d.day_before_payment for d in payment.notifications]
     await state.set_state(NotificationStates.add)
+    return await edit_and_answer(
+        call, 'За сколько дней нужно уведомить тебя об оплате?', get_notification_days_add(exclude_days=notif_days),
+    )
 
 
 @dp.callback_query_handler(NotificationDays.filter(), state=NotificationStates.add)
-async def notification_add(call: types.CallbackQuery, state: FSMContext, callback_data: dict):
-    await call.message.edit_text('Добавление...')
-    user_data = await state.get_data()
-    payment_ordered_number = user_data.get('payment_ordered_number')
-    user: User = User.get(telegram_id=call.from_user.id)
-    payment: Payment = user.get_payment_list()[payment_ordered_number]
+async def notification_add(call: types.CallbackQuery, state: FSMContext, callback_data: dict, user: User):
+    if (payment := await get_selected_payment(state, user)) is None:
+        return await payment_not_found(call, state, user)
     day_before_notification = int(callback_data.get('day'))
     try:
-        payment.add_notification(day_before_notification)
+        await payment.aadd_notification(day_before_notification)
         bot_message = 'Уведомление добавлено!'
     except (TypeError, IndexError, TypeError):
         bot_message = 'Ошибка добавления уведомления, попробуйте ещё раз'
-    await call.message.edit_text(
-        f'{bot_message}\n{get_payment_message(payment)}',
-        reply_markup=get_service_markup(has_notifications=any(payment.get_notification_list()))
-    )
+    bot_text, markup = get_payment_view(payment)
     await state.set_state(PaymentStates.select)
     del payment
+    return await edit_and_answer(call, f'{bot_message}\n{bot_text}', markup)
 
 
 @dp.callback_query_handler(NotificationAction.filter(action=['delete']), state=PaymentStates.select)
-async def pre_notification_delete(call: types.CallbackQuery, state: FSMContext, callback_data: dict):
-    user: User = User.get(telegram_id=call.from_user.id)
-    user_data = await state.get_data()
-    payment_ordered_number = user_data.get('payment_ordered_number')
-    payment: Payment = user.get_payment_list()[payment_ordered_number]
-    notification_days = [day.day_before_payment for day in payment.get_notification_list()]
-    await call.message.edit_text(
-        'Уведомление за сколько дней до события ты хочешь удалить?',
-        reply_markup=get_notification_days_delete(notification_days),
-    )
+async def pre_notification_delete(call: types.CallbackQuery, state: FSMContext, callback_data: dict, user: User):
+    if (payment := await get_selected_payment(state, user)) is None:
+        return await payment_not_found(call, state, user)
+    notification_days = [day.day_before_payment for day in payment.notifications]
     await state.set_state(NotificationStates.delete)
     del payment
+    return await edit_and_answer(
+        call, 'Уведомление за сколько дней до события ты хочешь удалить?',
+        get_notification_days_delete(notification_days),
+    )
 
 
 @dp.callback_query_handler(NotificationDays.filter(), state=NotificationStates.delete)
-async def notification_delete(call: types.CallbackQuery, state: FSMContext, callback_data: dict):
-    await call.message.edit_text('Удаление...')
-    user_data = await state.get_data()
-    payment_ordered_number = user_data.get('payment_ordered_number')
-    user: User = User.get(telegram_id=call.from_user.id)
-    payment: Payment = user.get_payment_list()[payment_ordered_number]
+async def notification_delete(call: types.CallbackQuery, state: FSMContext, callback_data: dict, user: User):
+    if (payment := await get_selected_payment(state, user)) is None:
+        return await payment_not_found(call, state, user)
     notification_day = int(callback_data.get('day'))
     try:
-        assert payment.delete_notification(notification_day)
+        assert await payment.adelete_notification(notification_day)
         bot_message = 'Уведомление удалено!'
     except (TypeError, IndexError, TypeError, AssertionError):
         bot_message = 'Ошибка удаления уведомления, попробуйте ещё раз'
     except Exception as e:
         bot_message = 'Ошибка удаления уведомления, попробуйте ещё раз'
         logger.error(e, stack_info=True)
-    await call.message.edit_text(
-        f'{bot_message}\n{get_payment_message(payment)}',
-        reply_markup=get_service_markup(has_notifications=any(payment.get_notification_list()))
-    )
+    bot_text, markup = get_payment_view(payment)
     await state.set_state(PaymentStates.select)
     del payment
+    return await edit_and_answer(call, f'{bot_message}\n{bot_text}', markup)
 
 
 @dp.message_handler()
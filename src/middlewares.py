@@ -0,0 +1,193 @@
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from aiogram import types
+from aiogram.dispatcher.handler import current_handler, CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from utils.settings import (
+    logging, QUERIES_PER_UPDATE_LIMIT, THROTTLE_RATE_LIMIT, THROTTLE_WINDOW, THROTTLE_MAX_USERS,
+    COALESCE_TIMEOUT,
+)
+from utils.cache import TTLCache
+from utils.queries import QueryCounter, current_counter
+from utils.db import User, aload_user
+from utils.stats import stats
+from utils import metrics
+from src import profiling
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCounterMiddleware(BaseMiddleware):
+    """Counts database queries made while a single update is processed.
+
+    Counts are also added to an enclosing counter, if there is one,
+    so `count_queries()` around the dispatcher sees them.
+    """
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        data['query_counter_token'] = current_counter.set(QueryCounter())
+
+    async def on_post_process_update(self, update: types.Update, results: list, data: dict):
+        counter: QueryCounter = current_counter.get()
+        token = data.pop('query_counter_token')
+        current_counter.reset(token)
+        if isinstance(token.old_value, QueryCounter):
+            token.old_value.count += counter.count
+        metrics.update_queries.observe(counter.count)
+        if counter.count > QUERIES_PER_UPDATE_LIMIT:
+            logger.warning(f'Update {update.update_id} made {counter.count} queries')
+        else:
+            logger.debug(f'Update {update.update_id} made {counter.count} queries')
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Drops updates of users who send too many, and duplicate taps on the same button.
+
+    A callback query with the same data for the same message as one still being
+    handled is only answered, so repeated taps do not repeat its queries and edits.
+    Runs before the user is loaded, dropped updates make no queries.
+    """
+
+    def __init__(self, rate_limit: int = THROTTLE_RATE_LIMIT, window: float = THROTTLE_WINDOW,
+                 coalesce_timeout: float = COALESCE_TIMEOUT):
+        super().__init__()
+        self.rate_limit = rate_limit
+        self.window = window
+        self.coalesce_timeout = coalesce_timeout
+        # telegram id -> [window start, updates in the window], entry expires with its window
+        self._windows = TTLCache(maxsize=THROTTLE_MAX_USERS, ttl=window)
+        # (telegram id, message id, callback data) -> handling start
+        self._in_flight: dict[tuple[int, int, str], float] = {}
+
+    def is_throttled(self, telegram_id: int) -> bool:
+        now = time.monotonic()
+        window = self._windows.get(telegram_id)
+        if window is None or now - window[0] >= self.window:
+            self._windows.set(telegram_id, [now, 1])
+            return False
+        window[1] += 1
+        return window[1] > self.rate_limit
+
+    @staticmethod
+    def get_callback_key(call: types.CallbackQuery) -> tuple[int, int, str]:
+        return call.from_user.id, call.message.message_id if call.message else 0, call.data
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        if self.is_throttled(message.from_user.id):
+            metrics.throttled_updates.inc(type='message')
+            raise CancelHandler()
+
+    async def on_pre_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        key = self.get_callback_key(call)
+        started_at = self._in_flight.get(key)
+        if started_at is not None and time.monotonic() - started_at < self.coalesce_timeout:
+            metrics.coalesced_callbacks.inc()
+            await call.answer()
+            raise CancelHandler()
+        if self.is_throttled(call.from_user.id):
+            metrics.throttled_updates.inc(type='callback_query')
+            await call.answer('Слишком часто, подождите пару секунд')
+            raise CancelHandler()
+        self._in_flight[key] = time.monotonic()
+        data['coalesce_key'] = key
+        if len(self._in_flight) > THROTTLE_MAX_USERS:
+            self.drop_stale()
+
+    def drop_stale(self) -> None:
+        # entries left by updates which failed before post-processing
+        now = time.monotonic()
+        for key, started_at in list(self._in_flight.items()):
+            if now - started_at >= self.coalesce_timeout:
+                del self._in_flight[key]
+
+    async def on_post_process_callback_query(self, call: types.CallbackQuery, results: list, data: dict):
+        if (key := data.pop('coalesce_key', None)) is not None:
+            self._in_flight.pop(key, None)
+
+
+class UserLoaderMiddleware(BaseMiddleware):
+    """Loads user once per update, payments are loaded by the handlers which need them.
+
+    Handlers receive it as `user` argument, it is None for unknown users.
+    A user who was unreachable and writes again is reachable from now on.
+    """
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        stats.mark_active(message.from_user.id)
+        data['user'] = user = await aload_user(message.from_user.id)
+        if user is not None and not user.is_reachable:
+            await User.aset_reachable(user.telegram_id, True)
+            user.is_reachable = True
+
+    async def on_pre_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        stats.mark_active(call.from_user.id)
+        data['user'] = await aload_user(call.from_user.id)
+
+
+# name of the handler processing the update, errors are reported after it has finished
+current_handler_name: ContextVar[Optional[str]] = ContextVar('current_handler_name', default=None)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Records handler latency and errors, and Bot API calls made per update.
+
+    API calls are also added to an enclosing counter, see `metrics.count_api_calls()`.
+    """
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        metrics.update_count.inc()
+        data['api_counter_token'] = metrics.current_api_counter.set(QueryCounter())
+
+    async def on_post_process_update(self, update: types.Update, results: list, data: dict):
+        counter: QueryCounter = metrics.current_api_counter.get()
+        token = data.pop('api_counter_token')
+        metrics.current_api_counter.reset(token)
+        if isinstance(token.old_value, QueryCounter):
+            token.old_value.count += counter.count
+        metrics.update_api_calls.observe(counter.count)
+
+    async def on_pre_process_error(self, update: types.Update, error: Exception, data: dict):
+        metrics.handler_errors.inc(handler=current_handler_name.get() or 'unknown')
+
+    def start_handler(self, data: dict) -> None:
+        current_handler_name.set(current_handler.get().__name__)
+        data['handler_started_at'] = time.perf_counter()
+
+    def finish_handler(self, data: dict) -> None:
+        started_at = data.pop('handler_started_at', None)
+        if started_at is not None:
+            metrics.handler_latency.observe(
+                time.perf_counter() - started_at, handler=current_handler_name.get(),
+            )
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self.start_handler(data)
+
+    async def on_post_process_message(self, message: types.Message, results: list, data: dict):
+        self.finish_handler(data)
+
+    async def on_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        self.start_handler(data)
+
+    async def on_post_process_callback_query(self, call: types.CallbackQuery, results: list, data: dict):
+        self.finish_handler(data)
+
+
+class ProfilingMiddleware(BaseMiddleware):
+    """Counts updates of a running `/profile` session, which stops after enough of them."""
+
+    async def on_post_process_update(self, update: types.Update, results: list, data: dict):
+        if profiling.current_session is not None:
+            profiling.current_session.count_update()
+
+
+def setup(dp) -> None:
+    dp.middleware.setup(ProfilingMiddleware())
+    dp.middleware.setup(MetricsMiddleware())
+    dp.middleware.setup(QueryCounterMiddleware())
+    dp.middleware.setup(ThrottlingMiddleware())
+    dp.middleware.setup(UserLoaderMiddleware())
@@ -0,0 +1,73 @@
+from datetime import timedelta
+
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+
+from utils.settings import logging, OUTBOX_POLL_INTERVAL, OUTBOX_BATCH_SIZE, OUTBOX_RETENTION_DAYS
+from utils.dates import get_local_now
+from utils.db import OutboxMessage
+from utils.aio import run_db
+from src.scheduler import scheduler
+from src.buttons import get_main_markup
+from src.delivery import delivery_queue, Delivery
+
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxRelay:
+    """Moves pending outbox messages to the delivery queue.
+
+    Messages already handed over are remembered by the last id, the queue marks
+    them sent or failed. After a restart pending messages are handed over
+    again, so a message is sent at least once.
+    """
+
+    def __init__(self, batch_size: int = OUTBOX_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.last_id = 0
+
+    async def relay(self) -> int:
+        relayed = 0
+        while messages := await run_db(OutboxMessage.get_pending, self.last_id, self.batch_size):
+            self.last_id = messages[-1].id
+            relayed += len(messages)
+            for message in messages:
+                delivery_queue.put(Delivery(
+                    message.telegram_id, message.text,
+                    reply_markup=get_main_markup(),
+                    outbox_id=message.id,
+                ))
+        if relayed:
+            logger.info(f'Relayed {relayed} outbox messages')
+        return relayed
+
+
+outbox_relay = OutboxRelay()
+
+
+async def relay_outbox() -> None:
+    await outbox_relay.relay()
+
+
+def job_relay_outbox():
+    scheduler.add_job(
+        relay_outbox,
+        trigger=IntervalTrigger(seconds=OUTBOX_POLL_INTERVAL),
+        name='relay_outbox',
+        id='relay_outbox',
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.add_job(
+        clean_outbox,
+        trigger=CronTrigger(hour=4, minute=0),
+        name='clean_outbox',
+        id='clean_outbox',
+        executor='threadpool',
+    )
+
+
+def clean_outbox() -> None:
+    deleted = OutboxMessage.delete_sent(before=get_local_now() - timedelta(days=OUTBOX_RETENTION_DAYS))
+    logger.info(f'Deleted {deleted} sent outbox messages')
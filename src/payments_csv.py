@@ -0,0 +1,120 @@
+import csv
+import io
+import tempfile
+from datetime import datetime
+from typing import IO, Iterable
+
+from peewee import prefetch
+
+from utils.settings import IMPORT_MAX_ROWS, EXPORT_CHUNK_SIZE, EXPORT_SPOOL_SIZE
+from utils.dates import WEEKLY, MONTHLY, QUARTERLY, YEARLY
+from utils.db import User, Payment, Notification
+
+
+HEADER = ['name', 'description', 'price', 'date', 'notifications', 'period']
+NOTIFICATION_DAYS = range(1, 20)  # as accepted by Payment.add_notification
+PERIOD_NAMES = {'неделя': WEEKLY, 'месяц': MONTHLY, 'квартал': QUARTERLY, 'год': YEARLY}
+
+
+def parse_period(value: str) -> str:
+    value = value.strip().lower()
+    if not value:
+        return MONTHLY
+    if value in PERIOD_NAMES.values():
+        return value
+    if value in PERIOD_NAMES:
+        return PERIOD_NAMES[value]
+    raise ValueError('период должен быть: неделя, месяц, квартал или год')
+
+
+def get_period_name(period: str) -> str:
+    return next(name for name, value in PERIOD_NAMES.items() if value == period)
+
+
+def parse_row(row: list[str]) -> dict:
+    """One `name,description,price,YYYY-MM-DD[,day;day[,period]]` row, raises ValueError if it is wrong."""
+    if len(row) not in (4, 5, 6):
+        raise ValueError('нужно от 4 до 6 полей')
+    name, description, price, date_payment = (value.strip() for value in row[:4])
+    if not name:
+        raise ValueError('пустое название')
+    try:
+        price = float(price)
+    except ValueError:
+        raise ValueError('цена должна быть числом') from None
+    try:
+        date_payment = datetime.strptime(date_payment, '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError('дата должна быть в формате год-месяц-день') from None
+    try:
+        days = sorted({int(day) for day in row[4].split(';') if day.strip()}) if len(row) >= 5 else []
+    except ValueError:
+        raise ValueError('дни уведомлений должны быть числами через ";"') from None
+    if any(day not in NOTIFICATION_DAYS for day in days):
+        raise ValueError('уведомления можно ставить за 1-19 дней')
+    return {
+        'name': name,
+        'description': description,
+        'price': price,
+        'date': date_payment,
+        'notification_days': days,
+        'period': parse_period(row[5]) if len(row) == 6 else MONTHLY,
+    }
+
+
+def parse_payments(lines: Iterable[str]) -> tuple[list[dict], list[str]]:
+    """Valid rows and error descriptions with line numbers; header and empty lines are skipped."""
+    rows, errors, names = [], [], set()
+    for number, row in enumerate(csv.reader(lines, skipinitialspace=True), start=1):
+        if not any(value.strip() for value in row) or (number == 1 and row[0].strip().lower() == HEADER[0]):
+            continue
+        if len(rows) >= IMPORT_MAX_ROWS:
+            errors.append(f'Строки после {number - 1}-й пропущены: не больше {IMPORT_MAX_ROWS} за раз')
+            break
+        try:
+            payment = parse_row(row)
+        except ValueError as exc:
+            errors.append(f'Строка {number}: {exc}')
+            continue
+        if payment['name'] in names:
+            errors.append(f'Строка {number}: повтор названия "{payment["name"]}"')
+            continue
+        names.add(payment['name'])
+        rows.append(payment)
+    return rows, errors
+
+
+def export_payments(user: User, chunk_size: int = EXPORT_CHUNK_SIZE) -> IO[bytes]:
+    """CSV with all payments of the user, in the format accepted by the import.
+
+    Payments are read in keyset chunks and written to a spooled file, which
+    moves to disk once it outgrows EXPORT_SPOOL_SIZE. The caller closes it.
+    """
+    file = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    text = io.TextIOWrapper(file, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(HEADER)
+    last_id = 0
+    while payments := list(prefetch(
+        Payment.select()
+        .where((Payment.user == user.id) & (Payment.id > last_id))
+        .order_by(Payment.id)
+        .limit(chunk_size),
+        Notification.select().order_by(Notification.day_before_payment),
+    )):
+        last_id = payments[-1].id
+        writer.writerows(
+            [
+                payment.name,
+                payment.description,
+                payment.price,
+                payment.date.isoformat(),
+                ';'.join(str(n.day_before_payment) for n in payment.notifications),
+                get_period_name(payment.period),
+            ]
+            for payment in payments
+        )
+    text.flush()
+    text.detach()
+    file.seek(0)
+    return file
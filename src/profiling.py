@@ -0,0 +1,116 @@
+import asyncio
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+from collections import Counter
+from collections.abc import Sized
+from typing import Optional
+
+from aiogram import types
+
+from utils.settings import (
+    logging, bot, dp, PROFILE_TOP_FUNCTIONS, PROFILE_TOP_ALLOCATIONS, PROFILE_TRACEMALLOC_FRAMES,
+)
+from src.scheduler import scheduler
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilingSession:
+    """cProfile and tracemalloc running until `max_updates` updates or `max_seconds` have passed.
+
+    The profiler sees everything on the event loop thread, not only handlers:
+    scheduler jobs and notification delivery are in the report too.
+    Database queries run in worker threads and are seen only as waiting.
+    """
+
+    def __init__(self, chat_id: int, max_updates: int, max_seconds: float):
+        self.chat_id = chat_id
+        self.max_updates = max_updates
+        self.max_seconds = max_seconds
+        self.updates = 0
+        self.notifications = 0
+        self.profiler = cProfile.Profile()
+        self._started_at = 0.0
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._finished = False
+
+    def start(self) -> None:
+        tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+        self._snapshot = tracemalloc.take_snapshot()
+        self._started_at = time.perf_counter()
+        self._timer = asyncio.get_running_loop().call_later(self.max_seconds, self.finish)
+        self.profiler.enable()
+
+    def count_update(self) -> None:
+        self.updates += 1
+        if self.updates >= self.max_updates:
+            self.finish()
+
+    def finish(self) -> None:
+        if self._finished:
+            return
+        self._finished = True
+        self.profiler.disable()
+        self._timer.cancel()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        global current_session
+        current_session = None
+        task = asyncio.get_running_loop().create_task(self.send_report(snapshot))
+        reports.add(task)
+        task.add_done_callback(reports.discard)
+
+    def get_report(self, snapshot: tracemalloc.Snapshot) -> str:
+        duration = time.perf_counter() - self._started_at
+        lines = [
+            f'Profiling window: {duration:.1f} sec, {self.updates} updates, '
+            f'{self.notifications} notifications',
+            '',
+        ]
+        jobs = Counter(job.func.__name__ for job in scheduler.get_jobs())
+        lines.append(f'Scheduler jobs: {sum(jobs.values())}')
+        lines.extend(f'  {name}: {count}' for name, count in jobs.most_common())
+        storage = dp.storage
+        lines.append(f'FSM entries: {len(storage) if isinstance(storage, Sized) else "unknown"}')
+        lines.append('')
+
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP_FUNCTIONS)
+        lines.append(f'Top {PROFILE_TOP_FUNCTIONS} functions by cumulative time')
+        lines.append(stream.getvalue())
+
+        lines.append(f'Top {PROFILE_TOP_ALLOCATIONS} allocation sites in the window')
+        differences = snapshot.compare_to(self._snapshot, 'lineno')
+        lines.extend(str(difference) for difference in differences[:PROFILE_TOP_ALLOCATIONS])
+        return '\n'.join(lines)
+
+    async def send_report(self, snapshot: tracemalloc.Snapshot) -> None:
+        # FSM storage counts its entries with a query, the report is built off the loop
+        report = await asyncio.get_running_loop().run_in_executor(None, self.get_report, snapshot)
+        document = types.InputFile(io.BytesIO(report.encode()), filename='profile.txt')
+        try:
+            await bot.send_document(self.chat_id, document)
+        except Exception as exc:
+            logger.error(f'Cannot send profiling report: {exc}')
+
+
+# the running session, None keeps the hooks down to one global lookup
+current_session: Optional[ProfilingSession] = None
+reports: set[asyncio.Task] = set()
+
+
+def start_profiling(chat_id: int, max_updates: int, max_seconds: float) -> bool:
+    """Start a session, False if one is already running."""
+    global current_session
+    if current_session is not None:
+        return False
+    current_session = ProfilingSession(chat_id, max_updates, max_seconds)
+    current_session.start()
+    logger.info(f'Profiling started for {max_updates} updates or {max_seconds} sec')
+    return True
@@ -1,12 +1,22 @@
-import time
+from datetime import datetime
 
-from pytz import timezone
+from apscheduler.events import (
+    JobExecutionEvent, JobSubmissionEvent, EVENT_JOB_SUBMITTED, EVENT_JOB_MISSED,
+)
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.executors.asyncio import AsyncIOExecutor
 from apscheduler.executors.pool import ThreadPoolExecutor, ProcessPoolExecutor
+from apscheduler.triggers.base import BaseTrigger
 from apscheduler.triggers.cron import CronTrigger
 
-from utils.settings import dp, logging, get_day_word, PAYMENTS, CACHE_CLEAR_TIMER
+from utils.settings import (
+    logging, get_day_word, TIMEZONE, SCHEDULER_THREAD_POOL_SIZE, SCHEDULER_PROCESS_POOL_SIZE,
+    SCHEDULER_COALESCE, SCHEDULER_MAX_INSTANCES, SCHEDULER_MISFIRE_GRACE_TIME,
+)
+from utils.cache import user_cache, view_cache
+from utils.dates import get_next_fire_dates
+from utils import metrics
 from src.buttons import get_main_markup
 
 
@@ -15,48 +25,88 @@ logger = logging.getLogger(__name__)
 jobstores = {
     'default': MemoryJobStore()
 }
+# coroutine jobs must run on the event loop, blocking ones go to `executor='threadpool'`
 executors = {
-    'default': ThreadPoolExecutor(20),
-    'processpool': ProcessPoolExecutor(5)
+    'default': AsyncIOExecutor(),
+    'threadpool': ThreadPoolExecutor(SCHEDULER_THREAD_POOL_SIZE),
 }
+if SCHEDULER_PROCESS_POOL_SIZE:
+    executors['processpool'] = ProcessPoolExecutor(SCHEDULER_PROCESS_POOL_SIZE)
 job_defaults = {
-    'coalesce': False,
-    'max_instances': 3
+    'coalesce': SCHEDULER_COALESCE,
+    'max_instances': SCHEDULER_MAX_INSTANCES,
+    'misfire_grace_time': SCHEDULER_MISFIRE_GRACE_TIME,
 }
 
 scheduler = AsyncIOScheduler(
     jobstores=jobstores,
-    # executors=executors,
-    # job_defaults=job_defaults,
-    timezone=timezone('Europe/Moscow')
+    executors=executors,
+    job_defaults=job_defaults,
+    timezone=TIMEZONE
 )
 
 
+class NotificationTrigger(BaseTrigger):
+    """Fires `days_before` days before every charge of a payment, at NOTIFICATION_HOUR.
+
+    Unlike a monthly cron on `day - days_before`, it works for any period and
+    for notifications which fall into the previous month.
+    """
+
+    def __init__(self, anchor, period: str, days_before: int):
+        self.anchor = anchor
+        self.period = period
+        self.days_before = days_before
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        after = (previous_fire_time or now).astimezone(TIMEZONE).replace(tzinfo=None)
+        fire_at = get_next_fire_dates([self.anchor], [self.period], [self.days_before], after)[0]
+        return TIMEZONE.localize(fire_at)
+
+    def __str__(self):
+        return f'notification[{self.period} from {self.anchor}, {self.days_before} days before]'
+
+
 def start():
+    scheduler.add_listener(record_job_lag, EVENT_JOB_SUBMITTED)
+    scheduler.add_listener(record_missed_job, EVENT_JOB_MISSED)
     scheduler.start()
     job_clear_cache()
 
 
-async def send_notification(telegram_id: int, payment_price: float,
-                            username: str, payment_name: str, notif_days: int):
+def get_job_label(job_id: str) -> str:
+    # notification jobs have an id per notification, so they are grouped by function
+    job = scheduler.get_job(job_id)
+    return job.func.__name__ if job else 'unknown'
+
+
+def record_job_lag(event: JobSubmissionEvent) -> None:
+    now = datetime.now(TIMEZONE)
+    label = get_job_label(event.job_id)
+    for run_time in event.scheduled_run_times:
+        metrics.scheduler_lag.observe((now - run_time).total_seconds(), job=label)
+
+
+def record_missed_job(event: JobExecutionEvent) -> None:
+    metrics.scheduler_missed.inc(job=get_job_label(event.job_id))
+
+
+def get_notification_text(payment_price: float, username: str, payment_name: str, notif_days: int) -> str:
     days_left: str = f'{notif_days} {get_day_word(notif_days)}'
     message = (
         f'Привет, {username}!',
         f'Оплата по сервису {payment_name} произойдёт через {days_left}.',
         f'Стоимость: {payment_price}',
     )
-    try:
-        await dp.bot.send_message(
-            telegram_id,
-            '\n'.join(message),
-            reply_markup=get_main_markup()
-        )
-    except Exception as exc:
-        error_message = (
-            str(exc),
-            f'Cannot send message about notification to user {telegram_id} about {payment_name}'
-        )
-        logger.debug('\n'.join(error_message))
+    return '\n'.join(message)
+
+
+async def send_notification(telegram_id: int, payment_price: float,
+                            username: str, payment_name: str, notif_days: int):
+    text = get_notification_text(payment_price, username, payment_name, notif_days)
+    # src.delivery needs the models, which import this module
+    from src.delivery import delivery_queue, Delivery
+    delivery_queue.put(Delivery(telegram_id, text, reply_markup=get_main_markup()))
 
 
 def job_clear_cache():
@@ -73,12 +123,11 @@ def job_clear_cache():
         trigger=cron,
         name='clear_cache',
         id='clear_cache',
+        executor='threadpool',
     )
 
 
 def clear_cache():
-    id_list = tuple(PAYMENTS.keys())
-    for telegram_id in id_list:
-        if time.time() - PAYMENTS[telegram_id]['timestamp'] > CACHE_CLEAR_TIMER:
-            PAYMENTS.pop(telegram_id)
-    del id_list
+    user_cache.expire()
+    view_cache.expire()
+    logger.debug(f'User cache: {user_cache.get_stats()}')
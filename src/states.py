@@ -5,6 +5,8 @@ class MainStates(StatesGroup):
     main_menu = State()
     change_name = State()
     broadcast = State()
+    summary = State()
+    stats = State()
 
 
 class NotificationStates(StatesGroup):
@@ -16,5 +18,6 @@ class NotificationStates(StatesGroup):
 class PaymentStates(StatesGroup):
     list = State()
     add = State()
+    bulk_add = State()
     select = State()
     delete = State()
@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+
+from apscheduler.triggers.interval import IntervalTrigger
+
+from utils.settings import (
+    logging, database, SWEEPER_INTERVAL, SWEEPER_BATCH_SIZE, SWEEPER_MISFIRE_GRACE,
+)
+from utils.dates import get_local_now
+from utils.db import User, Payment, Notification, OutboxMessage, bulk_update_next_fire_dates, set_next_fire_dates
+from utils.aio import run_db
+from utils import metrics
+from src.scheduler import scheduler, get_notification_text
+from src.outbox import relay_outbox
+
+
+logger = logging.getLogger(__name__)
+
+
+def job_sweep_notifications():
+    scheduler.add_job(
+        sweep_notifications,
+        trigger=IntervalTrigger(seconds=SWEEPER_INTERVAL),
+        name='sweep_notifications',
+        id='sweep_notifications',
+        max_instances=1,
+        coalesce=True,
+    )
+
+
+def get_due_notifications(now, batch_size: int = SWEEPER_BATCH_SIZE) -> list[Notification]:
+    return list(
+        Notification.select(Notification, Payment, User)
+        .join(Payment)
+        .join(User)
+        .where(Notification.next_fire_at <= now)
+        .order_by(Notification.next_fire_at)
+        .limit(batch_size)
+    )
+
+
+def enqueue_due_notifications(now: datetime, missed_before: datetime,
+                              batch_size: int = SWEEPER_BATCH_SIZE) -> int:
+    """Write a batch of due notifications to the outbox and move them to the next period.
+
+    Both happen in one transaction, so a crash cannot lose a notification or
+    write it twice. It takes the write lock before reading: handlers and other
+    processes write meanwhile, and a deferred transaction could not upgrade.
+    Notifications due before `missed_before` are moved on without a message,
+    they are logged and counted as missed. Returns the number of processed
+    notifications.
+    """
+    with database.atomic('IMMEDIATE'):
+        notifications = get_due_notifications(now, batch_size)
+        missed = [n for n in notifications if n.next_fire_at < missed_before]
+        if missed:
+            metrics.notification_count.inc(len(missed), status='missed')
+            logger.warning(
+                f'Skipped {len(missed)} notifications late by more than {SWEEPER_MISFIRE_GRACE} s: '
+                + ', '.join(f'{n.id} due at {n.next_fire_at}' for n in missed)
+            )
+        # message is built from the rows loaded right now, so renames are never stale
+        rows = [
+            {
+                'notification_id': n.id,
+                'telegram_id': n.payment.user.telegram_id,
+                'text': get_notification_text(
+                    n.payment.price, n.payment.user.username, n.payment.name, n.day_before_payment,
+                ),
+                'due_at': n.next_fire_at,
+            }
+            # notifications of users who blocked the bot are moved on without a message
+            for n in notifications if n.next_fire_at >= missed_before and n.payment.user.is_reachable
+        ]
+        if rows:
+            OutboxMessage.insert_many(rows).on_conflict_ignore().execute()
+        set_next_fire_dates(notifications, after=now)
+        if notifications:
+            bulk_update_next_fire_dates(notifications)
+    return len(notifications)
+
+
+async def sweep_notifications():
+    """Move every notification which fire date has come to the outbox, the relay sends them."""
+    now = get_local_now()
+    missed_before = now - timedelta(seconds=SWEEPER_MISFIRE_GRACE)
+    processed = 0
+    while count := await run_db(enqueue_due_notifications, now, missed_before):
+        processed += count
+        if count < SWEEPER_BATCH_SIZE:
+            break
+    if processed:
+        logger.info(f'Sweeper processed {processed} notifications')
+        await relay_outbox()
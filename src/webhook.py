@@ -0,0 +1,80 @@
+import asyncio
+from typing import Optional
+
+from aiohttp import web
+from aiogram import types
+from aiogram.dispatcher.webhook import WebhookRequestHandler, AnswerCallbackQuery
+from aiogram.utils import executor
+
+from utils.settings import (
+    logging, dp, WEBHOOK_URL, WEBHOOK_PATH, WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_DRAIN_TIMEOUT,
+)
+
+
+logger = logging.getLogger(__name__)
+
+is_webhook_mode = False
+
+
+async def answer_callback(call: types.CallbackQuery, text: Optional[str] = None) -> Optional[AnswerCallbackQuery]:
+    """Answer callback query, returning the answer so it goes inline in the webhook response.
+
+    Handlers should `return` the result. In polling mode callbacks are answered
+    only when there is a text to show, as before.
+    """
+    if is_webhook_mode:
+        return AnswerCallbackQuery(call.id, text)
+    if text:
+        await call.answer(text)
+    return None
+
+
+class DrainingWebhookRequestHandler(WebhookRequestHandler):
+    """Counts updates in progress and refuses new ones once shutdown has started."""
+
+    async def post(self):
+        app = self.request.app
+        if app['draining']:
+            return web.Response(status=503, headers={'Retry-After': '5'})
+        app['in_flight'] += 1
+        try:
+            return await super().post()
+        finally:
+            app['in_flight'] -= 1
+
+
+async def drain(app: web.Application) -> None:
+    app['draining'] = True
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + WEBHOOK_DRAIN_TIMEOUT
+    while app['in_flight'] and loop.time() < deadline:
+        await asyncio.sleep(0.1)
+    if app['in_flight']:
+        logger.warning(f'Webhook stopped with {app["in_flight"]} updates in progress')
+
+
+def run_webhook(on_startup=None, on_shutdown=None):
+    global is_webhook_mode
+    is_webhook_mode = True
+
+    async def startup(dispatcher):
+        if WEBHOOK_URL:
+            await dispatcher.bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH)
+        if on_startup:
+            await on_startup(dispatcher)
+
+    async def shutdown(dispatcher):
+        await drain(app)
+        if WEBHOOK_URL:
+            await dispatcher.bot.delete_webhook()
+        if on_shutdown:
+            await on_shutdown(dispatcher)
+
+    app = web.Application()
+    app['draining'] = False
+    app['in_flight'] = 0
+    bot_executor = executor.Executor(dp, skip_updates=True)
+    bot_executor.on_startup(startup, polling=False)
+    bot_executor.on_shutdown(shutdown, polling=False)
+    bot_executor.set_webhook(WEBHOOK_PATH, request_handler=DrainingWebhookRequestHandler, web_app=app)
+    bot_executor.run_app(host=WEBAPP_HOST, port=WEBAPP_PORT)
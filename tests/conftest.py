@@ -0,0 +1,69 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from aiogram import Bot, Dispatcher
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
+
+import utils.aio
+import utils.db
+from utils.settings import dp, database, DATABASE_PRAGMAS, TIMEZONE
+from utils.cache import user_cache, view_cache
+from utils.fsm_storage import SQLiteStorage
+from utils.db import connect_db, initialize_db
+from migrations import run_migrations
+from src.middlewares import ThrottlingMiddleware
+from tools.fake_telegram import FakeBotAPI
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Empty bot database in a temporary file.
+
+    DB threads keep their connection open, so every test gets its own pool.
+    """
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+    monkeypatch.setattr(utils.aio, 'db_executor', executor)
+    database.init(str(tmp_path / 'bot.db'), pragmas=DATABASE_PRAGMAS)
+    connect_db()
+    run_migrations()
+    initialize_db()
+    user_cache.clear()
+    view_cache.clear()
+    yield database
+    executor.submit(database.close).result()
+    executor.shutdown()
+    database.close()
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    """Started scheduler which never runs jobs, used by the models instead of the bot one."""
+    scheduler = BackgroundScheduler(jobstores={'default': MemoryJobStore()}, timezone=TIMEZONE)
+    scheduler.start(paused=True)
+    monkeypatch.setattr(utils.db, 'scheduler', scheduler)
+    yield scheduler
+    scheduler.shutdown(wait=False)
+
+
+@pytest.fixture
+def api(db, scheduler, tmp_path, monkeypatch):
+    """Dispatcher with a fresh FSM storage and a bot answered by `FakeBotAPI` without a server."""
+    api = FakeBotAPI()
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        api.calls.append((method, data))
+        return api.get_result(method, data or {})
+
+    monkeypatch.setattr(Bot, 'request', request)
+    storage = SQLiteStorage(str(tmp_path / 'fsm.db'))
+    monkeypatch.setattr(dp, 'storage', storage)
+    for middleware in dp.middleware.applications:
+        if isinstance(middleware, ThrottlingMiddleware):
+            monkeypatch.setattr(middleware, 'rate_limit', float('inf'))
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    yield api
+    asyncio.run(storage.close())
+    asyncio.run(storage.wait_closed())
@@ -0,0 +1,54 @@
+import asyncio
+
+import src.broadcast
+from utils.db import User, Broadcast
+from src.broadcast import run_in_background
+
+
+class FakeBot:
+    def __init__(self, failing: set[int]):
+        self.failing = failing
+        self.sent: list[int] = []
+
+    async def send_message(self, chat_id, text):
+        if chat_id in self.failing:
+            raise ValueError('broken message')
+        self.sent.append(chat_id)
+
+    async def edit_message_text(self, text, chat_id, message_id):
+        pass
+
+
+def create_broadcast(users: int) -> Broadcast:
+    for telegram_id in range(1, users + 1):
+        User.create_or_update(telegram_id, f'user{telegram_id}')
+    return Broadcast.create(text='Hello', chat_id=1, message_id=1, total=users)
+
+
+async def wait_broadcast(broadcast: Broadcast) -> None:
+    task = run_in_background(broadcast)
+    await asyncio.wait([task])
+    while src.broadcast.running_broadcasts:
+        await asyncio.sleep(0.01)
+
+
+def test_unexpected_send_error_counts_as_failed(db, monkeypatch):
+    bot = FakeBot(failing={2})
+    monkeypatch.setattr(src.broadcast, 'bot', bot)
+    broadcast = create_broadcast(3)
+    asyncio.run(wait_broadcast(broadcast))
+    broadcast = Broadcast.get_by_id(broadcast.id)
+    assert bot.sent == [1, 3]
+    assert (broadcast.status, broadcast.sent, broadcast.failed) == (Broadcast.FINISHED, 2, 1)
+
+
+def test_crashed_broadcast_is_marked_failed(db, monkeypatch):
+    def save_checkpoint(*args, **kwargs):
+        raise RuntimeError('database is gone')
+
+    monkeypatch.setattr(src.broadcast, 'bot', FakeBot(failing=set()))
+    monkeypatch.setattr(src.broadcast, 'save_checkpoint', save_checkpoint)
+    broadcast = create_broadcast(1)
+    asyncio.run(wait_broadcast(broadcast))
+    assert Broadcast.get_by_id(broadcast.id).status == Broadcast.FAILED
+    assert Broadcast.get_running() == []
@@ -0,0 +1,47 @@
+from datetime import date, datetime
+
+from utils.dates import get_next_due_dates, get_next_fire_dates, get_weekly_charges, WEEKLY, MONTHLY, QUARTERLY, YEARLY
+from utils.settings import NOTIFICATION_HOUR
+
+
+def next_due(anchor: date, period: str, on_or_after: date) -> date:
+    return get_next_due_dates([anchor], [period], on_or_after)[0].item()
+
+
+def test_charge_on_anchor_and_every_period():
+    assert next_due(date(2026, 1, 5), MONTHLY, date(2025, 12, 1)) == date(2026, 1, 5)
+    assert next_due(date(2026, 1, 5), MONTHLY, date(2026, 1, 5)) == date(2026, 1, 5)
+    assert next_due(date(2026, 1, 5), MONTHLY, date(2026, 1, 6)) == date(2026, 2, 5)
+    assert next_due(date(2026, 1, 5), WEEKLY, date(2026, 1, 6)) == date(2026, 1, 12)
+    assert next_due(date(2026, 1, 5), QUARTERLY, date(2026, 1, 6)) == date(2026, 4, 5)
+    assert next_due(date(2026, 1, 5), YEARLY, date(2026, 1, 6)) == date(2027, 1, 5)
+
+
+def test_month_end_is_clamped():
+    assert next_due(date(2026, 1, 31), MONTHLY, date(2026, 2, 1)) == date(2026, 2, 28)
+    assert next_due(date(2026, 1, 31), MONTHLY, date(2026, 3, 1)) == date(2026, 3, 31)
+    assert next_due(date(2026, 1, 31), MONTHLY, date(2026, 4, 1)) == date(2026, 4, 30)
+    assert next_due(date(2024, 2, 29), YEARLY, date(2024, 3, 1)) == date(2025, 2, 28)
+
+
+def test_many_payments_in_one_pass():
+    anchors = [date(2026, 1, 31), date(2026, 3, 10), date(2026, 10, 1)]
+    periods = [MONTHLY, WEEKLY, QUARTERLY]
+    due = get_next_due_dates(anchors, periods, date(2026, 10, 18)).tolist()
+    assert due == [date(2026, 10, 31), date(2026, 10, 20), date(2027, 1, 1)]
+
+
+def test_weekly_charges_up_to_end():
+    assert get_weekly_charges(date(2026, 10, 22), date(2026, 11, 12)) == [
+        date(2026, 10, 22), date(2026, 10, 29), date(2026, 11, 5),
+    ]
+    assert get_weekly_charges(date(2026, 10, 22), date(2026, 10, 22)) == []
+
+
+def test_notification_fires_days_before_charge():
+    # the charge on the 1st is notified 3 days before, across the month boundary
+    fire_at, = get_next_fire_dates([date(2026, 1, 1)], [MONTHLY], [3], datetime(2026, 10, 18, 12))
+    assert fire_at == datetime(2026, 10, 29, NOTIFICATION_HOUR)
+    # today's notification time has passed, so the next one is a period later
+    fire_at, = get_next_fire_dates([date(2026, 1, 21)], [MONTHLY], [3], datetime(2026, 10, 18, 23))
+    assert fire_at == datetime(2026, 11, 18, NOTIFICATION_HOUR)
@@ -0,0 +1,88 @@
+import asyncio
+from datetime import datetime
+from typing import Union
+
+from aiogram.utils import exceptions
+
+import src.delivery
+from utils.db import User, DeadLetter, OutboxMessage
+from src.delivery import DeliveryQueue, Delivery
+
+
+class FlakyBot:
+    """Fails with `error` `failures` times for every user, then sends."""
+
+    def __init__(self, failures: int, error: type[Exception] = exceptions.NetworkError):
+        self.failures = failures
+        self.error = error
+        self.attempts: dict[int, int] = {}
+        self.sent: list[int] = []
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        await asyncio.sleep(0.01)
+        self.attempts[chat_id] = self.attempts.get(chat_id, 0) + 1
+        if self.attempts[chat_id] <= self.failures:
+            raise self.error('connection reset')
+        self.sent.append(chat_id)
+
+
+def deliver(bot: FlakyBot, monkeypatch, *deliveries: Union[int, Delivery]) -> None:
+    async def main():
+        monkeypatch.setattr(src.delivery, 'bot', bot)
+        queue = DeliveryQueue(rate=1000, workers=2, spread_window=0, max_attempts=3, backoff=0.01)
+        queue.start()
+        for delivery in deliveries:
+            queue.put(delivery if isinstance(delivery, Delivery) else Delivery(delivery, 'Pay'))
+        await asyncio.sleep(0)  # the workers take the messages, the queue itself is empty
+        await queue.join()
+        await queue.stop()
+
+    asyncio.run(main())
+
+
+def test_join_waits_for_messages_in_flight(db, monkeypatch):
+    bot = FlakyBot(failures=0)
+    deliver(bot, monkeypatch, 1, 2, 3)
+    assert sorted(bot.sent) == [1, 2, 3]
+
+
+def test_temporary_errors_are_retried(db, monkeypatch):
+    bot = FlakyBot(failures=2)
+    deliver(bot, monkeypatch, 1)
+    assert bot.sent == [1]
+    assert DeadLetter.select().count() == 0
+
+
+def test_message_failing_every_attempt_is_dead_lettered(db, monkeypatch):
+    User.create_or_update(1, 'user')
+    bot = FlakyBot(failures=3)
+    deliver(bot, monkeypatch, 1)
+    assert bot.sent == []
+    letter, = DeadLetter.select()
+    assert (letter.telegram_id, letter.attempts) == (1, 3)
+    assert letter.error.startswith('NetworkError')
+
+
+
+def add_outbox(telegram_id: int) -> Delivery:
+    User.create_or_update(telegram_id, f'user{telegram_id}')
+    row = OutboxMessage.create(telegram_id=telegram_id, text='Pay', due_at=datetime(2026, 10, 18, 12))
+    return Delivery(telegram_id, 'Pay', outbox_id=row.id)
+
+
+def test_crashed_delivery_is_retried(db, monkeypatch):
+    bot = FlakyBot(failures=1, error=RuntimeError)
+    delivery = add_outbox(1)
+    deliver(bot, monkeypatch, delivery)
+    assert bot.sent == [1]
+    assert OutboxMessage.get_by_id(delivery.outbox_id).status == OutboxMessage.SENT
+
+
+def test_delivery_crashing_every_attempt_is_dead_lettered(db, monkeypatch):
+    bot = FlakyBot(failures=3, error=RuntimeError)
+    delivery = add_outbox(1)
+    deliver(bot, monkeypatch, delivery)
+    assert bot.sent == []
+    assert OutboxMessage.get_by_id(delivery.outbox_id).status == OutboxMessage.FAILED
+    letter, = DeadLetter.select()
+    assert (letter.attempts, letter.error) == (3, 'RuntimeError: connection reset')
@@ -0,0 +1,114 @@
+import asyncio
+import subprocess
+import sys
+import threading
+
+from utils.fsm_storage import SQLiteStorage
+
+
+def reopen(storage: SQLiteStorage) -> SQLiteStorage:
+    return SQLiteStorage(storage.path, flush_interval=storage.flush_interval)
+
+
+def test_imports_without_settings():
+    subprocess.run([sys.executable, '-c', 'import utils.fsm_storage'], check=True)
+
+
+def test_state_survives_restart(tmp_path):
+    async def main():
+        storage = SQLiteStorage(str(tmp_path / 'fsm.db'), flush_interval=0.01)
+        await storage.set_state(chat=1, user=1, state='PaymentStates:list')
+        await storage.update_data(chat=1, user=1, page=['next', 0, 0])
+        await storage.close()
+        await storage.wait_closed()
+
+        storage = reopen(storage)
+        assert await storage.get_state(chat=1, user=1) == 'PaymentStates:list'
+        assert await storage.get_data(chat=1, user=1) == {'page': ['next', 0, 0]}
+
+    asyncio.run(main())
+
+
+def test_write_during_flush_is_saved(tmp_path):
+    async def main():
+        storage = SQLiteStorage(str(tmp_path / 'fsm.db'), flush_interval=0.01)
+        writing, release = threading.Event(), threading.Event()
+        write = storage._write
+
+        def slow_write(dirty):
+            writing.set()
+            release.wait()
+            write(dirty)
+
+        storage._write = slow_write
+        await storage.set_state(chat=1, user=1, state='first')
+        await asyncio.get_running_loop().run_in_executor(None, writing.wait)
+        await storage.set_state(chat=2, user=2, state='second')
+        release.set()
+        for _ in range(100):
+            if not storage._dirty and not storage._flushing:
+                break
+            await asyncio.sleep(0.01)
+
+        storage = reopen(storage)
+        assert await storage.get_state(chat=1, user=1) == 'first'
+        assert await storage.get_state(chat=2, user=2) == 'second'
+
+    asyncio.run(main())
+
+
+def test_failed_flush_keeps_records(tmp_path):
+    async def main():
+        storage = SQLiteStorage(str(tmp_path / 'fsm.db'), flush_interval=60)
+        write = storage._write
+        await storage.set_state(chat=1, user=1, state='old')
+        await storage.set_state(chat=2, user=2, state='kept')
+
+        def failing_write(dirty):
+            # a newer change made while the failed write was in progress
+            storage._dirty[('1', '1')] = {'state': 'new', 'data': {}, 'bucket': {}}
+            raise RuntimeError('database is locked')
+
+        storage._write = failing_write
+        await storage.flush()
+        assert storage._dirty[('1', '1')]['state'] == 'new'
+        assert storage._dirty[('2', '2')]['state'] == 'kept'
+        assert not storage._flushing
+
+        storage._write = write
+        await storage.close()
+        storage = reopen(storage)
+        assert await storage.get_state(chat=1, user=1) == 'new'
+        assert await storage.get_state(chat=2, user=2) == 'kept'
+
+    asyncio.run(main())
+
+
+def test_storage_opens_database_on_first_use(tmp_path):
+    async def main():
+        storage = SQLiteStorage(str(tmp_path / 'fsm.db'))
+        assert list(tmp_path.iterdir()) == []
+        assert await storage.get_state(chat=1, user=1) is None
+        assert (tmp_path / 'fsm.db').exists()
+        await storage.close()
+        await storage.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_read_does_not_wait_for_flush(tmp_path):
+    async def main():
+        storage = SQLiteStorage(str(tmp_path / 'fsm.db'), flush_interval=60)
+        await storage.set_state(chat=3, user=3, state='stored')
+        await storage.close()
+        await storage.wait_closed()
+
+        storage = reopen(storage)
+        await storage.get_state(chat=1, user=1)  # opens the reader
+        # a flush holds the writer connection for its whole transaction
+        with storage._db_lock:
+            state = await asyncio.wait_for(storage.get_state(chat=3, user=3), timeout=1)
+        assert state == 'stored'
+        await storage.wait_closed()
+
+    asyncio.run(main())
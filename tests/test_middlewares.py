@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+
+import src.middlewares
+from src.middlewares import ThrottlingMiddleware
+from tools.fake_telegram import make_callback_update
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(src.middlewares.time, 'monotonic', clock.monotonic)
+    return clock
+
+
+def test_updates_over_rate_limit_are_throttled(clock):
+    middleware = ThrottlingMiddleware(rate_limit=2, window=2)
+    assert [middleware.is_throttled(1) for _ in range(3)] == [False, False, True]
+    assert not middleware.is_throttled(2)
+    clock.now += 2
+    assert not middleware.is_throttled(1)
+
+
+def test_duplicate_tap_is_answered_without_handler(api, clock):
+    middleware = ThrottlingMiddleware(rate_limit=10, window=2, coalesce_timeout=5)
+    call = types.Update(**make_callback_update(1, 'id:show_payments')).callback_query
+
+    async def main():
+        first, second = {}, {}
+        await middleware.on_pre_process_callback_query(call, first)
+        with pytest.raises(CancelHandler):
+            await middleware.on_pre_process_callback_query(call, second)
+        assert [method for method, _ in api.calls] == ['answerCallbackQuery']
+        # once the first one is handled, the next tap goes to the handler again
+        await middleware.on_post_process_callback_query(call, [], first)
+        await middleware.on_pre_process_callback_query(call, second)
+
+    asyncio.run(main())
@@ -0,0 +1,26 @@
+import asyncio
+from datetime import date
+
+from utils.db import User, Notification, load_user, rehydrate_jobs
+
+
+def add_user_with_payment(telegram_id: int = 1):
+    User.create_or_update(telegram_id, 'user')
+    return load_user(telegram_id).add_payment('Music', 'Subscription', 10, date(2026, 1, 5))
+
+
+def test_add_notification_twice_keeps_one_job(db, scheduler):
+    payment = add_user_with_payment()
+    payment.add_notification(3)
+    payment.add_notification(3)
+    assert Notification.select().count() == 1
+    assert len(scheduler.get_jobs()) == 1
+
+
+def test_rehydration_replaces_registered_jobs(db, scheduler):
+    payment = add_user_with_payment()
+    payment.add_notification(1)
+    payment.add_notification(2)
+    assert asyncio.run(rehydrate_jobs(chunk_size=1)) == 2
+    assert sorted(job.id for job in scheduler.get_jobs()) == sorted(
+        notification.get_job_name() for notification in Notification.select())
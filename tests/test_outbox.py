@@ -0,0 +1,86 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from aiogram.utils import exceptions
+
+import src.delivery
+import src.outbox
+from utils.db import User, OutboxMessage, DeadLetter
+from src.delivery import DeliveryQueue
+from src.outbox import OutboxRelay, clean_outbox
+
+
+BLOCKED_ID = 2
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent: list[int] = []
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        if chat_id == BLOCKED_ID:
+            raise exceptions.BotBlocked('Forbidden: bot was blocked by the user')
+        self.sent.append(chat_id)
+
+
+def add_messages(*telegram_ids: int) -> None:
+    due_at = datetime(2026, 10, 18, 12)
+    for notification_id, telegram_id in enumerate(telegram_ids, start=1):
+        User.create_or_update(telegram_id, f'user{telegram_id}')
+        OutboxMessage.create(notification_id=notification_id, telegram_id=telegram_id, text='Pay', due_at=due_at)
+
+
+def relay(relay: OutboxRelay, bot: FakeBot, monkeypatch) -> int:
+    async def main():
+        queue = DeliveryQueue(rate=1000, workers=2, spread_window=0)
+        monkeypatch.setattr(src.outbox, 'delivery_queue', queue)
+        monkeypatch.setattr(src.delivery, 'bot', bot)
+        queue.start()
+        try:
+            relayed = await relay.relay()
+            await queue.join()
+        finally:
+            await queue.stop()
+        return relayed
+
+    return asyncio.run(main())
+
+
+def test_relayed_messages_are_marked_sent_or_failed(db, monkeypatch):
+    add_messages(1, BLOCKED_ID, 3)
+    bot, outbox_relay = FakeBot(), OutboxRelay(batch_size=2)
+    assert OutboxMessage.count_pending() == 3
+    assert relay(outbox_relay, bot, monkeypatch) == 3
+    assert OutboxMessage.count_pending() == 0
+    assert sorted(bot.sent) == [1, 3]
+    statuses = {row.telegram_id: row.status for row in OutboxMessage.select()}
+    assert statuses == {1: OutboxMessage.SENT, BLOCKED_ID: OutboxMessage.FAILED, 3: OutboxMessage.SENT}
+    assert [row.telegram_id for row in DeadLetter.select()] == [BLOCKED_ID]
+    assert not User.get(User.telegram_id == BLOCKED_ID).is_reachable
+    # handed over messages are not relayed again
+    assert relay(outbox_relay, bot, monkeypatch) == 0
+
+
+def test_pending_messages_are_relayed_after_restart(db, monkeypatch):
+    add_messages(1)
+    OutboxMessage.set_status(1, OutboxMessage.PENDING)
+    bot = FakeBot()
+    # a new relay, as after a restart, hands over everything still pending
+    assert relay(OutboxRelay(), bot, monkeypatch) == 1
+    assert relay(OutboxRelay(), bot, monkeypatch) == 0
+    assert bot.sent == [1]
+
+
+def test_same_notification_date_is_written_once(db):
+    add_messages(1)
+    row = {'notification_id': 1, 'telegram_id': 1, 'text': 'Pay', 'due_at': datetime(2026, 10, 18, 12)}
+    OutboxMessage.insert_many([row]).on_conflict_ignore().execute()
+    assert OutboxMessage.select().count() == 1
+
+
+def test_old_sent_messages_are_cleaned(db):
+    add_messages(1, 3)
+    OutboxMessage.set_status(1, OutboxMessage.SENT)
+    OutboxMessage.update(sent_at=datetime.now() - timedelta(days=365)).where(OutboxMessage.id == 1).execute()
+    clean_outbox()
+    assert [row.telegram_id for row in OutboxMessage.select()] == [3]
@@ -0,0 +1,93 @@
+import threading
+from datetime import date, datetime
+
+import utils.db
+from utils.settings import database
+
+from utils.db import User, Payment, load_user, check_spending_summary
+from utils.dates import WEEKLY, MONTHLY, YEARLY
+
+
+def create_user(telegram_id: int = 1) -> User:
+    User.create_or_update(telegram_id, 'user')
+    return load_user(telegram_id)
+
+
+def test_upcoming_charges_by_next_due(db, scheduler, monkeypatch):
+    monkeypatch.setattr(utils.db, 'get_local_now', lambda: datetime(2026, 10, 18, 12))
+    user = create_user()
+    today = date(2026, 10, 18)
+    user.import_payments([
+        {'name': 'Music', 'description': '', 'price': 10, 'date': date(2026, 1, 25), 'notification_days': []},
+        {'name': 'Cloud', 'description': '', 'price': 2, 'date': date(2026, 1, 20), 'notification_days': []},
+        {'name': 'Gym', 'description': '', 'price': 5, 'date': date(2026, 10, 1), 'period': WEEKLY,
+         'notification_days': []},
+        {'name': 'Domain', 'description': '', 'price': 15, 'date': date(2026, 3, 1), 'period': YEARLY,
+         'notification_days': []},
+    ])
+    # stored dates are from the import day, the view moves the passed ones on
+    Payment.update(next_due=date(2026, 10, 1)).where(Payment.name == 'Gym').execute()
+
+    charges, count, total = user.get_upcoming_charges(today, days=30, limit=2)
+    assert [(p.name, day) for day, p in charges] == [('Cloud', date(2026, 10, 20)), ('Gym', date(2026, 10, 22))]
+    # the weekly payment is charged four times till 17.11
+    assert (count, total) == (6, 32)
+    assert Payment.get(Payment.name == 'Gym').next_due == date(2026, 10, 22)
+
+    charges, _, _ = user.get_upcoming_charges(today, days=30, limit=4)
+    assert [(p.name, day) for day, p in charges] == [
+        ('Cloud', date(2026, 10, 20)), ('Gym', date(2026, 10, 22)), ('Music', date(2026, 10, 25)),
+        ('Gym', date(2026, 10, 29)),
+    ]
+
+
+def test_added_payment_has_next_due(db, scheduler):
+    payment = create_user().add_payment('Music', '', 10, date(2020, 1, 31), MONTHLY)
+    assert Payment.get_by_id(payment.id).next_due >= date.today()
+
+
+def test_summary_follows_added_and_deleted_payments(db, scheduler):
+    user = create_user()
+    music = user.add_payment('Music', '', 10, date(2026, 1, 5), MONTHLY)
+    user.add_payment('Cloud', '', 2.5, date(2026, 1, 20), MONTHLY)
+    domain = user.add_payment('Domain', '', 15, date(2026, 3, 1), YEARLY)
+    user.get_payment(music.id).delete_instance(True)
+    user.get_payment(domain.id).delete_instance(True)
+
+    periods, top_payments = user.get_summary()
+    assert [(row.period, row.total, row.payments) for row in periods] == [(MONTHLY, 2.5, 1)]
+    assert [payment.name for payment in top_payments] == ['Cloud']
+    assert check_spending_summary() == 0
+
+
+def test_get_payment_with_notifications(db, scheduler):
+    user = create_user()
+    payment = user.add_payment('Music', '', 10, date(2026, 1, 5), MONTHLY)
+    assert user.get_payment(payment.id).notifications == []
+    payment.add_notification(3)
+    payment.add_notification(1)
+    loaded = user.get_payment(payment.id)
+    assert [n.day_before_payment for n in loaded.notifications] == [3, 1]
+    assert create_user(2).get_payment(payment.id) is None
+
+
+def test_moving_passed_charges_on_survives_concurrent_writer(db, scheduler, monkeypatch):
+    user = create_user()
+    user.add_payment('Music', '', 10, date(2026, 1, 5), MONTHLY)
+    Payment.update(next_due=date(2026, 1, 5)).execute()
+    writers = []
+
+    def set_next_due_dates(payments, on_or_after):
+        # another connection commits between the read of passed dates and their update
+        writer = threading.Thread(target=lambda: (database.connect(), create_user(2), database.close()))
+        writer.start()
+        writer.join(timeout=0.5)  # it waits for our write lock, if there is one
+        writers.append(writer)
+        set_next_due(payments, on_or_after)
+
+    set_next_due = utils.db.set_next_due_dates
+    monkeypatch.setattr(utils.db, 'set_next_due_dates', set_next_due_dates)
+    charges, count, total = user.get_upcoming_charges(date(2026, 10, 18), days=30, limit=20)
+    writers[0].join()
+    assert [(p.name, day) for day, p in charges] == [('Music', date(2026, 11, 5))]
+    assert User.select().count() == 2
@@ -0,0 +1,56 @@
+import asyncio
+from datetime import date
+
+from aiogram import types
+
+from utils.settings import dp, QUERIES_PER_UPDATE_LIMIT
+from utils.queries import count_queries
+from utils.db import User, Payment, load_user
+import src.main_bot  # noqa: F401, registers handlers
+from tools.fake_telegram import make_message_update, make_callback_update
+
+
+TELEGRAM_ID = 1
+NOTIFICATION_DAY = 3
+
+
+def get_user_flow(payment_id: int) -> list[tuple[str, dict]]:
+    return [
+        ('start', make_message_update(TELEGRAM_ID, '/start')),
+        ('payment_list', make_callback_update(TELEGRAM_ID, 'id:show_payments')),
+        ('payment_view', make_callback_update(TELEGRAM_ID, f'view:{payment_id}')),
+        ('notification_add_menu', make_callback_update(TELEGRAM_ID, 'notification:add')),
+        ('notification_add', make_callback_update(TELEGRAM_ID, f'notification:{NOTIFICATION_DAY}')),
+        ('notification_delete_menu', make_callback_update(TELEGRAM_ID, 'notification:delete')),
+        ('notification_delete', make_callback_update(TELEGRAM_ID, f'notification:{NOTIFICATION_DAY}')),
+        ('payment_back', make_callback_update(TELEGRAM_ID, 'payment:back')),
+        ('payment_add_menu', make_callback_update(TELEGRAM_ID, 'payment:add')),
+        ('payment_add', make_message_update(TELEGRAM_ID, 'Added,Added payment,99.9,2020-01-20')),
+        ('payment_delete', make_callback_update(TELEGRAM_ID, 'payment:delete')),
+        ('main_menu', make_callback_update(TELEGRAM_ID, 'id:back')),
+        ('summary', make_callback_update(TELEGRAM_ID, 'id:summary')),
+        ('upcoming', make_callback_update(TELEGRAM_ID, 'id:upcoming')),
+    ]
+
+
+def test_handlers_stay_within_query_limit(api):
+    User.create_or_update(TELEGRAM_ID, 'user')
+    load_user(TELEGRAM_ID).import_payments([
+        {'name': f'Payment {n}', 'description': '', 'price': 100 + n, 'date': date(2020, 1, 1 + n),
+         'notification_days': [1]}
+        for n in range(3)
+    ])
+    payment_id = Payment.select(Payment.id).order_by(Payment.id).first().id
+
+    async def main():
+        queries = {}
+        for step, update in get_user_flow(payment_id):
+            api.calls.clear()
+            with count_queries() as counter:
+                await dp.process_updates([types.Update(**update)])
+            assert api.calls, f'{step} was not handled'
+            queries[step] = counter.count
+        return queries
+
+    queries = asyncio.run(main())
+    assert max(queries.values()) <= QUERIES_PER_UPDATE_LIMIT, queries
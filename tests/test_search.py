@@ -0,0 +1,33 @@
+from datetime import date
+
+from utils.db import User, Payment, load_user
+
+
+def add_payments(telegram_id: int, *payments: tuple[str, str]) -> User:
+    User.create_or_update(telegram_id, f'user{telegram_id}')
+    user = load_user(telegram_id)
+    for name, description in payments:
+        user.add_payment(name, description, 10, date(2026, 1, 5))
+    return user
+
+
+def search(user: User, text: str) -> list[str]:
+    return [payment.name for payment in user.search_payments(text)]
+
+
+def test_words_match_by_prefix_in_name_or_description(db, scheduler):
+    user = add_payments(1, ('Music', 'Family plan'), ('Cloud', 'Photo storage'), ('Internet', 'Home fiber'))
+    assert search(user, 'mus') == ['Music']
+    assert search(user, 'photo stor') == ['Cloud']
+    assert search(user, 'home music') == []
+    assert search(user, '') == []
+    assert search(user, '"mus*(') == ['Music']  # query syntax is not passed to FTS5
+
+
+def test_search_sees_only_own_and_existing_payments(db, scheduler):
+    user = add_payments(1, ('Music', 'Family plan'), ('Cloud', 'Music backup'))
+    add_payments(2, ('Music', 'Student plan'))
+    # the name weighs more than the description
+    assert search(user, 'music') == ['Music', 'Cloud']
+    user.get_payment(Payment.get(Payment.name == 'Music', Payment.user == user.id).id).delete_instance(True)
+    assert search(user, 'music') == ['Cloud']
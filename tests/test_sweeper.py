@@ -0,0 +1,59 @@
+import threading
+from datetime import date, datetime, timedelta
+
+import src.sweeper
+
+from utils import metrics
+from utils.settings import database
+from utils.db import User, Notification, OutboxMessage, load_user
+from src.sweeper import enqueue_due_notifications
+
+
+def add_notifications(*due_dates: datetime) -> list[Notification]:
+    User.create_or_update(1, 'user')
+    payment = load_user(1).add_payment('Music', 'Subscription', 10, date(2026, 1, 5))
+    notifications = []
+    for days_before, due_at in enumerate(due_dates, start=1):
+        notification = Notification.create(payment=payment, day_before_payment=days_before, next_fire_at=due_at)
+        notifications.append(notification)
+    return notifications
+
+
+def test_due_notifications_go_to_outbox(db):
+    now = datetime(2026, 10, 18, 12)
+    on_time, = add_notifications(now - timedelta(minutes=1))
+    assert enqueue_due_notifications(now, missed_before=now - timedelta(hours=1)) == 1
+    assert [row.notification_id for row in OutboxMessage.select()] == [on_time.id]
+    assert Notification.get_by_id(on_time.id).next_fire_at > now
+
+
+def test_late_notifications_are_counted_as_missed(db, caplog):
+    now = datetime(2026, 10, 18, 12)
+    on_time, late = add_notifications(now - timedelta(minutes=1), now - timedelta(days=2))
+    missed = metrics.notification_count.get(status='missed')
+    assert enqueue_due_notifications(now, missed_before=now - timedelta(hours=1)) == 2
+    assert [row.notification_id for row in OutboxMessage.select()] == [on_time.id]
+    assert metrics.notification_count.get(status='missed') == missed + 1
+    assert f'{late.id} due at' in caplog.text
+    assert Notification.get_by_id(late.id).next_fire_at > now
+
+
+def test_sweep_survives_concurrent_writer(db, monkeypatch):
+    now = datetime(2026, 10, 18, 12)
+    notification, = add_notifications(now - timedelta(minutes=1))
+    writers = []
+
+    def get_notification_text(*args):
+        # a handler commits between the read of due notifications and the outbox write
+        writer = threading.Thread(target=lambda: (database.connect(), User.create_or_update(2, 'x'), database.close()))
+        writer.start()
+        writer.join(timeout=0.5)  # it waits for the sweeper's write lock
+        writers.append(writer)
+        return get_text(*args)
+
+    get_text = src.sweeper.get_notification_text
+    monkeypatch.setattr(src.sweeper, 'get_notification_text', get_notification_text)
+    assert enqueue_due_notifications(now, missed_before=now - timedelta(hours=1)) == 1
+    writers[0].join()
+    assert [row.notification_id for row in OutboxMessage.select()] == [notification.id]
+    assert User.select().count() == 2
@@ -0,0 +1,51 @@
+import utils.ttl_cache
+from utils.ttl_cache import TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def make_cache(monkeypatch, maxsize: int = 3, ttl: float = 10) -> tuple[TTLCache, Clock]:
+    clock = Clock()
+    monkeypatch.setattr(utils.ttl_cache.time, 'monotonic', clock.monotonic)
+    return TTLCache(maxsize=maxsize, ttl=ttl), clock
+
+
+def test_least_recently_used_is_evicted(monkeypatch):
+    cache, _ = make_cache(monkeypatch)
+    for key in 'abc':
+        cache.set(key, key.upper())
+    assert cache.get('a') == 'A'
+    cache.set('d', 'D')
+    assert 'b' not in cache
+    assert [cache.get(key) for key in 'acd'] == ['A', 'C', 'D']
+    assert cache.get_stats() == {'size': 3, 'hits': 4, 'misses': 0, 'evictions': 1}
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    cache, clock = make_cache(monkeypatch)
+    cache.set('a', 1)
+    clock.now = 5
+    cache.set('b', 2)
+    clock.now = 10
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    clock.now = 15
+    assert cache.expire() == 1
+    assert len(cache) == 0
+
+
+def test_rewrite_extends_ttl(monkeypatch):
+    cache, clock = make_cache(monkeypatch)
+    cache.set('a', 1)
+    clock.now = 8
+    cache.set('a', 2)
+    clock.now = 12
+    assert cache.get('a') == 2
+    assert cache.pop('a') == 2
+    assert cache.get('a', 'missing') == 'missing'
@@ -0,0 +1,236 @@
+"""Load test for the bot handlers against the fake Bot API.
+
+Seeds a temporary database with N users having M payments each, then every
+user goes through the main flows concurrently: /start, payment list, payment
+view, add/delete notification and add/delete payment.
+
+    python -m tools.benchmark --users 200 --payments 10 --output bench.json
+
+Results are printed and written as JSON, so runs of different commits can be
+compared. Nothing is sent to Telegram: the bot talks to `FakeBotAPI`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from datetime import date
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
+
+from utils.settings import logging, dp, database, DATABASE_PRAGMAS, FSM_FLUSH_INTERVAL, FSM_CACHE_SIZE
+from utils.fsm_storage import SQLiteStorage
+from utils.queries import count_queries
+from utils.metrics import InstrumentedBot, count_api_calls
+from utils.cache import user_cache
+from utils.db import User, Payment, load_user, connect_db, initialize_db
+from migrations import run_migrations
+from src.scheduler import scheduler
+from src.middlewares import ThrottlingMiddleware
+import src.main_bot  # noqa: F401, registers handlers
+from tools.fake_telegram import FakeBotAPI, make_message_update, make_callback_update
+
+
+FIRST_TELEGRAM_ID = 10_000_000
+BOT_TOKEN = '123456:BENCHMARK'  # well-formed, only the fake Bot API sees it
+NOTIFICATION_DAY = 3
+
+
+def get_user_flow(telegram_id: int, payment_ids: list[int]) -> list[tuple[str, dict]]:
+    view = payment_ids[telegram_id % len(payment_ids)]
+    return [
+        ('start', make_message_update(telegram_id, '/start')),
+        ('payment_list', make_callback_update(telegram_id, 'id:show_payments')),
+        ('payment_view', make_callback_update(telegram_id, f'view:{view}')),
+        ('notification_add_menu', make_callback_update(telegram_id, 'notification:add')),
+        ('notification_add', make_callback_update(telegram_id, f'notification:{NOTIFICATION_DAY}')),
+        ('notification_delete_menu', make_callback_update(telegram_id, 'notification:delete')),
+        ('notification_delete', make_callback_update(telegram_id, f'notification:{NOTIFICATION_DAY}')),
+        ('payment_back', make_callback_update(telegram_id, 'payment:back')),
+        ('payment_add_menu', make_callback_update(telegram_id, 'payment:add')),
+        ('payment_add', make_message_update(telegram_id, 'Bench,Bench payment,99.9,2020-01-20')),
+        ('payment_delete', make_callback_update(telegram_id, 'payment:delete')),
+        ('main_menu', make_callback_update(telegram_id, 'id:back')),
+    ]
+
+
+def seed(users: int, payments: int) -> dict[int, list[int]]:
+    """Users with payments and one notification per payment, added by the model methods.
+
+    So the spending summary and the other derived tables are filled as in use.
+    Returns payment ids of every user by telegram id.
+    """
+    for i in range(users):
+        telegram_id = FIRST_TELEGRAM_ID + i
+        User.create_or_update(telegram_id, f'user{i}')
+        load_user(telegram_id).import_payments([
+            {'name': f'Payment {n}', 'description': f'Benchmark payment {n}', 'price': 100 + n,
+             'date': date(2020, 1, 1 + n % 28), 'notification_days': [1]}
+            for n in range(payments)
+        ])
+    # the scheduler is not started, jobs queued by the import are not needed
+    scheduler.remove_all_jobs()
+    rows = Payment.select(Payment.id, User.telegram_id).join(User).order_by(Payment.id).tuples()
+    user_payments: dict[int, list[int]] = defaultdict(list)
+    for payment_id, telegram_id in rows:
+        user_payments[telegram_id].append(payment_id)
+    return user_payments
+
+
+def percentile(values: list[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def get_latency_stats(latencies: list[float]) -> dict[str, float]:
+    return {
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'max': max(latencies, default=0.0) * 1000,
+    }
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+class Benchmark:
+    def __init__(self, user_payments: dict[int, list[int]], payments: int, concurrency: int):
+        self.user_payments = user_payments
+        self.users = len(user_payments)
+        self.payments = payments
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.queries: dict[str, list[int]] = defaultdict(list)
+        self.api_calls: dict[str, list[int]] = defaultdict(list)
+        self.errors = 0
+
+    async def process(self, step: str, update: dict) -> None:
+        started_at = time.perf_counter()
+        with count_queries() as counter, count_api_calls() as api_counter:
+            try:
+                await dp.process_updates([types.Update(**update)])
+            except Exception:
+                self.errors += 1
+        self.latencies[step].append(time.perf_counter() - started_at)
+        self.queries[step].append(counter.count)
+        self.api_calls[step].append(api_counter.count)
+
+    async def run_user(self, telegram_id: int) -> None:
+        async with self.semaphore:
+            for step, update in get_user_flow(telegram_id, self.user_payments[telegram_id]):
+                await self.process(step, update)
+
+    async def run(self) -> float:
+        started_at = time.perf_counter()
+        await asyncio.gather(*(
+            self.run_user(telegram_id) for telegram_id in self.user_payments
+        ))
+        return time.perf_counter() - started_at
+
+    def get_results(self, duration: float) -> dict:
+        latencies = [value for values in self.latencies.values() for value in values]
+        queries = [value for values in self.queries.values() for value in values]
+        api_calls = [value for values in self.api_calls.values() for value in values]
+        updates = len(latencies)
+        return {
+            'commit': get_commit(),
+            'users': self.users,
+            'payments_per_user': self.payments,
+            'updates': updates,
+            'errors': self.errors,
+            'duration_sec': duration,
+            'updates_per_sec': updates / duration if duration else 0.0,
+            'latency_ms': get_latency_stats(latencies),
+            'queries_per_update': {
+                'mean': sum(queries) / updates if updates else 0.0,
+                'max': max(queries, default=0),
+            },
+            'api_calls_per_update': {
+                'mean': sum(api_calls) / updates if updates else 0.0,
+                'max': max(api_calls, default=0),
+            },
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'steps': {
+                step: {
+                    'latency_ms': get_latency_stats(self.latencies[step]),
+                    'queries_per_update': sum(self.queries[step]) / len(self.queries[step]),
+                    'api_calls_per_update': sum(self.api_calls[step]) / len(self.api_calls[step]),
+                }
+                for step in self.latencies
+            },
+        }
+
+
+async def run_benchmark(user_payments: dict[int, list[int]], payments: int,
+                        concurrency: int, api_port: int) -> dict:
+    api = FakeBotAPI()
+    runner = await api.start(port=api_port)
+    bot = InstrumentedBot(BOT_TOKEN, server=TelegramAPIServer.from_base(f'http://127.0.0.1:{api_port}'))
+    dp.bot = bot
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    benchmark = Benchmark(user_payments, payments, concurrency)
+    try:
+        duration = await benchmark.run()
+    finally:
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        await (await bot.get_session()).close()
+        await runner.cleanup()
+    return benchmark.get_results(duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--payments', type=int, default=5, help='payments per user, at least 1')
+    parser.add_argument('--concurrency', type=int, default=50, help='users in flight at once')
+    parser.add_argument('--port', type=int, default=8081, help='fake Bot API port')
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+    # simulated users tap much faster than people, the per-user limit would drop their updates
+    for middleware in dp.middleware.applications:
+        if isinstance(middleware, ThrottlingMiddleware):
+            middleware.rate_limit = float('inf')
+
+    with tempfile.TemporaryDirectory() as directory:
+        database.init(os.path.join(directory, 'benchmark.db'), pragmas=DATABASE_PRAGMAS)
+        dp.storage = SQLiteStorage(
+            os.path.join(directory, 'fsm.db'),
+            flush_interval=FSM_FLUSH_INTERVAL,
+            cache_size=FSM_CACHE_SIZE,
+        )
+        connect_db()
+        run_migrations()
+        initialize_db()
+        payments = max(args.payments, 1)
+        user_payments = seed(args.users, payments)
+        user_cache.clear()
+        results = asyncio.run(run_benchmark(user_payments, payments, args.concurrency, args.port))
+        database.close()
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
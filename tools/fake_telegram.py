@@ -0,0 +1,153 @@
+"""Local stand-ins for Telegram: a fake Bot API server and a webhook update sender.
+
+Start the fake side first, it waits until the bot webhook is up:
+
+    python -m tools.fake_telegram http://127.0.0.1:8080/webhook
+
+then run the bot with `TELEGRAM_API_URL = 'http://127.0.0.1:8081'` in local
+settings as `python main.py webhook`.
+"""
+import asyncio
+import itertools
+import json
+import sys
+import time
+from typing import Optional
+
+from aiohttp import ClientSession, web
+
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'P4S', 'username': 'p4s_bot'}
+
+
+class FakeBotAPI:
+    """Answers every Bot API method with a plausible result and records the calls."""
+
+    def __init__(self):
+        self.calls: list[tuple[str, dict]] = []
+        self._message_ids = itertools.count(1000)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8081) -> web.AppRunner:
+        runner = web.AppRunner(self.make_app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        data = dict(await request.post())
+        self.calls.append((method, data))
+        return web.json_response({'ok': True, 'result': self.get_result(method, data)})
+
+    def get_result(self, method: str, data: dict):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            return []
+        if method == 'getWebhookInfo':
+            return {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        if method in ('sendMessage', 'editMessageText', 'sendDocument'):
+            chat_id = int(data.get('chat_id', 0))
+            return {
+                'message_id': int(data.get('message_id', next(self._message_ids))),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': data.get('text', ''),
+            }
+        return True
+
+
+_update_ids = itertools.count(1)
+
+
+def make_message_update(telegram_id: int, text: str) -> dict:
+    message = {
+        'message_id': next(_update_ids),
+        'date': int(time.time()),
+        'chat': {'id': telegram_id, 'type': 'private'},
+        'from': {'id': telegram_id, 'is_bot': False, 'first_name': 'User', 'username': f'user{telegram_id}'},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': next(_update_ids), 'message': message}
+
+
+def make_callback_update(telegram_id: int, data: str, message_id: int = 1) -> dict:
+    return {
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(next(_update_ids)),
+            'chat_instance': str(telegram_id),
+            'data': data,
+            'from': {'id': telegram_id, 'is_bot': False, 'first_name': 'User'},
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': telegram_id, 'type': 'private'},
+                'text': '',
+            },
+        },
+    }
+
+
+async def post_updates(url: str, updates: list[dict]) -> list[tuple[int, str]]:
+    """POST updates to the webhook one by one, like Telegram does for a single chat."""
+    responses = []
+    async with ClientSession() as session:
+        for update in updates:
+            async with session.post(url, json=update) as response:
+                responses.append((response.status, await response.text()))
+    return responses
+
+
+def get_demo_flow(telegram_id: int) -> list[dict]:
+    return [
+        make_message_update(telegram_id, '/start'),
+        make_callback_update(telegram_id, 'id:show_payments'),
+        make_callback_update(telegram_id, 'payment:add'),
+        make_message_update(telegram_id, 'Demo,Demo service,100,2020-01-15'),
+        make_callback_update(telegram_id, 'payment:back'),
+    ]
+
+
+async def wait_for_webhook(url: str, timeout: float = 60) -> None:
+    """Poll `url` until it answers 200, TimeoutError if it does not within `timeout` seconds."""
+    deadline = time.monotonic() + timeout
+    async with ClientSession() as session:
+        while True:
+            error: Optional[OSError] = None
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return
+                    status = response.status
+            except OSError as exc:
+                error, status = exc, None
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'Webhook {url} is not ready after {timeout} sec, last status {status}') from error
+            await asyncio.sleep(0.5)
+
+
+async def run_demo(webhook_url: str, api_port: int = 8081) -> None:
+    """Start fake Bot API, wait for the bot webhook and send a demo conversation."""
+    api = FakeBotAPI()
+    runner = await api.start(port=api_port)
+    try:
+        await wait_for_webhook(webhook_url)
+        api.calls.clear()
+        for status, body in await post_updates(webhook_url, get_demo_flow(42)):
+            print(status, body)
+        print(json.dumps([method for method, _ in api.calls]))
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(run_demo(sys.argv[1] if len(sys.argv) > 1 else 'http://127.0.0.1:8080/webhook'))
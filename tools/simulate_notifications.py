@@ -0,0 +1,266 @@
+"""Time-travel simulation of notification jobs against the fake Bot API.
+
+Seeds a temporary database with N users having M payments each through the
+models, registers the notification jobs as the bot does on start, then runs
+the scheduler over a date range on a virtual clock. Every scheduler wakeup
+happens at once: the clock jumps to the next due job instead of waiting.
+
+    python -m tools.simulate_notifications --users 1000 --payments 5 --days 31 --output simulation.json
+
+Notifications go through the delivery queue to `FakeBotAPI`, nothing is sent
+to Telegram. Reports jobs fired per wakeup, the peak burst, CPU time spent
+by the scheduler and memory per registered job. Runs the 'cron' notification
+mode, where every notification is a scheduler job.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+from contextlib import ExitStack
+from datetime import date, datetime, timedelta
+from typing import Optional
+from unittest import mock
+
+import apscheduler.executors.base
+import apscheduler.executors.base_py3
+import apscheduler.schedulers.base
+from aiogram import Bot
+from aiogram.bot.api import TelegramAPIServer
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED
+from apscheduler.executors.asyncio import AsyncIOExecutor
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+import utils.dates
+import utils.db
+import src.delivery
+from utils.settings import logging, bot, database, DATABASE_PRAGMAS, NOTIFICATION_MODE, TIMEZONE
+from utils.cache import user_cache
+from utils.dates import PERIODS
+from utils.db import User, connect_db, initialize_db, load_user, rehydrate_jobs
+from migrations import run_migrations
+from src.delivery import DeliveryQueue
+from src.scheduler import scheduler as bot_scheduler, job_defaults
+from tools.benchmark import get_commit, percentile
+from tools.fake_telegram import FakeBotAPI
+
+
+FIRST_TELEGRAM_ID = 10_000_000
+PERIOD_WEIGHTS = (5, 70, 10, 15)  # weekly, monthly, quarterly, yearly
+NOTIFICATION_DAYS = range(1, 11)  # as offered by the bot keyboard
+DELIVERY_RATE = 1_000_000  # the limit is per real second, which the simulation does not spend
+
+
+class VirtualClock:
+    def __init__(self, now: datetime):
+        self.now = now
+
+
+class VirtualTimeScheduler(AsyncIOScheduler):
+    """Scheduler which never waits: the simulation calls `tick` at the time of the next due job."""
+
+    next_wait: Optional[float] = None
+
+    def _start_timer(self, wait_seconds):
+        self.next_wait = wait_seconds
+
+    def tick(self) -> None:
+        """Run due jobs right away, unlike `wakeup` which is deferred to the event loop."""
+        self._start_timer(self._process_jobs())
+
+
+def get_virtual_datetime(clock: VirtualClock) -> type:
+    class VirtualDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return clock.now.astimezone(tz) if tz else clock.now.replace(tzinfo=None)
+
+    return VirtualDatetime
+
+
+def virtual_time(clock: VirtualClock) -> ExitStack:
+    """Make the scheduler, its executors and `get_local_now` read the virtual clock."""
+    virtual_datetime = get_virtual_datetime(clock)
+    stack = ExitStack()
+    for module in (apscheduler.schedulers.base, apscheduler.executors.base,
+                   apscheduler.executors.base_py3, utils.dates):
+        stack.enter_context(mock.patch.object(module, 'datetime', virtual_datetime))
+    return stack
+
+
+def seed(users: int, payments: int, notifications: int, start: date, rng: random.Random) -> None:
+    """Users with payments charged since up to a year before `start`, each with 1..N notifications."""
+    for i in range(users):
+        telegram_id = FIRST_TELEGRAM_ID + i
+        User.create_or_update(telegram_id, f'user{i}')
+        rows = [
+            {'name': f'Payment {n}', 'description': f'Simulated payment {n}', 'price': 100 + n,
+             'date': start - timedelta(days=rng.randrange(365)),
+             'period': rng.choices(PERIODS, weights=PERIOD_WEIGHTS)[0],
+             'notification_days': sorted(rng.sample(NOTIFICATION_DAYS, rng.randint(1, notifications)))}
+            for n in range(payments)
+        ]
+        load_user(telegram_id).import_payments(rows)
+    user_cache.clear()
+
+
+class Simulation:
+    def __init__(self, scheduler: VirtualTimeScheduler, clock: VirtualClock, api: FakeBotAPI):
+        self.scheduler = scheduler
+        self.clock = clock
+        self.api = api
+        self.submitted = 0
+        self.finished = 0
+        self.missed = 0
+        self.ticks: list[dict] = []
+        scheduler.add_listener(self.on_submitted, EVENT_JOB_SUBMITTED)
+        scheduler.add_listener(self.on_finished, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+        scheduler.add_listener(self.on_missed, EVENT_JOB_MISSED)
+
+    def on_submitted(self, event) -> None:
+        self.submitted += 1
+
+    def on_finished(self, event) -> None:
+        self.finished += 1
+
+    def on_missed(self, event) -> None:
+        self.missed += 1
+
+    def get_sent(self) -> int:
+        return sum(method == 'sendMessage' for method, _ in self.api.calls)
+
+    async def run(self, end: datetime, queue: DeliveryQueue) -> None:
+        while self.scheduler.next_wait is not None:
+            self.clock.now += timedelta(seconds=self.scheduler.next_wait)
+            if self.clock.now >= end:
+                break
+            submitted, sent = self.submitted, self.get_sent()
+            started_at = time.process_time()
+            self.scheduler.tick()
+            cpu_time = time.process_time() - started_at
+            # coroutine jobs run as tasks, then their messages go through the queue
+            while self.finished < self.submitted:
+                await asyncio.sleep(0)
+            await queue.join()
+            self.ticks.append({
+                'at': self.clock.now.isoformat(),
+                'jobs': self.submitted - submitted,
+                'sent': self.get_sent() - sent,
+                'cpu_ms': cpu_time * 1000,
+            })
+
+
+async def run_simulation(start: datetime, end: datetime, clock: VirtualClock,
+                         workers: int, api_port: int) -> dict:
+    api = FakeBotAPI()
+    runner = await api.start(port=api_port)
+    bot.server = TelegramAPIServer.from_base(f'http://127.0.0.1:{api_port}')
+    Bot.set_current(bot)
+    scheduler = VirtualTimeScheduler(
+        jobstores={'default': MemoryJobStore()},
+        executors={'default': AsyncIOExecutor()},
+        job_defaults=job_defaults,
+        timezone=TIMEZONE,
+    )
+    queue = DeliveryQueue(rate=DELIVERY_RATE, workers=workers, spread_window=0)
+    # models and `send_notification` look both up at call time
+    with mock.patch.object(utils.db, 'scheduler', scheduler), \
+            mock.patch.object(src.delivery, 'delivery_queue', queue):
+        scheduler.start()
+        queue.start()
+        # tracing allocations slows registration down, so it is timed on a second pass
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        jobs = await rehydrate_jobs()
+        memory_per_job = (tracemalloc.get_traced_memory()[0] - memory_before) / jobs if jobs else 0.0
+        tracemalloc.stop()
+        scheduler.remove_all_jobs()
+        started_at = time.process_time()
+        await rehydrate_jobs()
+        registration_cpu = time.process_time() - started_at
+        scheduler.tick()
+
+        simulation = Simulation(scheduler, clock, api)
+        try:
+            await simulation.run(end, queue)
+        finally:
+            await queue.stop()
+            scheduler.shutdown(wait=False)
+            await asyncio.sleep(0)  # shutdown runs on the loop
+            await (await bot.get_session()).close()
+            await runner.cleanup()
+
+    jobs_per_tick = [tick['jobs'] for tick in simulation.ticks]
+    cpu_time = sum(tick['cpu_ms'] for tick in simulation.ticks) / 1000
+    peak = max(simulation.ticks, key=lambda tick: tick['jobs'], default=None)
+    return {
+        'commit': get_commit(),
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'registered_jobs': jobs,
+        'registration_cpu_sec': registration_cpu,
+        'memory_per_job_bytes': memory_per_job,
+        'ticks': len(simulation.ticks),
+        'jobs_fired': simulation.submitted,
+        'jobs_missed': simulation.missed,
+        'notifications_sent': simulation.get_sent(),
+        'jobs_per_tick': {
+            'mean': sum(jobs_per_tick) / len(jobs_per_tick) if jobs_per_tick else 0.0,
+            'p95': percentile(jobs_per_tick, 95),
+            'max': max(jobs_per_tick, default=0),
+        },
+        'peak_burst': peak,
+        'scheduling_cpu_sec': cpu_time,
+        'scheduling_cpu_per_job_us': cpu_time / simulation.submitted * 1e6 if simulation.submitted else 0.0,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'timeline': simulation.ticks,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--payments', type=int, default=5, help='payments per user')
+    parser.add_argument('--notifications', type=int, default=2, help='at most per payment, at least 1')
+    parser.add_argument('--start', type=date.fromisoformat, default=None, help='YYYY-MM-DD, today by default')
+    parser.add_argument('--days', type=int, default=31)
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the population')
+    parser.add_argument('--workers', type=int, default=4, help='delivery workers')
+    parser.add_argument('--port', type=int, default=8082, help='fake Bot API port')
+    parser.add_argument('--output', default='simulation.json')
+    args = parser.parse_args()
+    if NOTIFICATION_MODE != 'cron':
+        parser.error('notification jobs are simulated in the "cron" NOTIFICATION_MODE only')
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+    logging.getLogger('apscheduler').setLevel(logging.WARNING)
+
+    start_day = args.start or datetime.now(TIMEZONE).date()
+    start = TIMEZONE.localize(datetime.combine(start_day, datetime.min.time()))
+    end = TIMEZONE.localize(datetime.combine(start_day + timedelta(days=args.days), datetime.min.time()))
+    clock = VirtualClock(start)
+    with tempfile.TemporaryDirectory() as directory, virtual_time(clock):
+        database.init(os.path.join(directory, 'simulation.db'), pragmas=DATABASE_PRAGMAS)
+        connect_db()
+        run_migrations()
+        initialize_db()
+        seed(args.users, args.payments, max(args.notifications, 1), start_day, random.Random(args.seed))
+        # the import queued jobs in the bot scheduler, which is not started; the simulated
+        # one registers them again by rehydration, as the bot does on start
+        bot_scheduler.remove_all_jobs()
+        results = asyncio.run(run_simulation(start, end, clock, args.workers, args.port))
+        results.update(users=args.users, payments_per_user=args.payments)
+        database.close()
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(json.dumps({key: value for key, value in results.items() if key != 'timeline'}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import asyncio
+import contextvars
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from utils.settings import logging, database, DB_POOL_SIZE, LOOP_MONITOR_INTERVAL, LOOP_LAG_WARNING
+
+
+logger = logging.getLogger(__name__)
+
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='db')
+
+
+def _call_with_connection(func: Callable, *args, **kwargs):
+    # peewee keeps connection state per thread, so every worker opens its own once
+    database.connect(reuse_if_open=True)
+    return func(*args, **kwargs)
+
+
+async def run_db(func: Callable, *args, **kwargs):
+    """Run blocking database code in the DB thread pool instead of the event loop.
+
+    The current context is copied, so queries are still counted for the update.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, _call_with_connection, func, *args, **kwargs)
+    return await loop.run_in_executor(db_executor, call)
+
+
+class LoopMonitor:
+    """Measures how late the event loop wakes up a task which sleeps `interval` seconds."""
+
+    def __init__(self, interval: float = LOOP_MONITOR_INTERVAL):
+        self.interval = interval
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.samples = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            started_at = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - started_at - self.interval
+            self.samples += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag > LOOP_LAG_WARNING:
+                logger.warning(f'Event loop was blocked for {lag:.3f} sec')
+
+    def get_stats(self) -> dict[str, float]:
+        return {
+            'samples': self.samples,
+            'max_lag': self.max_lag,
+            'avg_lag': self.total_lag / self.samples if self.samples else 0.0,
+        }
+
+
+loop_monitor = LoopMonitor()
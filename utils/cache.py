@@ -0,0 +1,23 @@
+from typing import Any, Hashable
+
+from utils.settings import CACHE_CLEAR_TIMER, CACHE_MAX_ENTRIES, VIEW_CACHE_MAX_ENTRIES
+from utils.ttl_cache import TTLCache  # noqa: F401, imported from here by the rest of the bot
+
+
+user_cache = TTLCache(maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_CLEAR_TIMER)
+# telegram id -> {view key: rendered view}, views are dropped by the model methods changing them
+view_cache = TTLCache(maxsize=VIEW_CACHE_MAX_ENTRIES, ttl=CACHE_CLEAR_TIMER)
+
+
+def get_views(telegram_id: int) -> dict[Hashable, Any]:
+    views = view_cache.get(telegram_id)
+    if views is None:
+        views = {}
+        view_cache.set(telegram_id, views)
+    return views
+
+
+def invalidate_view(telegram_id: int, *keys: Hashable) -> None:
+    if (views := view_cache.get(telegram_id)) is not None:
+        for key in keys:
+            views.pop(key, None)
@@ -0,0 +1,75 @@
+from datetime import date, datetime, time
+from typing import Sequence, Union
+
+import numpy as np
+
+from utils.settings import TIMEZONE, NOTIFICATION_HOUR
+
+
+WEEKLY, MONTHLY, QUARTERLY, YEARLY = 'weekly', 'monthly', 'quarterly', 'yearly'
+PERIODS = (WEEKLY, MONTHLY, QUARTERLY, YEARLY)
+PERIOD_MONTHS = {WEEKLY: 0, MONTHLY: 1, QUARTERLY: 3, YEARLY: 12}  # 0 means the step is in days
+PERIODS_PER_MONTH = {WEEKLY: 52 / 12, MONTHLY: 1, QUARTERLY: 1 / 3, YEARLY: 1 / 12}
+
+DateArray = np.ndarray  # datetime64[D]
+
+
+def get_local_now() -> datetime:
+    """Current time in bot timezone without tzinfo, as it is stored in the database."""
+    return datetime.now(TIMEZONE).replace(tzinfo=None)
+
+
+def _clamp_to_month(months: np.ndarray, day_offsets: np.ndarray) -> DateArray:
+    """Day `day_offsets + 1` of every month, or its last day if the month is shorter."""
+    first_days = months.astype('datetime64[D]')
+    last_days = (months + np.timedelta64(1, 'M')).astype('datetime64[D]') - np.timedelta64(1, 'D')
+    return np.minimum(first_days + day_offsets.astype('timedelta64[D]'), last_days)
+
+
+def get_next_due_dates(anchors: Sequence[date], periods: Sequence[str],
+                       on_or_after: Union[date, Sequence[date]]) -> DateArray:
+    """First charge on `on_or_after` or later for every payment, in one pass over arrays.
+
+    A payment is charged on its anchor date and then every period after it.
+    Monthly steps keep the anchor day, clamped to the month end, so a payment
+    on the 31st is charged on the 30th in April and on the 31st again in May.
+    """
+    anchors = np.asarray(anchors, dtype='datetime64[D]')
+    after = np.broadcast_to(np.asarray(on_or_after, dtype='datetime64[D]'), anchors.shape)
+    steps = np.array([PERIOD_MONTHS[period] for period in periods], dtype=np.int64).reshape(anchors.shape)
+    weekly = steps == 0
+
+    # weekly: whole weeks from the anchor, never before it
+    days = (after - anchors).astype(np.int64)
+    weeks = np.maximum(0, -(-days // 7))
+    weekly_due = anchors + (weeks * 7).astype('timedelta64[D]')
+
+    # monthly and longer: first period month not before the month of `after`
+    anchor_months = anchors.astype('datetime64[M]')
+    day_offsets = (anchors - anchor_months.astype('datetime64[D]')).astype(np.int64)
+    months = (after.astype('datetime64[M]') - anchor_months).astype(np.int64)
+    safe_steps = np.where(weekly, 1, steps)
+    periods_passed = np.maximum(0, -(-months // safe_steps))
+    due_months = anchor_months + (periods_passed * safe_steps).astype('timedelta64[M]')
+    due = _clamp_to_month(due_months, day_offsets)
+    # same month as `after` but an earlier day: the next period
+    next_due = _clamp_to_month(due_months + safe_steps.astype('timedelta64[M]'), day_offsets)
+    due = np.where(due < after, next_due, due)
+
+    return np.where(weekly, weekly_due, due)
+
+
+def get_weekly_charges(next_due: date, end: date) -> list[date]:
+    """Charges of a weekly payment from `next_due` up to `end`, not including it."""
+    return np.arange(np.datetime64(next_due, 'D'), np.datetime64(end, 'D'), np.timedelta64(7, 'D')).tolist()
+
+
+def get_next_fire_dates(anchors: Sequence[date], periods: Sequence[str], days_before: Sequence[int],
+                        after: datetime) -> list[datetime]:
+    """First notification moment strictly later than `after` for every payment notification."""
+    days_before = np.asarray(days_before, dtype=np.int64).astype('timedelta64[D]')
+    # the earliest charge whose notification at NOTIFICATION_HOUR is still ahead
+    first_day = np.datetime64(after.date()) + np.timedelta64(int(after.time() >= time(NOTIFICATION_HOUR)), 'D')
+    due = get_next_due_dates(anchors, periods, first_day + days_before)
+    fire_days = (due - days_before).tolist()
+    return [datetime.combine(day, time(NOTIFICATION_HOUR)) for day in fire_days]
@@ -1,27 +1,55 @@
+import asyncio
+import re
 from contextlib import suppress
-from datetime import date
+from datetime import date, datetime, timedelta
 from typing import Optional
 
 from peewee import (
     Model, CharField, AutoField, IntegerField, FloatField, DateField,
-    BooleanField, ForeignKeyField, IntegrityError,
+    BooleanField, ForeignKeyField, DateTimeField, TextField, IntegrityError, JOIN, Case, fn, EXCLUDED,
 )
+from playhouse.sqlite_ext import FTS5Model, SearchField
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+
+from utils.settings import (
+    logging, database, NOTIFICATION_MODE, REHYDRATE_CHUNK_SIZE, PAYMENTS_PAGE_SIZE,
+    SUMMARY_TOP_SERVICES, SUMMARY_CHECK_HOUR, STATS_FLUSH_INTERVAL, SEARCH_RESULTS_LIMIT,
+)
+from utils.startup import startup_timer
+from utils.cache import user_cache, view_cache, invalidate_view
+from utils.aio import run_db
+from utils.dates import (
+    get_local_now, get_next_due_dates, get_next_fire_dates, get_weekly_charges, WEEKLY, MONTHLY, PERIODS,
+)
+from utils.stats import stats
+from src.scheduler import scheduler, send_notification, NotificationTrigger
 
-from utils.settings import database
-from src.scheduler import scheduler, send_notification
 
+logger = logging.getLogger(__name__)
+Charge = tuple[date, 'Payment']  # day of an upcoming charge and its payment
 
 class BaseModel(Model):
     class Meta:
         database = database
 
 
+def get_prefetched(instance: Model, backref: str) -> Optional[list]:
+    """List of related rows loaded together with the instance, None if they were not loaded."""
+    return instance.__dict__.get(backref)
+
+
 class User(BaseModel):
     id = AutoField()
     telegram_id = IntegerField(unique=True)
     username = CharField(default='Default User')
     is_admin = BooleanField(default=False)
+    is_reachable = BooleanField(default=True)  # false once the user blocked the bot or was deleted
+
+    class Meta:
+        indexes = (
+            (('is_reachable', 'id'), False),
+        )
 
     def get_payment_list(self) -> list[object]:
         payments: Payment = (Payment.select()
@@ -32,19 +60,256 @@ class User(BaseModel):
         return payments
 
     def add_payment(self, name: str, description: str, price: float,
-                    date) -> object:
-        payment: Payment = Payment.create(
-            name=name,
-            description=description,
-            price=price,
-            date=date,
-            user=self,
-        )
+                    date, period: str = MONTHLY) -> object:
+        if period not in PERIODS:
+            raise ValueError(f'Unknown period "{period}"')
+        with database.atomic('IMMEDIATE'):
+            payment: Payment = Payment.create(
+                name=name,
+                description=description,
+                price=price,
+                date=date,
+                period=period,
+                next_due=get_next_due(date, period),
+                user=self,
+            )
+            SpendingSummary.add(self.id, payment.period, payment.price)
+        stats.inc('payments')
+        invalidate_view(self.telegram_id, 'list', 'summary', 'upcoming')
+        payment.notifications = []
         return payment
 
+    async def aadd_payment(self, name: str, description: str, price: float,
+                           date, period: str = MONTHLY) -> object:
+        return await run_db(self.add_payment, name, description, price, date, period)
+
     def change_username(self, new_username: str) -> None:
         self.username = new_username
         self.save()
+        user_cache.pop(self.telegram_id)
+        view_cache.pop(self.telegram_id)
+
+    async def achange_username(self, new_username: str) -> None:
+        await run_db(self.change_username, new_username)
+
+    def get_payment_page(self, cursor: int = 0, forward: bool = True,
+                         size: int = PAYMENTS_PAGE_SIZE) -> tuple[list['Payment'], bool]:
+        """Payments after (or before) the `cursor` id and whether there are more in that direction.
+
+        Keyset pagination: every page is an index range scan, whatever its number.
+        """
+        query = Payment.select().where(Payment.user == self.id)
+        if forward:
+            query = query.where(Payment.id > cursor).order_by(Payment.id)
+        else:
+            query = query.where(Payment.id < cursor).order_by(Payment.id.desc())
+        payments = list(query.limit(size + 1))
+        has_more = len(payments) > size
+        payments = payments[:size]
+        if not forward:
+            payments.reverse()
+        return payments, has_more
+
+    async def aget_payment_page(self, cursor: int = 0, forward: bool = True) -> tuple[list['Payment'], bool]:
+        return await run_db(self.get_payment_page, cursor, forward)
+
+    def get_payment(self, payment_id: int) -> Optional['Payment']:
+        """Payment of this user with its notifications, looked up by primary key in one joined query."""
+        rows = list(
+            Payment.select(Payment, Notification)
+            .join(Notification, JOIN.LEFT_OUTER, attr='joined_notification')
+            .where((Payment.id == payment_id) & (Payment.user == self.id))
+            .order_by(Notification.id)
+        )
+        if not rows:
+            return None
+        payment = rows[0]
+        payment.user = self
+        # a payment without notifications comes as one row with no joined notification
+        payment.notifications = [row.joined_notification for row in rows if hasattr(row, 'joined_notification')]
+        for notification in payment.notifications:
+            notification.payment = payment
+        return payment
+
+    async def aget_payment(self, payment_id: int) -> Optional['Payment']:
+        return await run_db(self.get_payment, payment_id)
+
+    def import_payments(self, rows: list[dict], chunk_size: int = 100) -> tuple[int, list[str]]:
+        """Insert payments with their notification days in one transaction.
+
+        Rows are dicts with name, description, price, date and notification_days.
+        Payments with names the user already has are skipped, their names are returned.
+        """
+        names = [row['name'] for row in rows]
+        with database.atomic('IMMEDIATE'):
+            existing = {
+                name for name, in Payment.select(Payment.name)
+                .where((Payment.user == self.id) & Payment.name.in_(names)).tuples()
+            }
+            rows = [row for row in rows if row['name'] not in existing]
+            payment_rows = [
+                {'user': self.id, 'name': row['name'], 'description': row['description'],
+                 'price': row['price'], 'date': row['date'], 'period': row.get('period', MONTHLY)}
+                for row in rows
+            ]
+            next_due = get_next_due_dates(
+                [row['date'] for row in payment_rows], [row['period'] for row in payment_rows], get_local_now().date(),
+            ).tolist()
+            for row, due in zip(payment_rows, next_due):
+                row['next_due'] = due
+            for start in range(0, len(payment_rows), chunk_size):
+                Payment.insert_many(payment_rows[start:start + chunk_size]).execute()
+            periods: dict[str, list[float]] = {}
+            for row in payment_rows:
+                periods.setdefault(row['period'], []).append(row['price'])
+            for period, prices in periods.items():
+                SpendingSummary.add(self.id, period, sum(prices), len(prices))
+            payments = {
+                payment.name: payment for payment in
+                Payment.select().where((Payment.user == self.id) & Payment.name.in_([row['name'] for row in rows]))
+            }
+            notifications = []
+            for row in rows:
+                payment = payments[row['name']]
+                payment.user = self
+                payment.notifications = []
+                for day in row['notification_days']:
+                    notifications.append(Notification(payment=payment, day_before_payment=day))
+            if NOTIFICATION_MODE != 'cron':
+                set_next_fire_dates(notifications)
+            notification_rows = [
+                {'payment': n.payment.id, 'day_before_payment': n.day_before_payment, 'next_fire_at': n.next_fire_at}
+                for n in notifications
+            ]
+            for start in range(0, len(notification_rows), chunk_size):
+                Notification.insert_many(notification_rows[start:start + chunk_size]).execute()
+            if NOTIFICATION_MODE == 'cron' and notifications:
+                by_payment = {payment.id: payment for payment in payments.values()}
+                notifications = list(
+                    Notification.select()
+                    .where(Notification.payment.in_(list(by_payment)))
+                    .order_by(Notification.id)
+                )
+                for notification in notifications:
+                    notification.payment = by_payment[notification.payment_id]
+        # jobs are registered only after the rows are committed
+        if NOTIFICATION_MODE == 'cron':
+            for notification in notifications:
+                notification.add_job()
+        if rows:
+            stats.inc('payments', len(rows))
+            stats.inc('notifications', len(notification_rows))
+            invalidate_view(self.telegram_id, 'list', 'summary', 'upcoming')
+        return len(rows), sorted(existing)
+
+    async def aimport_payments(self, rows: list[dict]) -> tuple[int, list[str]]:
+        return await run_db(self.import_payments, rows)
+
+    def get_summary(self, top: int = SUMMARY_TOP_SERVICES) -> tuple[list['SpendingSummary'], list['Payment']]:
+        """Totals by period and the most expensive payments, without reading all payments."""
+        periods = list(
+            SpendingSummary.select()
+            .where((SpendingSummary.user == self.id) & (SpendingSummary.payments > 0))
+        )
+        top_payments = list(
+            Payment.select()
+            .where(Payment.user == self.id)
+            .order_by(Payment.price.desc())
+            .limit(top)
+        )
+        return periods, top_payments
+
+    def get_upcoming_charges(self, today: date, days: int, limit: int) -> tuple[list[Charge], int, float]:
+        """Charges in `days` days from `today` by day, and the number and total of all of them.
+
+        Reads the (user, next_due) index range only, a weekly payment is charged
+        every week of the range. Next charges which have passed since the last
+        look are moved on first. The write lock is taken before that read, a
+        deferred transaction could not upgrade its lock once another connection
+        has committed in between.
+        """
+        end = today + timedelta(days=days)
+        weeks_left = ((fn.julianday(end) - fn.julianday(Payment.next_due) + 6) / 7).cast('INTEGER')
+        charges = Case(None, [(Payment.period == WEEKLY, weeks_left)], 1)
+        with database.atomic('IMMEDIATE'):
+            passed = list(
+                Payment.select(Payment.id, Payment.date, Payment.period)
+                .where((Payment.user == self.id) & (Payment.next_due < today))
+            )
+            if passed:
+                set_next_due_dates(passed, today)
+                Payment.bulk_update(passed, fields=[Payment.next_due])
+            payments = list(
+                Payment.select(
+                    Payment.id, Payment.name, Payment.price, Payment.period, Payment.next_due,
+                    fn.SUM(charges).over().alias('window_count'),
+                    fn.SUM(Payment.price * charges).over().alias('window_total'),
+                )
+                .where((Payment.user == self.id) & (Payment.next_due < end))
+                .order_by(Payment.next_due, Payment.id)
+                .limit(limit)
+            )
+        if not payments:
+            return [], 0, 0.0
+        # payments past the limit are charged after these, so the first charges are among them
+        upcoming = [
+            (day, payment)
+            for payment in payments
+            for day in (get_weekly_charges(payment.next_due, end) if payment.period == WEEKLY else [payment.next_due])
+        ]
+        upcoming.sort(key=lambda charge: (charge[0], charge[1].id))
+        return upcoming[:limit], payments[0].window_count, payments[0].window_total
+
+    async def aget_upcoming_charges(self, today: date, days: int, limit: int) -> tuple[list[Charge], int, float]:
+        return await run_db(self.get_upcoming_charges, today, days, limit)
+
+    async def aget_summary(self) -> tuple[list['SpendingSummary'], list['Payment']]:
+        return await run_db(self.get_summary)
+
+    def search_payments(self, text: str, limit: int = SEARCH_RESULTS_LIMIT) -> list['Payment']:
+        """Payments whose name or description has words starting with every word of `text`, best first."""
+        expression = PaymentSearch.get_expression(self.id, text)
+        if expression is None:
+            return []
+        return list(
+            Payment.select()
+            .join(PaymentSearch, on=(PaymentSearch.rowid == Payment.id))
+            .where(PaymentSearch.match(expression))
+            .order_by(PaymentSearch.bm25(*PaymentSearch.WEIGHTS), Payment.id)
+            .limit(limit)
+        )
+
+    async def asearch_payments(self, text: str) -> list['Payment']:
+        return await run_db(self.search_payments, text)
+
+    @staticmethod
+    def set_reachable(telegram_id: int, is_reachable: bool) -> bool:
+        """Mark the user as (un)reachable by the bot, returns False if nothing changed.
+
+        Cron jobs of unreachable users are removed and added back when they return.
+        """
+        changed = (User
+                   .update(is_reachable=is_reachable)
+                   .where((User.telegram_id == telegram_id) & (User.is_reachable != is_reachable))
+                   .execute())
+        if not changed:
+            return False
+        user_cache.pop(telegram_id)
+        if NOTIFICATION_MODE == 'cron':
+            notifications = (Notification.select(Notification, Payment, User)
+                             .join(Payment)
+                             .join(User)
+                             .where(User.telegram_id == telegram_id))
+            for notification in notifications:
+                if is_reachable:
+                    notification.add_job()
+                else:
+                    notification.delete_notif_job()
+        return True
+
+    @staticmethod
+    async def aset_reachable(telegram_id: int, is_reachable: bool) -> bool:
+        return await run_db(User.set_reachable, telegram_id, is_reachable)
 
     @staticmethod
     def create_or_update(telegram_id: int, username: str) -> None:
@@ -54,18 +319,39 @@ class User(BaseModel):
         if username:
             user.update({'username': username})
         with suppress(IntegrityError) as unique_error:
-            User.get_or_create(**user)
+            _, created = User.get_or_create(**user)
+            if created:
+                stats.inc('users')
         del user
 
+    @staticmethod
+    async def acreate_or_update(telegram_id: int, username: str) -> None:
+        await run_db(User.create_or_update, telegram_id, username)
+
 
 class Payment(BaseModel):
     id = AutoField()
-    name = CharField(unique=True)
+    name = CharField()
     description = CharField()
     price = FloatField()
-    date = DateField(default=date.today())
+    date = DateField(default=date.today())  # first charge, the next ones follow every period
+    period = CharField(default=MONTHLY)  # one of utils.dates.PERIODS
+    next_due = DateField(null=True)  # next charge, moved on when the upcoming charges are shown
     user = ForeignKeyField(User, backref='payments', on_delete='CASCADE')
 
+    class Meta:
+        indexes = (
+            (('user', 'id'), False),
+            (('user', 'name'), True),
+            (('user', 'price'), False),
+            (('user', 'next_due'), False),
+        )
+
+    @staticmethod
+    def get_view_key(payment_id: int) -> tuple[str, int]:
+        """Key of the rendered payment view in the user views cache."""
+        return 'payment', payment_id
+
     def get_notification_list(self) -> list['Notification']:
         notifications: Notification = (Notification.select()
                     .join(Payment)
@@ -77,28 +363,116 @@ class Payment(BaseModel):
     def delete_instance(self, *args, **kwargs) -> bool:
         for notification in self.notifications:
             notification.delete_notif_job()
-        return super().delete_instance(args, kwargs)
+        invalidate_view(self.user.telegram_id, 'list', 'summary', 'upcoming', self.get_view_key(self.id))
+        with database.atomic('IMMEDIATE'):
+            SpendingSummary.remove(self.user_id, self.period, self.price)
+            deleted = super().delete_instance(args, kwargs)
+        stats.inc('payments', -1)
+        stats.inc('notifications', -len(self.notifications))
+        return deleted
+
+    async def adelete_instance(self, *args, **kwargs) -> bool:
+        return await run_db(self.delete_instance, *args, **kwargs)
 
     def add_notification(self, days_before: int) -> Optional[object]:
         if 0 >= days_before or days_before >= 20:
             return None
-        notification: Notification = Notification.get_or_create(payment=self, day_before_payment=days_before)[0]
+        notification, created = Notification.get_or_create(payment=self, day_before_payment=days_before)
         notification.add_job()
+        invalidate_view(self.user.telegram_id, self.get_view_key(self.id))
+        if created:
+            stats.inc('notifications')
+        if created and (notifications := get_prefetched(self, 'notifications')) is not None:
+            notifications.append(notification)
         return notification
 
+    async def aadd_notification(self, days_before: int) -> Optional[object]:
+        return await run_db(self.add_notification, days_before)
+
     def delete_notification(self, notification_day: int) -> bool:
         try:
-            notification: Notification = list(filter(lambda n: n.day_before_payment==notification_day, self.get_notification_list()))[0]
+            notification: Notification = list(filter(lambda n: n.day_before_payment==notification_day, self.notifications))[0]
         except IndexError:
             return False
         notification.delete_notif_job()
-        return bool(notification.delete_instance())
+        invalidate_view(self.user.telegram_id, self.get_view_key(self.id))
+        if (notifications := get_prefetched(self, 'notifications')) is not None:
+            notifications.remove(notification)
+        deleted = bool(notification.delete_instance())
+        if deleted:
+            stats.inc('notifications', -1)
+        return deleted
+
+    async def adelete_notification(self, notification_day: int) -> bool:
+        return await run_db(self.delete_notification, notification_day)
+
+
+class PaymentSearch(FTS5Model):
+    """Full-text index of payment names and descriptions, `rowid` is the payment id.
+
+    The index has external content: the text is read from `payment`, only
+    the index is stored. Triggers keep it in sync on every insert, delete and
+    rename, including bulk queries. The owner id is indexed too, so a search
+    reads only the index entries of one user.
+    Transactions writing payments begin IMMEDIATE: the triggers read the index
+    before writing it, and a deferred transaction which has read cannot take
+    the write lock once another connection has committed.
+    """
+    name = SearchField()
+    description = SearchField()
+    user_id = SearchField()
+
+    WEIGHTS = (4.0, 1.0, 0.0)  # bm25 weights of the columns, a word in the name counts more
+
+    class Meta:
+        database = database
+        table_name = 'payment_search'
+        options = {
+            'content': Payment._meta.table_name,
+            'content_rowid': 'id',
+            'tokenize': 'unicode61 remove_diacritics 2',
+            'prefix': '2 3',
+        }
+
+    @staticmethod
+    def create_triggers() -> None:
+        table, content = PaymentSearch._meta.table_name, Payment._meta.table_name
+        columns = 'name, description, user_id'
+        delete = (f"INSERT INTO {table} ({table}, rowid, {columns}) "
+                  f"VALUES ('delete', old.id, old.name, old.description, old.user_id);")
+        insert = (f"INSERT INTO {table} (rowid, {columns}) "
+                  f"VALUES (new.id, new.name, new.description, new.user_id);")
+        triggers = {
+            'insert': f'AFTER INSERT ON {content} BEGIN {insert} END',
+            'delete': f'AFTER DELETE ON {content} BEGIN {delete} END',
+            'update': f'AFTER UPDATE OF {columns} ON {content} BEGIN {delete} {insert} END',
+        }
+        for name, body in triggers.items():
+            database.execute_sql(f'CREATE TRIGGER IF NOT EXISTS {table}_{name} {body}')
+
+    @staticmethod
+    def get_expression(user_id: int, text: str) -> Optional[str]:
+        """MATCH expression for words of `text` as prefixes, None if there are no words.
+
+        Words are quoted, so user input cannot use the query syntax.
+        """
+        words = re.findall(r'\w+', text.lower())
+        if not words:
+            return None
+        prefixes = ' '.join(f'"{word}"*' for word in words)
+        return f'user_id:"{user_id}" AND {{name description}}:({prefixes})'
 
 
 class Notification(BaseModel):
     id = AutoField()
     day_before_payment = IntegerField(default=1)
     payment = ForeignKeyField(Payment, backref='notifications', on_delete='CASCADE')
+    next_fire_at = DateTimeField(null=True, index=True)
+
+    class Meta:
+        indexes = (
+            (('payment', 'id'), False),
+        )
 
     def get_job_name(self) -> str:
         return f'u{self.id}p{self.payment.id}n{self.payment.user.id}'
@@ -107,16 +481,20 @@ class Notification(BaseModel):
         with suppress(Exception):
             scheduler.remove_job(self.get_job_name())
 
+    def get_next_fire_date(self, after: Optional[datetime] = None) -> datetime:
+        return get_next_fire_dates(
+            [self.payment.date], [self.payment.period], [self.day_before_payment], after or get_local_now(),
+        )[0]
+
+    def update_next_fire_date(self) -> None:
+        self.next_fire_at = self.get_next_fire_date()
+        self.save(only=[Notification.next_fire_at])
+
     def add_job(self) -> None:
-        day: int = self.payment.date.day - self.day_before_payment
-        cron = CronTrigger(
-            year='*',
-            month='*',
-            day=day,
-            hour='12',
-            minute='0',
-            second='0',
-        )
+        if NOTIFICATION_MODE != 'cron':
+            self.update_next_fire_date()
+            return
+        trigger = NotificationTrigger(self.payment.date, self.payment.period, self.day_before_payment)
         job_id = self.get_job_name()
         message_objects: dict = {
             'telegram_id': self.payment.user.telegram_id,
@@ -129,17 +507,334 @@ class Notification(BaseModel):
         scheduler.add_job(
             send_notification,
             kwargs=message_objects,
-            trigger=cron,
+            trigger=trigger,
             name=job_id,
             id=job_id,
+            replace_existing=True,
+        )
+
+
+
+
+
+class SpendingSummary(BaseModel):
+    """Total price and number of user payments with the same period.
+
+    These few rows are all it takes to show the monthly and yearly totals.
+    They are changed together with the payments, `check_spending_summary`
+    rebuilds them if they ever drift.
+    """
+    id = AutoField()
+    user = ForeignKeyField(User, on_delete='CASCADE')
+    period = CharField()
+    total = FloatField(default=0)
+    payments = IntegerField(default=0)
+
+    class Meta:
+        table_name = 'spending_summary'
+        indexes = (
+            (('user', 'period'), True),
+        )
+
+    @staticmethod
+    def add(user_id: int, period: str, price: float, payments: int = 1) -> None:
+        (SpendingSummary
+         .insert(user=user_id, period=period, total=price, payments=payments)
+         .on_conflict(
+             conflict_target=[SpendingSummary.user, SpendingSummary.period],
+             update={
+                 SpendingSummary.total: SpendingSummary.total + EXCLUDED.total,
+                 SpendingSummary.payments: SpendingSummary.payments + EXCLUDED.payments,
+             },
+         )
+         .execute())
+
+    @staticmethod
+    def remove(user_id: int, period: str, price: float) -> None:
+        # the row of a period stays at zero payments, so removal is a single statement
+        (SpendingSummary
+         .update(total=SpendingSummary.total - price, payments=SpendingSummary.payments - 1)
+         .where((SpendingSummary.user == user_id) & (SpendingSummary.period == period))
+         .execute())
+
+    @staticmethod
+    def get_expected():
+        """Summary rows computed from the payments themselves."""
+        return (Payment
+                .select(Payment.user, Payment.period, fn.SUM(Payment.price), fn.COUNT(Payment.id))
+                .group_by(Payment.user, Payment.period))
+
+    @staticmethod
+    def rebuild() -> int:
+        with database.atomic():
+            SpendingSummary.delete().execute()
+            return (SpendingSummary
+                    .insert_from(
+                        SpendingSummary.get_expected(),
+                        [SpendingSummary.user, SpendingSummary.period, SpendingSummary.total,
+                         SpendingSummary.payments],
+                    )
+                    .execute())
+
+    @staticmethod
+    def get_mismatched_users() -> set[int]:
+        expected = {
+            (user_id, period): (round(total, 2), count)
+            for user_id, period, total, count in SpendingSummary.get_expected().tuples()
+        }
+        stored = {
+            (row.user_id, row.period): (round(row.total, 2), row.payments)
+            for row in SpendingSummary.select().where(SpendingSummary.payments > 0)
+        }
+        return {user_id for user_id, _ in expected.keys() ^ stored.keys()} | {
+            key[0] for key, value in expected.items()
+            if key in stored and stored[key] != value
+        }
+
+
+def check_spending_summary() -> int:
+    """Compare the summary with the payments and rebuild it from scratch if they differ.
+
+    Returns the number of users whose summary was wrong.
+    """
+    users = SpendingSummary.get_mismatched_users()
+    if users:
+        logger.warning(f'Spending summary of {len(users)} users is wrong, rebuild it')
+        SpendingSummary.rebuild()
+        view_cache.clear()
+    return len(users)
+
+
+def job_check_spending_summary():
+    scheduler.add_job(
+        check_spending_summary,
+        trigger=CronTrigger(hour=SUMMARY_CHECK_HOUR, minute=30),
+        name='check_spending_summary',
+        id='check_spending_summary',
+        executor='threadpool',
+    )
+
+
+class Stat(BaseModel):
+    """Stored value of an admin statistics counter, see `utils.stats`."""
+    key = CharField(primary_key=True)
+    value = IntegerField(default=0)
+
+
+def load_stats() -> None:
+    """Load stored counters, totals which were never stored are counted once."""
+    values = dict(Stat.select(Stat.key, Stat.value).tuples())
+    totals = {'users': User, 'payments': Payment, 'notifications': Notification}
+    missing = [
+        {'key': key, 'value': model.select().count()}
+        for key, model in totals.items() if key not in values
+    ]
+    if missing:
+        logger.info(f'Count {", ".join(row["key"] for row in missing)} for statistics')
+        Stat.insert_many(missing).on_conflict_ignore().execute()
+        values = dict(Stat.select(Stat.key, Stat.value).tuples())
+    stats.set_values(values)
+
+
+def flush_stats() -> None:
+    pending = stats.take_pending()
+    try:
+        with database.atomic():
+            for key, amount in pending.items():
+                (Stat
+                 .insert(key=key, value=amount)
+                 .on_conflict(conflict_target=[Stat.key], update={Stat.value: Stat.value + EXCLUDED.value})
+                 .execute())
+            values = dict(Stat.select(Stat.key, Stat.value).tuples())
+    except Exception:
+        stats.restore_pending(pending)
+        raise
+    stats.set_values(values)
+
+
+def job_flush_stats():
+    load_stats()
+    scheduler.add_job(
+        flush_stats,
+        trigger=IntervalTrigger(seconds=STATS_FLUSH_INTERVAL),
+        name='flush_stats',
+        id='flush_stats',
+        executor='threadpool',
+    )
+
+
+class Broadcast(BaseModel):
+    """Broadcast with its progress, saved after every batch of users so it can be resumed."""
+    RUNNING, FINISHED, FAILED = 'running', 'finished', 'failed'
+
+    id = AutoField()
+    text = TextField()
+    chat_id = IntegerField()  # where the progress message is
+    message_id = IntegerField()
+    status = CharField(default=RUNNING, index=True)
+    last_user_id = IntegerField(default=0)
+    total = IntegerField(default=0)
+    sent = IntegerField(default=0)
+    unreachable = IntegerField(default=0)
+    failed = IntegerField(default=0)
+    created_at = DateTimeField(default=datetime.now)
+    finished_at = DateTimeField(null=True)
+
+    @staticmethod
+    def get_running() -> list['Broadcast']:
+        return list(Broadcast.select().where(Broadcast.status == Broadcast.RUNNING).order_by(Broadcast.id))
+
+
+class DeadLetter(BaseModel):
+    """Message which could not be delivered after all attempts."""
+    id = AutoField()
+    telegram_id = IntegerField(index=True)
+    text = TextField()
+    error = CharField()
+    attempts = IntegerField()
+    created_at = DateTimeField(default=datetime.now)
+
+
+class OutboxMessage(BaseModel):
+    """Notification written down before it is sent, so a restart neither loses nor repeats it.
+
+    A notification gets one row per fire date, repeated sweeps of the same date are ignored.
+    """
+    PENDING, SENT, FAILED = 'pending', 'sent', 'failed'
+
+    id = AutoField()
+    notification_id = IntegerField(null=True)  # not a foreign key, rows outlive deleted notifications
+    telegram_id = IntegerField()
+    text = TextField()
+    due_at = DateTimeField()
+    status = CharField(default=PENDING)
+    created_at = DateTimeField(default=datetime.now)
+    sent_at = DateTimeField(null=True)
+
+    class Meta:
+        table_name = 'outbox'
+        indexes = (
+            (('notification_id', 'due_at'), True),
+            (('status', 'id'), False),
         )
 
+    @staticmethod
+    def get_pending(after_id: int, limit: int) -> list['OutboxMessage']:
+        return list(
+            OutboxMessage.select()
+            .where((OutboxMessage.status == OutboxMessage.PENDING) & (OutboxMessage.id > after_id))
+            .order_by(OutboxMessage.id)
+            .limit(limit)
+        )
 
+    @staticmethod
+    def count_pending() -> int:
+        return OutboxMessage.select().where(OutboxMessage.status == OutboxMessage.PENDING).count()
+
+    @staticmethod
+    def set_status(message_id: int, status: str) -> None:
+        (OutboxMessage
+         .update(status=status, sent_at=get_local_now() if status == OutboxMessage.SENT else None)
+         .where(OutboxMessage.id == message_id)
+         .execute())
 
+    @staticmethod
+    def delete_sent(before: datetime) -> int:
+        return (OutboxMessage
+                .delete()
+                .where((OutboxMessage.status == OutboxMessage.SENT) & (OutboxMessage.sent_at < before))
+                .execute())
+
+
+def load_user(telegram_id: int) -> Optional[User]:
+    """User row only, payments are loaded by page or by id when needed.
+
+    Served from `user_cache`, models drop the entry whenever they change it.
+    """
+    if (user := user_cache.get(telegram_id)) is not None:
+        return user
+    user = User.get_or_none(User.telegram_id == telegram_id)
+    if user is not None:
+        user_cache.set(telegram_id, user)
+    return user
+
+
+async def aload_user(telegram_id: int) -> Optional[User]:
+    if (user := user_cache.get(telegram_id)) is not None:
+        return user
+    return await run_db(load_user, telegram_id)
+
+
+def connect_db() -> None:
+    database.connect(reuse_if_open=True)
+    startup_timer.mark('DB connect')
 
 
 def initialize_db() -> None:
-    database.connect()
-    database.create_tables([User, Payment, Notification])
-    for notitication in Notification.select():
-        notitication.add_job()
+    database.connect(reuse_if_open=True)
+    has_summary = SpendingSummary.table_exists()
+    database.create_tables([
+        User, Payment, PaymentSearch, Notification, SpendingSummary, Stat, Broadcast, DeadLetter, OutboxMessage,
+    ])
+    PaymentSearch.create_triggers()
+    if not has_summary:
+        SpendingSummary.rebuild()
+    startup_timer.mark('table creation')
+
+
+def get_next_due(anchor: date, period: str) -> date:
+    return get_next_due_dates([anchor], [period], get_local_now().date())[0].item()
+
+
+def set_next_due_dates(payments: list[Payment], on_or_after: date) -> None:
+    next_due = get_next_due_dates([p.date for p in payments], [p.period for p in payments], on_or_after)
+    for payment, due in zip(payments, next_due.tolist()):
+        payment.next_due = due
+
+
+def set_next_fire_dates(notifications: list[Notification], after: Optional[datetime] = None) -> None:
+    """Compute next fire dates of many notifications in one pass, their payments must be loaded."""
+    if not notifications:
+        return
+    fire_dates = get_next_fire_dates(
+        [n.payment.date for n in notifications],
+        [n.payment.period for n in notifications],
+        [n.day_before_payment for n in notifications],
+        after or get_local_now(),
+    )
+    for notification, fire_at in zip(notifications, fire_dates):
+        notification.next_fire_at = fire_at
+
+
+async def rehydrate_jobs(chunk_size: int = REHYDRATE_CHUNK_SIZE) -> int:
+    """Register jobs for all stored notifications, yielding to the event loop between chunks.
+
+    Notifications are loaded together with their payment and user by one joined
+    query per chunk, so `add_job` does not touch the database lazily.
+    """
+    query = (Notification.select(Notification, Payment, User)
+             .join(Payment)
+             .join(User)
+             .order_by(Notification.id)
+             )
+    if NOTIFICATION_MODE != 'cron':
+        query = query.where(Notification.next_fire_at.is_null())
+    else:
+        query = query.where(User.is_reachable)
+    last_id, count = 0, 0
+    while notifications := await run_db(list, query.where(Notification.id > last_id).limit(chunk_size)):
+        last_id = notifications[-1].id
+        count += len(notifications)
+        if NOTIFICATION_MODE != 'cron':
+            set_next_fire_dates(notifications)
+            await run_db(bulk_update_next_fire_dates, notifications)
+        else:
+            for notification in notifications:
+                notification.add_job()
+        await asyncio.sleep(0)
+    return count
+
+
+def bulk_update_next_fire_dates(notifications: list[Notification]) -> None:
+    with database.atomic():
+        Notification.bulk_update(notifications, fields=[Notification.next_fire_at])
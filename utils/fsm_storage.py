@@ -0,0 +1,235 @@
+import asyncio
+import copy
+import json
+import logging
+import sqlite3
+import threading
+import typing
+
+from aiogram.dispatcher.storage import BaseStorage
+
+from utils.ttl_cache import TTLCache
+
+
+logger = logging.getLogger(__name__)
+
+Address = tuple[str, str]
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage which survives restarts.
+
+    States are kept in a small in-memory layer and written to SQLite in the
+    background: changes are collected in `_dirty` and flushed in one
+    transaction every `flush_interval` seconds, so handlers never wait for disk.
+    Records missing from memory are read off the loop by a separate read-only
+    connection, which does not wait for a flush in progress. The database is
+    opened on first use, so creating the storage touches no files.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0,
+                 cache_size: int = 10000, cache_ttl: float = 600):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._hot = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._dirty: dict[Address, dict] = {}
+        self._flushing: dict[Address, dict] = {}
+        self._flush_task: typing.Optional[asyncio.Task] = None
+        self._closed = False
+        self._db_lock = threading.Lock()  # writer connection
+        self._read_lock = threading.Lock()  # reader connection
+        self._connection: typing.Optional[sqlite3.Connection] = None
+        self._reader: typing.Optional[sqlite3.Connection] = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        """Writer connection, the database and its table are created on first use. Call with `_db_lock`."""
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS fsm_state ('
+                'chat TEXT NOT NULL, user TEXT NOT NULL, state TEXT, data TEXT, bucket TEXT, '
+                'PRIMARY KEY (chat, user))'
+            )
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def _get_reader(self) -> sqlite3.Connection:
+        """Read-only connection, WAL lets it read while the writer holds its transaction. Call with `_read_lock`."""
+        if self._reader is None:
+            with self._db_lock:
+                self._get_connection()  # the file and the table must exist
+            self._reader = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+        return self._reader
+
+    def __len__(self) -> int:
+        """Approximate number of users with a state: stored rows plus pending writes."""
+        with self._read_lock:
+            stored = self._get_reader().execute('SELECT COUNT(*) FROM fsm_state').fetchone()[0]
+        return stored + len(self._dirty)
+
+    def _get_cached(self, address: Address) -> typing.Optional[dict]:
+        if address in self._dirty:
+            return self._dirty[address]
+        if address in self._flushing:
+            return self._flushing[address]
+        return self._hot.get(address)
+
+    def _read(self, address: Address) -> dict:
+        with self._read_lock:
+            row = self._get_reader().execute(
+                'SELECT state, data, bucket FROM fsm_state WHERE chat = ? AND user = ?', address,
+            ).fetchone()
+        if row:
+            return {'state': row[0], 'data': json.loads(row[1]), 'bucket': json.loads(row[2])}
+        return {'state': None, 'data': {}, 'bucket': {}}
+
+    async def _load(self, address: Address) -> dict:
+        if (record := self._get_cached(address)) is not None:
+            return record
+        record = await asyncio.get_running_loop().run_in_executor(None, self._read, address)
+        # the record may have been changed while it was read, the change wins
+        if (changed := self._get_cached(address)) is not None:
+            return changed
+        self._hot.set(address, record)
+        return record
+
+    def _mark_dirty(self, address: Address, record: dict) -> None:
+        self._dirty[address] = record
+        self._hot.set(address, record)
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if self._closed:
+            return
+        task = self._flush_task
+        if task is None or task.done() or task is asyncio.current_task():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _resolve(self, chat, user) -> tuple[Address, dict]:
+        address = tuple(map(str, self.check_address(chat=chat, user=user)))
+        return address, await self._load(address)
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+        self._flushing, self._dirty = self._dirty, {}
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, self._flushing)
+        except Exception as exc:
+            logger.error(f'Cannot flush {len(self._flushing)} FSM records: {exc}')
+            # keep them for the next flush, unless they were changed meanwhile
+            self._dirty = {**self._flushing, **self._dirty}
+        finally:
+            self._flushing = {}
+        # changes made while writing, or records which failed to be written
+        if self._dirty:
+            self._schedule_flush()
+
+    def _write(self, dirty: dict[Address, dict]) -> None:
+        to_delete = [address for address, record in dirty.items() if self._is_empty(record)]
+        to_save = [
+            (*address, record['state'], json.dumps(record['data']), json.dumps(record['bucket']))
+            for address, record in dirty.items() if not self._is_empty(record)
+        ]
+        with self._db_lock, self._get_connection() as connection:
+            connection.executemany('DELETE FROM fsm_state WHERE chat = ? AND user = ?', to_delete)
+            connection.executemany('INSERT OR REPLACE INTO fsm_state VALUES (?, ?, ?, ?, ?)', to_save)
+        logger.debug(f'FSM storage flushed {len(dirty)} records')
+
+    @staticmethod
+    def _is_empty(record: dict) -> bool:
+        return record['state'] is None and not record['data'] and not record['bucket']
+
+    async def close(self):
+        self._closed = True
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+        if self._dirty:
+            logger.warning(f'FSM storage closed with {len(self._dirty)} records not saved')
+
+    async def wait_closed(self):
+        with self._read_lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+        with self._db_lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        _, record = await self._resolve(chat, user)
+        return record['state'] or self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = await self._resolve(chat, user)
+        return copy.deepcopy(record['data'])
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        address, record = await self._resolve(chat, user)
+        self._mark_dirty(address, {**record, 'state': self.resolve_state(state)})
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        address, record = await self._resolve(chat, user)
+        self._mark_dirty(address, {**record, 'data': copy.deepcopy(data or {})})
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        address, record = await self._resolve(chat, user)
+        self._mark_dirty(address, {**record, 'data': {**record['data'], **(data or {}), **kwargs}})
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        address, record = await self._resolve(chat, user)
+        record = {**record, 'state': None}
+        if with_data:
+            record['data'] = {}
+        self._mark_dirty(address, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = await self._resolve(chat, user)
+        return copy.deepcopy(record['bucket'])
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        address, record = await self._resolve(chat, user)
+        self._mark_dirty(address, {**record, 'bucket': copy.deepcopy(bucket or {})})
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        address, record = await self._resolve(chat, user)
+        self._mark_dirty(address, {**record, 'bucket': {**record['bucket'], **(bucket or {}), **kwargs}})
@@ -0,0 +1,171 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from aiohttp import web
+from aiogram import Bot
+
+from utils.queries import QueryCounter
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _get_key(self, labels: dict) -> tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key: tuple[str, ...], **extra: str) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra.items())
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+    def get_lines(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        return '\n'.join(lines + self.get_lines())
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._get_key(labels), 0)
+
+    def get_lines(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{self._format_labels(key)} {value}' for key, value in values]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = default_buckets):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: counts for every bucket plus +Inf, sum of observed values
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._get_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[index] += 1
+            self._sums[key] = self._sums.get(key, 0) + value
+
+    def get_lines(self) -> list[str]:
+        lines = []
+        with self._lock:
+            items = [(key, list(counts), self._sums[key]) for key, counts in self._counts.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{self._format_labels(key, le=bound)} {cumulative}')
+            lines.append(f'{self.name}_sum{self._format_labels(key)} {total}')
+            lines.append(f'{self.name}_count{self._format_labels(key)} {cumulative}')
+        return lines
+
+
+registry: list[Metric] = []
+
+
+def render() -> str:
+    """All metrics in Prometheus text exposition format."""
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+update_count = Counter('bot_updates_total', 'Processed updates')
+handler_latency = Histogram('bot_handler_latency_seconds', 'Handler run time', ('handler',))
+handler_errors = Counter('bot_handler_errors_total', 'Exceptions raised by handlers', ('handler',))
+update_queries = Histogram(
+    'bot_update_db_queries', 'Database queries per update', buckets=(0, 1, 2, 4, 6, 8, 16, 32),
+)
+update_api_calls = Histogram(
+    'bot_update_api_calls', 'Bot API calls per update', buckets=(0, 1, 2, 3, 4, 6, 8),
+)
+api_calls = Counter('bot_api_calls_total', 'Bot API calls', ('method',))
+api_errors = Counter('bot_api_errors_total', 'Failed Bot API calls', ('method',))
+api_latency = Histogram('bot_api_latency_seconds', 'Bot API call time', ('method',))
+scheduler_lag = Histogram(
+    'bot_scheduler_job_lag_seconds', 'Delay between scheduled and actual job run', ('job',),
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300),
+)
+scheduler_missed = Counter('bot_scheduler_jobs_missed_total', 'Jobs which missed their run time', ('job',))
+throttled_updates = Counter('bot_updates_throttled_total', 'Updates dropped by the per-user limit', ('type',))
+coalesced_callbacks = Counter('bot_callbacks_coalesced_total', 'Duplicate callback queries answered without a handler')
+notification_count = Counter('bot_notifications_total', 'Payment notifications', ('status',))
+
+# API calls are counted per update like database queries
+current_api_counter: ContextVar[Optional[QueryCounter]] = ContextVar('current_api_counter', default=None)
+
+
+@contextmanager
+def count_api_calls():
+    counter = QueryCounter()
+    token = current_api_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        current_api_counter.reset(token)
+
+
+class InstrumentedBot(Bot):
+    """Bot which counts its API calls and measures their time."""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        counter = current_api_counter.get()
+        if counter is not None:
+            counter.count += 1
+        api_calls.inc(method=method)
+        started_at = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception:
+            api_errors.inc(method=method)
+            raise
+        finally:
+            api_latency.observe(time.perf_counter() - started_at, method=method)
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    """Serve metrics at http://host:port/metrics, meant for a local Prometheus."""
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
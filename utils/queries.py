@@ -0,0 +1,33 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from peewee import SqliteDatabase
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+
+current_counter: ContextVar[Optional[QueryCounter]] = ContextVar('current_counter', default=None)
+
+
+class CountingSqliteDatabase(SqliteDatabase):
+    """SqliteDatabase which reports every executed statement to the active QueryCounter."""
+
+    def execute_sql(self, *args, **kwargs):
+        counter = current_counter.get()
+        if counter is not None:
+            counter.count += 1
+        return super().execute_sql(*args, **kwargs)
+
+
+@contextmanager
+def count_queries():
+    counter = QueryCounter()
+    token = current_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        current_counter.reset(token)
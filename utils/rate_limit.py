@@ -0,0 +1,38 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Async token bucket: allows `rate` acquisitions per second with bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for `seconds`, e.g. after a flood-control error."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+        self._updated_at = self._paused_until
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
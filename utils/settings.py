@@ -1,18 +1,97 @@
 import logging
 from contextlib import suppress
-from collections import defaultdict
 
-from aiogram import Bot, Dispatcher
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from peewee import SqliteDatabase
+from aiogram import Dispatcher
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from playhouse.migrate import SqliteMigrator
+from pytz import timezone
 
+from utils.queries import CountingSqliteDatabase
+from utils.metrics import InstrumentedBot
 
-API_KEY = 'SOBAKA_BABAKA'
-PAYMENTS = defaultdict(dict)
-CACHE_CLEAR_TIMER = 300
 
-database = SqliteDatabase('default.db')
+API_KEY = '0:SOBAKA_BABAKA'  # well-formed placeholder, the real token goes to utils/local_settings.py
+TELEGRAM_API_URL = None  # e.g. 'http://127.0.0.1:8081' to talk to a local Bot API server
+WEBHOOK_URL = None  # public https address, webhook is registered in Telegram when set
+WEBHOOK_PATH = '/webhook'
+WEBAPP_HOST = '127.0.0.1'
+WEBAPP_PORT = 8080
+WEBHOOK_DRAIN_TIMEOUT = 30  # seconds to finish updates in progress on shutdown
+
+CACHE_CLEAR_TIMER = 300  # seconds, time to live of cached users
+CACHE_MAX_ENTRIES = 10000
+VIEW_CACHE_MAX_ENTRIES = 10000  # users with rendered payment views
+
+DATABASE_PATH = 'default.db'
+DATABASE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -16 * 1024,  # 16 MB
+}
+FSM_DATABASE_PATH = 'fsm.db'
+FSM_FLUSH_INTERVAL = 1  # seconds, FSM changes are written to disk in batches
+FSM_CACHE_SIZE = 10000
+
+DB_POOL_SIZE = 4  # threads running database queries
+LOOP_MONITOR_INTERVAL = 0.5  # seconds
+LOOP_LAG_WARNING = 0.1  # seconds, log when the event loop was blocked longer
+
+TIMEZONE = timezone('Europe/Moscow')
+NOTIFICATION_HOUR = 12
+# 'cron' - job per notification, 'sweeper' - single periodic job writing to the outbox,
+# 'worker' - like 'sweeper', but run by a separate `python main.py scheduler` process
+NOTIFICATION_MODE = 'cron'
+SWEEPER_INTERVAL = 60  # seconds
+SWEEPER_BATCH_SIZE = 500
+SWEEPER_MISFIRE_GRACE = 3600  # notifications late for more than this are skipped, not sent
+REHYDRATE_CHUNK_SIZE = 1000
+OUTBOX_POLL_INTERVAL = 5  # seconds between checks for undelivered outbox messages
+OUTBOX_BATCH_SIZE = 500
+OUTBOX_RETENTION_DAYS = 7  # sent messages are kept for this long
+
+SCHEDULER_THREAD_POOL_SIZE = 4  # for blocking jobs, coroutine jobs run on the event loop
+SCHEDULER_PROCESS_POOL_SIZE = 0  # for CPU heavy jobs, 0 disables the pool
+SCHEDULER_COALESCE = True  # run a job once if several runs were missed
+SCHEDULER_MAX_INSTANCES = 3
+SCHEDULER_MISFIRE_GRACE_TIME = 60  # seconds
+
+PAYMENTS_PAGE_SIZE = 10
+SEARCH_RESULTS_LIMIT = 10
+SUMMARY_TOP_SERVICES = 5
+UPCOMING_CHARGES_DAYS = 30  # window of the upcoming charges view
+UPCOMING_CHARGES_LIMIT = 20  # charges listed at most
+SUMMARY_CHECK_HOUR = 4  # daily consistency check of the spending summary
+STATS_FLUSH_INTERVAL = 60  # seconds between saves of the admin statistics counters
+IMPORT_MAX_ROWS = 500
+IMPORT_MAX_FILE_SIZE = 256 * 1024  # bytes
+EXPORT_CHUNK_SIZE = 500  # payments loaded per query
+EXPORT_SPOOL_SIZE = 1024 * 1024  # bytes kept in memory before the export goes to a temporary file
+
+QUERIES_PER_UPDATE_LIMIT = 6  # warn about handlers which make more queries
+THROTTLE_RATE_LIMIT = 5  # updates per user in THROTTLE_WINDOW, the rest is dropped
+THROTTLE_WINDOW = 2  # seconds
+THROTTLE_MAX_USERS = 10000  # users tracked at once
+COALESCE_TIMEOUT = 30  # seconds after which a callback still in flight no longer blocks its duplicates
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9100  # Prometheus metrics at /metrics, None to disable
+SCHEDULER_METRICS_PORT = 9101  # metrics of the scheduler process, None to disable
+PROFILE_MAX_UPDATES = 200  # /profile stops after this many updates
+PROFILE_MAX_SECONDS = 60  # or after this time, whatever comes first
+PROFILE_TOP_FUNCTIONS = 40
+PROFILE_TOP_ALLOCATIONS = 25
+PROFILE_TRACEMALLOC_FRAMES = 1  # frames kept per allocation, more is slower
+
+DELIVERY_RATE_LIMIT = 25  # notifications per second, leaves room for handlers under the global limit
+DELIVERY_WORKERS = 4
+DELIVERY_SPREAD_WINDOW = 0  # seconds, notifications due together are spread randomly over it
+DELIVERY_MAX_ATTEMPTS = 5  # then the message goes to the dead letters
+DELIVERY_RETRY_BACKOFF = 2  # seconds before the first retry, doubled after every attempt
+
+BROADCAST_RATE_LIMIT = 30  # messages per second, Telegram global limit
+BROADCAST_BATCH_SIZE = 500
+BROADCAST_PROGRESS_INTERVAL = 5  # seconds between progress reports
+
+database = CountingSqliteDatabase(DATABASE_PATH, pragmas=DATABASE_PRAGMAS)
 migrator = SqliteMigrator(database)
 
 logging.basicConfig(
@@ -34,7 +113,12 @@ def get_day_word(day: int) -> str:
 with suppress(ImportError):
     from utils.local_settings import *
 
+from utils.fsm_storage import SQLiteStorage
+
 
-bot = Bot(API_KEY)
-storage = MemoryStorage()
+bot = InstrumentedBot(
+    API_KEY,
+    server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION,
+)
+storage = SQLiteStorage(FSM_DATABASE_PATH, flush_interval=FSM_FLUSH_INTERVAL, cache_size=FSM_CACHE_SIZE)
 dp = Dispatcher(bot, storage=storage)
@@ -0,0 +1,23 @@
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """Logs how long every startup phase took since the previous one."""
+
+    def __init__(self):
+        self.started_at = self.last_mark = time.perf_counter()
+
+    def mark(self, phase: str) -> None:
+        now = time.perf_counter()
+        logger.info(
+            f'Startup phase "{phase}" took {now - self.last_mark:.3f} sec '
+            f'({now - self.started_at:.3f} sec total)'
+        )
+        self.last_mark = now
+
+
+startup_timer = StartupTimer()
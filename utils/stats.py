@@ -0,0 +1,63 @@
+import threading
+from datetime import date
+from typing import Optional
+
+from utils.dates import get_local_now
+
+
+class StatCounters:
+    """Admin statistics counted in memory instead of `COUNT(*)` on every view.
+
+    `values` are the stored totals as of the last flush, `pending` are changes
+    made by this process since then. Flushing adds `pending` to the stored
+    values, so several processes can count into the same rows.
+    Daily active users are remembered by id for the current day only, users
+    active before a restart may be counted again after it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values: dict[str, int] = {}
+        self.pending: dict[str, int] = {}
+        self._active_day: Optional[date] = None
+        self._active_users: set[int] = set()
+
+    def inc(self, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self.pending[key] = self.pending.get(key, 0) + amount
+
+    def get(self, key: str) -> int:
+        with self._lock:
+            return self.values.get(key, 0) + self.pending.get(key, 0)
+
+    def mark_active(self, telegram_id: int) -> None:
+        today = get_local_now().date()
+        with self._lock:
+            if today != self._active_day:
+                self._active_day = today
+                self._active_users.clear()
+            if telegram_id in self._active_users:
+                return
+            self._active_users.add(telegram_id)
+        self.inc(get_active_users_key(today))
+
+    def take_pending(self) -> dict[str, int]:
+        with self._lock:
+            pending, self.pending = self.pending, {}
+            return pending
+
+    def restore_pending(self, pending: dict[str, int]) -> None:
+        """Put back changes which could not be stored."""
+        for key, amount in pending.items():
+            self.inc(key, amount)
+
+    def set_values(self, values: dict[str, int]) -> None:
+        with self._lock:
+            self.values = values
+
+
+def get_active_users_key(day: date) -> str:
+    return f'active_users:{day.isoformat()}'
+
+
+stats = StatCounters()
@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class TTLCache:
+    """Bounded cache with per-entry time to live and LRU eviction.
+
+    Every entry lives the same `ttl`, so the order of writes is also the order
+    of expiry: expired entries are always at the head of `_expiry` and removing
+    them never needs a full scan. Safe to use from database worker threads.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, Any] = OrderedDict()  # least recently used first
+        self._expiry: OrderedDict[Hashable, float] = OrderedDict()  # soonest to expire first
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data and self._expiry[key] > time.monotonic()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            self.expire()
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self.expire()
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._expiry[key] = time.monotonic() + self.ttl
+            self._expiry.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                oldest, _ = self._data.popitem(last=False)
+                del self._expiry[oldest]
+                self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            self._expiry.pop(key, None)
+            return self._data.pop(key, default)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._expiry.clear()
+
+    def expire(self) -> int:
+        with self._lock:
+            now = time.monotonic()
+            expired = 0
+            while self._expiry:
+                key, expires_at = next(iter(self._expiry.items()))
+                if expires_at > now:
+                    break
+                del self._expiry[key]
+                del self._data[key]
+                expired += 1
+            self.evictions += expired
+            return expired
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }